@@ -12,6 +12,7 @@ setup(
     # package source directory
     package_dir={'shl_scripts': NAME},
     packages=find_packages(exclude=['contrib', 'docs', 'probe']),
+    package_data={'shl_scripts': ['shl_benchmark_baseline.json']},
     author='Laurent PERRINET, Institut de Neurosciences de la Timone (CNRS/Aix-Marseille Université)',
     description=' This is a collection of python scripts to test learning strategies to efficiently code natural image patches.  This is here restricted  to the framework of the [SparseNet algorithm from Bruno Olshausen](http://redwood.berkeley.edu/bruno/sparsenet/).',
     long_description=open('README.rst', 'r', encoding='utf-8').read(),
@@ -4,7 +4,7 @@ from __future__ import division, print_function, absolute_import
 __author__ = "Laurent Perrinet INT - CNRS"
 __version__ = '2017-02-09'
 __licence__ = 'GPLv2'
-__all__ = ['shl_experiments', 'shl_tools', 'shl_learn', 'shl_encode']
+__all__ = ['shl_experiments', 'shl_tools', 'shl_learn', 'shl_encode', 'shl_benchmark', 'shl_evaluate', 'shl_image', 'shl_server', 'shl_memory', 'shl_backend', 'shl_distributed', 'shl_trajectory']
 
 """
 ========================================================
@@ -39,7 +39,11 @@ Computation (2010) (see http://invibe.net/LaurentPerrinet/Publications/Perrinet1
 # from .shl_tools import *
 # from .shl_encode import *
 # from .shl_learn import *
-from shl_scripts import shl_tools
-from shl_scripts import shl_encode
-from shl_scripts import shl_learn
-from shl_scripts import shl_experiments
+
+# submodules are imported lazily on first access (PEP 562) such that a worker
+# which only needs ``shl_encode`` does not pay for the plotting stack
+def __getattr__(name):
+    if name in __all__:
+        import importlib
+        return importlib.import_module('shl_scripts.' + name)
+    raise AttributeError("module 'shl_scripts' has no attribute " + repr(name))
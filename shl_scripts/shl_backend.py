@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*
+from __future__ import division, print_function, absolute_import
+"""
+Execution backends.
+
+All parallel paths of the package (``sweep``, ``render_figures``, the
+``Pipeline`` of an experiment, and the sharded ``sparse_encode``,
+``evaluate`` and ``get_data``) map their jobs through a ``Backend``::
+
+    from shl_scripts.shl_backend import Backend
+    results = Backend('processes', n_jobs=4).map(func, jobs)
+
+The backend splits the cores between its workers and the BLAS threads of
+each worker (``n_cpus // n_workers`` by default), such that NumPy's matrix
+products in parallel workers do not oversubscribe the machine. In worker
+processes, the limit is set through the usual environment variables and,
+if ``threadpoolctl`` is installed, applied to the already loaded BLAS
+libraries. With threads, the limit needs ``threadpoolctl`` since all
+threads share the BLAS of the process.
+
+``set_default_backend`` chooses the backend used when none is given.
+
+"""
+import os
+
+BLAS_VARIABLES = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                  'VECLIB_MAXIMUM_THREADS', 'BLIS_NUM_THREADS', 'NUMEXPR_NUM_THREADS']
+
+KINDS = ['serial', 'threads', 'processes']
+
+_default_backend = None
+
+def cpu_count():
+    """
+    Number of CPUs available to this process.
+
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def split_cores(n_jobs=None, blas_threads=None, n_tasks=None):
+    """
+    Splits the available cores between workers and BLAS threads.
+
+    Parameters
+    ----------
+    n_jobs : int
+        Number of workers; None or a negative number uses all CPUs.
+
+    blas_threads : int
+        Number of BLAS threads per worker, by default ``n_cpus // n_workers``.
+
+    n_tasks : int
+        Number of tasks, which bounds the useful number of workers.
+
+    Returns
+    -------
+    n_workers, blas_threads : int
+
+    """
+    n_cpus = cpu_count()
+    n_workers = n_cpus if n_jobs is None or n_jobs < 1 else n_jobs
+    if not n_tasks is None: n_workers = max(1, min(n_workers, n_tasks))
+    if blas_threads is None: blas_threads = max(1, n_cpus // n_workers)
+    return n_workers, blas_threads
+
+def limit_blas_threads(n_threads):
+    """
+    Limits the number of threads of the BLAS libraries of this process.
+
+    Returns
+    -------
+    limits : threadpoolctl.threadpool_limits or None
+        None if ``threadpoolctl`` is not installed, in which case only the
+        environment variables (read by libraries loaded afterwards) are set.
+
+    """
+    for variable in BLAS_VARIABLES:
+        os.environ[variable] = str(n_threads)
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return None
+    return threadpool_limits(limits=n_threads)
+
+def _init_worker(blas_threads):
+    # keeps a reference such that the limits hold for the life of the worker
+    global _worker_limits
+    _worker_limits = limit_blas_threads(blas_threads)
+
+class Backend:
+    """Maps jobs serially, on a pool of threads or on a pool of processes.
+
+    Parameters
+    ----------
+    kind : {'serial', 'threads', 'processes'}
+
+    n_jobs : int
+        Number of workers (None or negative: all CPUs). With one worker, jobs
+        run serially in the calling thread.
+
+    blas_threads : int
+        Number of BLAS threads of each worker, by default such that
+        ``n_workers * blas_threads`` does not exceed the number of CPUs.
+
+    """
+    def __init__(self, kind='processes', n_jobs=None, blas_threads=None, verbose=0):
+        if not kind in KINDS:
+            raise ValueError('backend must be "serial", "threads" or "processes", got %s.' % kind)
+        self.kind = kind
+        self.n_jobs = n_jobs
+        self.blas_threads = blas_threads
+        self.verbose = verbose
+
+    def imap(self, func, *iterables):
+        """
+        Applies ``func`` to the jobs and yields the results in order, as
+        they are completed.
+
+        """
+        jobs = list(zip(*iterables))
+        n_workers, blas_threads = split_cores(self.n_jobs, self.blas_threads, n_tasks=len(jobs))
+        if self.kind == 'serial' or n_workers == 1:
+            for args in jobs:
+                yield func(*args)
+            return
+        if self.verbose: print('Running {} jobs on {} {} with {} BLAS thread(s) each'.format(
+                               len(jobs), n_workers, self.kind, blas_threads))
+        if self.kind == 'threads':
+            from concurrent.futures import ThreadPoolExecutor
+            try:
+                from threadpoolctl import threadpool_limits
+                limits = threadpool_limits(limits=blas_threads)
+            except ImportError:
+                limits = None
+            try:
+                with ThreadPoolExecutor(max_workers=n_workers) as executor:
+                    for result in executor.map(func, *zip(*jobs)):
+                        yield result
+            finally:
+                if not limits is None: limits.restore_original_limits()
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker,
+                                     initargs=(blas_threads,)) as executor:
+                futures = [executor.submit(func, *args) for args in jobs]
+                for future in futures:
+                    yield future.result()
+
+    def map(self, func, *iterables):
+        """
+        Applies ``func`` to the jobs (one per element of the iterables, as
+        with the builtin ``map``) and returns the list of results.
+
+        """
+        return list(self.imap(func, *iterables))
+
+def set_default_backend(kind, n_jobs=None, blas_threads=None):
+    """
+    Sets the backend used by the package when none is given, or resets
+    the defaults of each call site with None.
+
+    """
+    global _default_backend
+    _default_backend = None if kind is None else Backend(kind, n_jobs=n_jobs, blas_threads=blas_threads)
+
+def get_backend(backend=None, n_jobs=None, default='processes', verbose=0):
+    """
+    Returns the backend of a call site.
+
+    Parameters
+    ----------
+    backend : Backend or str
+        A backend, or its kind. By default, the one set by
+        ``set_default_backend`` or else ``default``.
+
+    n_jobs : int
+        Number of workers if a new backend is created; it overrides that of
+        the default backend.
+
+    """
+    if isinstance(backend, Backend):
+        return backend
+    if backend is None and not _default_backend is None:
+        if n_jobs is None: return _default_backend
+        return Backend(_default_backend.kind, n_jobs=n_jobs, blas_threads=_default_backend.blas_threads,
+                       verbose=verbose)
+    return Backend(default if backend is None else backend, n_jobs=n_jobs, verbose=verbose)
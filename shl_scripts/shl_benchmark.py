@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*
+from __future__ import division, print_function, absolute_import
+"""
+Benchmarks of the encoding and learning hot paths.
+
+All benchmarks run offline on synthetic data generated with
+``shl_tools.generate_sparse_vector`` against random dictionaries, apart from
+``get_data`` which uses the images bundled in ``probe/database`` (and
+requires SLIP). Run it as::
+
+    python -m shl_scripts.shl_benchmark --quick
+    python -m shl_scripts.shl_benchmark --baseline
+
+Each case reports the throughput (patches/s), the peak memory allocated
+during one call and, if a baseline is given, the speedup with respect to it.
+
+The reference baseline ``shl_benchmark_baseline.json`` (next to this module)
+holds the times of all cases (without ``get_data``) measured on one CPU
+with NumPy 1.23. Since times depend on the machine, a local baseline is
+better saved before changing the code, and then compared to::
+
+    python -m shl_scripts.shl_benchmark --save-baseline my_baseline.json
+    python -m shl_scripts.shl_benchmark --baseline my_baseline.json
+
+``encoder_frontier`` compares the sparse coding algorithms on ground-truth
+sparse signals (support recovery, coefficient error and throughput) and
+``plot_frontier`` draws the corresponding speed/accuracy Pareto plot::
+
+    python -m shl_scripts.shl_benchmark --frontier frontier.png
+
+``homeostasis_report`` compares the amortised homeostasis of
+``dict_learning`` (``homeo_every > 1``) to the update at every iteration::
+
+    python -m shl_scripts.shl_benchmark --homeostasis
+
+"""
+import time
+import os
+import json
+import tracemalloc
+import numpy as np
+
+datapath = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'probe', 'database')
+baseline_fname = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'shl_benchmark_baseline.json')
+
+def get_dictionary(n_dictionary, n_pixels, seed=42):
+    """
+    Returns a random dictionary with normalized atoms.
+
+    """
+    # a local generator, such that benchmarking does not reseed the global one
+    dictionary = np.random.default_rng(seed).standard_normal((n_dictionary, n_pixels))
+    dictionary /= np.sqrt(np.sum(dictionary**2, axis=1))[:, np.newaxis]
+    return dictionary
+
+def get_synthetic_data(n_samples, n_dictionary, l0_sparseness, n_pixels=256, do_sym=True, seed=42):
+    """
+    Returns synthetic patches as sparse combinations of the atoms of a random
+    dictionary, together with this dictionary and the ground-truth code.
+
+    """
+    from shl_scripts.shl_tools import generate_sparse_vector
+    dictionary = get_dictionary(n_dictionary, n_pixels, seed=seed)
+    sparse_vector = generate_sparse_vector(n_samples, l0_sparseness, n_dictionary, do_sym=do_sym, seed=seed)
+    return sparse_vector @ dictionary, dictionary, sparse_vector
+
+def get_P_cum_init(X, dictionary, nb_quant=128, do_sym=True):
+    """
+    Returns a uniform ``P_cum`` stacked with its rescaling vector, as
+    initialized in ``dict_learning``.
+
+    """
+    from shl_scripts.shl_encode import get_rescaling
+    P_cum = np.linspace(0, 1, nb_quant, endpoint=True)[np.newaxis, :] * np.ones((dictionary.shape[0], 1))
+    C_vec = get_rescaling(X @ dictionary.T, nb_quant=nb_quant, do_sym=do_sym)
+    return np.vstack((P_cum, C_vec))
+
+def measure(func, n_samples, repeat=3):
+    """
+    Times ``func()`` (best of ``repeat``) and measures the peak memory
+    allocated during one additional traced call.
+
+    """
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    dt = min(times)
+    return {'time':dt, 'throughput':n_samples / dt, 'peak_memory':peak}
+
+def get_cases(n_samples, n_dictionary, l0_sparseness, n_pixels=256, nb_quant=128):
+    """
+    Yields the (name, n_samples, func) benchmark cases for one size.
+
+    """
+    from shl_scripts.shl_encode import mp, sparse_encode, get_rescaling
+    from shl_scripts.shl_learn import dict_learning, get_P_cum
+
+    X, dictionary, _ = get_synthetic_data(n_samples, n_dictionary, l0_sparseness, n_pixels=n_pixels)
+    P_cum = get_P_cum_init(X, dictionary, nb_quant=nb_quant)
+    for do_sym in [True, False]:
+        yield ('mp do_sym={}'.format(do_sym), n_samples,
+               lambda do_sym=do_sym: mp(X, dictionary, l0_sparseness=l0_sparseness, do_sym=do_sym))
+        yield ('mp P_cum do_sym={}'.format(do_sym), n_samples,
+               lambda do_sym=do_sym: mp(X, dictionary, l0_sparseness=l0_sparseness, P_cum=P_cum, do_sym=do_sym))
+
+    for algorithm in ['mp', 'omp', 'lars']:
+        if not algorithm == 'mp':
+            try:
+                import sklearn
+            except ImportError:
+                continue
+        yield ('sparse_encode ' + algorithm, n_samples,
+               lambda algorithm=algorithm: sparse_encode(X, dictionary, algorithm=algorithm, l0_sparseness=l0_sparseness))
+
+    corr = X @ dictionary.T
+    yield ('get_rescaling', n_samples,
+           lambda: get_rescaling(corr.copy(), nb_quant=nb_quant, do_sym=True))
+    sparse_code = mp(X, dictionary, l0_sparseness=l0_sparseness, P_cum=P_cum)
+    yield ('get_P_cum', n_samples,
+           lambda: get_P_cum(sparse_code, C=P_cum[-1, :], nb_quant=nb_quant, do_sym=True))
+    yield ('dict_learning 1 iteration', n_samples,
+           lambda: dict_learning(X, dictionary=dictionary.copy(), P_cum=P_cum.copy(),
+                                 n_dictionary=n_dictionary, l0_sparseness=l0_sparseness,
+                                 n_iter=1, batch_size=n_samples, alpha_homeo=0.,
+                                 eta_homeo=0.01, nb_quant=nb_quant, do_sym=True))
+
+def get_data_case(n_image=10, max_patches=256, patch_size=(16, 16)):
+    """
+    Returns the (name, n_samples, func) benchmark case of ``get_data`` on the
+    bundled images, or None if SLIP is not available.
+
+    """
+    try:
+        import SLIP
+    except ImportError:
+        return None
+    from shl_scripts.shl_tools import get_data
+    return ('get_data', n_image * max_patches,
+            lambda: get_data(n_image=n_image, max_patches=max_patches, patch_size=patch_size,
+                             datapath=datapath, seed=42))
+
+def run_benchmarks(list_n_samples=[256, 1024], list_n_dictionary=[144, 324],
+                   list_l0_sparseness=[5, 15], n_pixels=256, repeat=3, do_data=True,
+                   baseline=None, verbose=0):
+    """
+    Runs all benchmarks across the given sizes.
+
+    Parameters
+    ----------
+    list_n_samples, list_n_dictionary, list_l0_sparseness : lists of int
+        Sizes of the problems to scan.
+
+    baseline : str
+        Filename of a baseline saved with ``save_baseline``. If given, the
+        results have a ``speedup`` column (baseline time / time).
+
+    Returns
+    -------
+    results : pandas DataFrame
+
+    """
+    import itertools
+    import pandas as pd
+    rows = []
+    for n_samples, n_dictionary, l0_sparseness in itertools.product(list_n_samples, list_n_dictionary, list_l0_sparseness):
+        for name, n_samples_, func in get_cases(n_samples, n_dictionary, l0_sparseness, n_pixels=n_pixels):
+            row = {'case':name, 'n_samples':n_samples_, 'n_dictionary':n_dictionary, 'l0_sparseness':l0_sparseness}
+            row.update(measure(func, n_samples_, repeat=repeat))
+            if verbose: print('{case:30s} n_samples={n_samples:6d} n_dictionary={n_dictionary:5d} l0_sparseness={l0_sparseness:3d} : {throughput:10.1f} patches/s'.format(**row))
+            rows.append(row)
+    if do_data:
+        case = get_data_case()
+        if not case is None:
+            name, n_samples_, func = case
+            row = {'case':name, 'n_samples':n_samples_, 'n_dictionary':0, 'l0_sparseness':0}
+            row.update(measure(func, n_samples_, repeat=1))
+            rows.append(row)
+        elif verbose:
+            print('SLIP is not available, skipping get_data')
+    results = pd.DataFrame(rows)
+    if not baseline is None:
+        results = compare_baseline(results, baseline)
+    return results
+
+def get_encoder(algorithm, X, dictionary, l0_sparseness, nb_quant=128):
+    """
+    Returns a function encoding X with the given algorithm. 'comp' stands for
+    matching pursuit with the homeostatic selection based on a (uniform)
+    ``P_cum``.
+
+    """
+    from shl_scripts.shl_encode import sparse_encode
+    if algorithm == 'comp':
+        P_cum = get_P_cum_init(X, dictionary, nb_quant=nb_quant)
+        return lambda: sparse_encode(X, dictionary, algorithm='mp', P_cum=P_cum, l0_sparseness=l0_sparseness)
+    return lambda: sparse_encode(X, dictionary, algorithm=algorithm, l0_sparseness=l0_sparseness)
+
+def encoder_frontier(list_n_dictionary=[144, 324], list_l0_sparseness=[5, 15],
+                     algorithms=['mp', 'comp', 'omp', 'lars'], n_samples=1024, n_pixels=256,
+                     seed=42, repeat=3, verbose=0):
+    """
+    Compares sparse coding algorithms on synthetic signals generated from a
+    known dictionary and a known sparse code.
+
+    Returns
+    -------
+    results : pandas DataFrame
+        For each algorithm and size: the support recovery (fraction of the
+        true support which is found), the relative error on the coefficients
+        and on the reconstruction, the throughput and whether the point is on
+        the Pareto front (throughput vs. support recovery) of its size.
+
+    """
+    import itertools
+    import pandas as pd
+    rows = []
+    for n_dictionary, l0_sparseness in itertools.product(list_n_dictionary, list_l0_sparseness):
+        X, dictionary, sparse_vector = get_synthetic_data(n_samples, n_dictionary, l0_sparseness,
+                                                          n_pixels=n_pixels, seed=seed)
+        support = sparse_vector != 0
+        for algorithm in algorithms:
+            if algorithm in ['omp', 'lars']:
+                try:
+                    import sklearn
+                except ImportError:
+                    if verbose: print('sklearn is not available, skipping', algorithm)
+                    continue
+            func = get_encoder(algorithm, X, dictionary, l0_sparseness)
+            sparse_code = func()
+            row = {'algorithm':algorithm, 'n_dictionary':n_dictionary, 'l0_sparseness':l0_sparseness,
+                   'support_recovery':np.sum(support & (sparse_code != 0)) / np.sum(support),
+                   'coeff_error':np.linalg.norm(sparse_code - sparse_vector) / np.linalg.norm(sparse_vector),
+                   'rec_error':np.linalg.norm(X - sparse_code @ dictionary) / np.linalg.norm(X)}
+            row.update(measure(func, n_samples, repeat=repeat))
+            if verbose: print('{algorithm:6s} n_dictionary={n_dictionary:5d} l0_sparseness={l0_sparseness:3d} : recovery={support_recovery:.3f} coeff_error={coeff_error:.3f} {throughput:10.1f} patches/s'.format(**row))
+            rows.append(row)
+    results = pd.DataFrame(rows)
+    results['pareto'] = False
+    for _, group in results.groupby(['n_dictionary', 'l0_sparseness']):
+        for i, row in group.iterrows():
+            dominated = ((group['throughput'] >= row['throughput']) & (group['support_recovery'] >= row['support_recovery'])
+                         & ((group['throughput'] > row['throughput']) | (group['support_recovery'] > row['support_recovery'])))
+            results.loc[i, 'pareto'] = not dominated.any()
+    return results
+
+def plot_frontier(results, fname=None):
+    """
+    Draws, for each size, the support recovery against the throughput of each
+    algorithm and links the points of the Pareto front.
+
+    """
+    import matplotlib.pyplot as plt
+    fig = plt.figure(figsize=(12, 6))
+    ax = fig.add_subplot(111)
+    markers = dict(zip(sorted(results['algorithm'].unique()), 'osD^v<>'))
+    for (n_dictionary, l0_sparseness), group in results.groupby(['n_dictionary', 'l0_sparseness']):
+        front = group[group['pareto']].sort_values('throughput')
+        lines = ax.plot(front['throughput'], front['support_recovery'], '--', alpha=.5,
+                        label='n_dictionary={}, l0_sparseness={}'.format(n_dictionary, l0_sparseness))
+        for _, row in group.iterrows():
+            ax.plot(row['throughput'], row['support_recovery'], markers[row['algorithm']],
+                    c=lines[0].get_color(), ms=8)
+    for algorithm, marker in markers.items():
+        ax.plot([], [], marker, c='k', label=algorithm)
+    ax.set_xscale('log')
+    ax.set_xlabel('throughput (patches/s)')
+    ax.set_ylabel('support recovery')
+    ax.legend(loc='best')
+    if not fname is None: fig.savefig(fname, dpi=200)
+    return fig, ax
+
+def homeostasis_report(list_homeo_every=[1, 2, 4, 8, 16], n_samples=4096, n_dictionary=144,
+                       l0_sparseness=10, n_pixels=256, n_iter=256, batch_size=128, eta_homeo=0.01,
+                       nb_quant=128, seed=42, verbose=0):
+    """
+    Learns the same dictionary (same initialization and batches) with the
+    homeostasis folded every ``homeo_every`` iterations.
+
+    Returns
+    -------
+    results : pandas DataFrame
+        For each ``homeo_every``: the time spent in the homeostasis and its
+        fraction of the learning time, the deviation of the final ``P_cum``
+        and rescaling vector from those obtained with ``homeo_every=1``, the
+        reconstruction error (RMSE) and the entropy of the probabilities of
+        selection of the final dictionary.
+
+    """
+    import pandas as pd
+    from shl_scripts.shl_learn import dict_learning, StageTimer
+    from shl_scripts.shl_encode import sparse_encode
+    from shl_scripts.shl_evaluate import Evaluation
+    X, dictionary, sparse_vector = get_synthetic_data(n_samples, n_dictionary, l0_sparseness,
+                                                      n_pixels=n_pixels, seed=seed)
+    init = np.random.RandomState(seed).randn(n_dictionary, n_pixels)
+    rows, reference = [], None
+    for homeo_every in list_homeo_every:
+        timer = StageTimer()
+        dico, P_cum = dict_learning(X, dictionary=init.copy(), n_dictionary=n_dictionary,
+                                    l0_sparseness=l0_sparseness, n_iter=n_iter, batch_size=batch_size,
+                                    eta_homeo=eta_homeo, alpha_homeo=0., nb_quant=nb_quant,
+                                    timer=timer, homeo_every=homeo_every, random_state=seed)
+        if reference is None: reference = P_cum
+        evaluation = Evaluation(n_dictionary)
+        evaluation.update(X, sparse_encode(X, dico, P_cum=P_cum, l0_sparseness=l0_sparseness), dico)
+        report = timer.report()
+        homeostasis = report.loc[[stage for stage in ['get_rescaling', 'update_P_cum'] if stage in report.index], 'total'].sum()
+        row = {'homeo_every':homeo_every, 'time':report['total'].sum(), 'homeostasis_time':homeostasis,
+               'homeostasis_fraction':homeostasis / report['total'].sum(),
+               'P_cum_error':np.abs(P_cum[:-1, :] - reference[:-1, :]).max(),
+               'C_error':np.abs(P_cum[-1, :] - reference[-1, :]).max() / reference[-1, :].max(),
+               'rmse':evaluation.rmse, 'entropy':evaluation.entropy}
+        if verbose: print('homeo_every={homeo_every:3d} : homeostasis={homeostasis_fraction:.3f} of {time:.2f}s, P_cum_error={P_cum_error:.4f}, C_error={C_error:.4f}, rmse={rmse:.4f}, entropy={entropy:.4f}'.format(**row))
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+def get_key(row):
+    return '{case} n_samples={n_samples} n_dictionary={n_dictionary} l0_sparseness={l0_sparseness}'.format(**row)
+
+def save_baseline(results, fname):
+    with open(fname, 'w') as fp:
+        json.dump({get_key(row):row['time'] for _, row in results.iterrows()}, fp, indent=1, sort_keys=True)
+
+def compare_baseline(results, fname):
+    with open(fname, 'r') as fp:
+        baseline = json.load(fp)
+    results = results.copy()
+    results['speedup'] = [baseline[get_key(row)] / row['time'] if get_key(row) in baseline else np.nan
+                          for _, row in results.iterrows()]
+    return results
+
+if __name__ == '__main__':
+    import argparse
+    import pandas as pd
+    parser = argparse.ArgumentParser(description='Benchmarks of the encode and learn hot paths')
+    parser.add_argument('--quick', action='store_true', help='only run the smallest sizes')
+    parser.add_argument('--baseline', default=None, nargs='?', const=baseline_fname,
+                        help='compare to this baseline file (by default, the reference one)')
+    parser.add_argument('--save-baseline', default=None,
+                        help='save the results as a baseline file (the reference one is not overwritten by default)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--frontier', default=None, nargs='?', const='',
+                        help='compare the encoders on ground-truth signals (and save the Pareto plot to this file)')
+    parser.add_argument('--homeostasis', action='store_true',
+                        help='compare the amortised homeostasis to the update at every iteration')
+    args = parser.parse_args()
+
+    if args.homeostasis:
+        if args.quick:
+            sizes = dict(list_homeo_every=[1, 8], n_iter=64)
+        else:
+            sizes = dict()
+        results = homeostasis_report(verbose=1, **sizes)
+    elif not args.frontier is None:
+        if args.quick:
+            sizes = dict(list_n_dictionary=[144], list_l0_sparseness=[5])
+        else:
+            sizes = dict()
+        results = encoder_frontier(repeat=args.repeat, verbose=1, **sizes)
+        if args.frontier:
+            import matplotlib
+            matplotlib.use('Agg')
+            plot_frontier(results, fname=args.frontier)
+    else:
+        if args.quick:
+            sizes = dict(list_n_samples=[256], list_n_dictionary=[144], list_l0_sparseness=[5])
+        else:
+            sizes = dict()
+        results = run_benchmarks(repeat=args.repeat, baseline=args.baseline, verbose=1, **sizes)
+        if not args.save_baseline is None:
+            save_baseline(results, args.save_baseline)
+    with pd.option_context('display.max_rows', None, 'display.max_columns', None, 'display.width', 200):
+        print(results)
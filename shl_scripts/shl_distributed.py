@@ -0,0 +1,437 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*
+from __future__ import division, print_function, absolute_import
+"""
+Distributed dictionary learning with a parameter server.
+
+A ``Coordinator`` holds the dictionary and the homeostasis (``P_cum`` or the
+gains) and listens on a TCP socket. Workers, on the same or on other hosts,
+each hold a shard of the patches and loop over:
+
+- pull the current dictionary and ``P_cum`` (with their version),
+- encode a mini-batch of their shard,
+- push back the Hebbian gradient ``sparse_code.T @ residual / n_dictionary``
+  and the statistics of the homeostasis (the histograms of the rescaled
+  coefficients and the rescaling vector, or the energy of each atom).
+
+The coordinator applies each push as one iteration of ``dict_learning``.
+A push computed from a dictionary more than ``max_staleness`` versions old
+is rejected and the worker pulls again, such that the staleness is bounded.
+Arrays are framed as in ``shl_server`` and sent as float32. Workers are
+stateless: a lost worker only loses its current mini-batch and the others
+keep on training.
+
+On one machine, ``dict_learning_distributed`` starts a coordinator on
+localhost and local worker processes (restarting those which die)::
+
+    dictionary, P_cum = dict_learning_distributed(data, n_dictionary=324, n_workers=4)
+
+On other hosts, workers are started with::
+
+    python -m shl_scripts.shl_distributed host:port shard.npy
+
+"""
+import time
+import socket
+import threading
+import numpy as np
+
+from shl_scripts.shl_server import pack_message, recv_message
+
+def pack_arrays(header, arrays, dtype=np.float32):
+    """
+    Frames a header and a list of arrays as a single message, the arrays
+    being concatenated into one payload of type ``dtype``.
+
+    """
+    header = dict(header, shapes=[array.shape for array in arrays])
+    payload = np.concatenate([np.asarray(array, dtype=dtype).ravel() for array in arrays]) if arrays else None
+    return pack_message(header, payload)
+
+def unpack_arrays(header, payload):
+    """
+    Splits the payload of a message framed by ``pack_arrays`` into arrays
+    of type float64.
+
+    """
+    arrays, i_start = [], 0
+    for shape in header.get('shapes', []):
+        size = int(np.prod(shape))
+        arrays.append(payload[i_start:i_start+size].astype(np.float64).reshape(shape))
+        i_start += size
+    return arrays
+
+def init_P_cum(X, dictionary, batch_size=100, nb_quant=100, C=0., do_sym=True):
+    """
+    Initial ``P_cum`` of ``dict_learning`` (with the rescaling vector of a
+    first mini-batch stacked as its last row if ``C=0.``).
+
+    """
+    from shl_scripts.shl_encode import get_rescaling
+    n_dictionary = dictionary.shape[0]
+    P_cum = np.linspace(0, 1, nb_quant, endpoint=True)[np.newaxis, :] * np.ones((n_dictionary, 1))
+    if C == 0.:
+        corr = (np.asarray(X[:batch_size, :]) @ dictionary.T)
+        P_cum = np.vstack((P_cum, get_rescaling(corr, nb_quant=nb_quant, do_sym=do_sym)))
+    return P_cum
+
+class Coordinator:
+    """Parameter server of a distributed ``dict_learning``.
+
+    Parameters
+    ----------
+    dictionary : array of shape (n_dictionary, n_pixels)
+        Initial dictionary.
+
+    P_cum : array
+        Initial ``P_cum`` (see ``init_P_cum``) if ``alpha_homeo=0``,
+        else the gains are learned.
+
+    address : tuple
+        ``(host, port)`` to listen on, port 0 picking a free port (see
+        ``address`` once started).
+
+    n_iter : int
+        Number of updates (accepted pushes) to apply.
+
+    max_staleness : int
+        Maximal number of updates applied between the pull of a dictionary
+        and the push of the gradient computed with it.
+
+    The other parameters are those of ``dict_learning``, sent to the workers
+    when they connect.
+
+    Attributes
+    ----------
+    version : int
+        Number of updates applied.
+
+    """
+    def __init__(self, dictionary, P_cum=None, address=('127.0.0.1', 0), n_iter=100, eta=0.02,
+                 eta_homeo=0.01, alpha_homeo=0.02, l0_sparseness=10, batch_size=100, method='mp', C=0.,
+                 nb_quant=100, do_sym=True, max_staleness=8, verbose=0):
+        self.dictionary = np.array(dictionary, dtype=float)
+        self.dictionary /= np.sqrt(np.sum(self.dictionary**2, axis=1))[:, np.newaxis]
+        self.P_cum = None if P_cum is None else np.array(P_cum, dtype=float)
+        if self.P_cum is None and alpha_homeo == 0:
+            raise ValueError('an initial P_cum is needed when alpha_homeo=0, see init_P_cum.')
+        self.mean_var = np.ones(self.dictionary.shape[0])
+        self.address = address
+        self.n_iter = n_iter
+        self.eta, self.eta_homeo, self.alpha_homeo = eta, eta_homeo, alpha_homeo
+        self.l0_sparseness, self.batch_size, self.method = l0_sparseness, batch_size, method
+        self.C, self.nb_quant, self.do_sym = C, nb_quant, do_sym
+        self.max_staleness = max_staleness
+        self.verbose = verbose
+        self.version = 0
+        self.n_rejected = 0
+        self.staleness = []
+        self.workers = {}
+        self.n_workers_seen = 0
+        self.t_last = time.time()
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+        self.server = None
+
+    def config(self):
+        return dict(n_dictionary=self.dictionary.shape[0], l0_sparseness=self.l0_sparseness,
+                    batch_size=self.batch_size, method=self.method, C=self.C, nb_quant=self.nb_quant,
+                    do_sym=self.do_sym, homeostasis='gain' if self.P_cum is None else 'P_cum')
+
+    def register(self):
+        with self.lock:
+            worker = self.n_workers_seen
+            self.n_workers_seen += 1
+            self.workers[worker] = 0
+        if self.verbose: print('Worker', worker, 'connected')
+        return worker
+
+    def unregister(self, worker):
+        with self.lock:
+            n_pushes = self.workers.pop(worker, None)
+        if self.verbose and not n_pushes is None and not self.finished.is_set():
+            print('Worker', worker, 'left after', n_pushes, 'updates')
+
+    def pull(self):
+        """
+        Returns the version of the state and its arrays (the dictionary and,
+        if any, ``P_cum``).
+
+        """
+        with self.lock:
+            arrays = [self.dictionary] if self.P_cum is None else [self.dictionary, self.P_cum]
+            return self.version, [array.copy() for array in arrays]
+
+    def push(self, worker, version, arrays):
+        """
+        Applies the contribution of a worker computed with the state of
+        ``version``, unless it is too stale or the learning is finished.
+
+        Returns
+        -------
+        accepted : bool
+
+        """
+        with self.lock:
+            if self.finished.is_set(): return False
+            staleness = self.version - version
+            if staleness > self.max_staleness:
+                self.n_rejected += 1
+                return False
+            self.apply(arrays)
+            self.staleness.append(staleness)
+            self.version += 1
+            self.t_last = time.time()
+            if worker in self.workers: self.workers[worker] += 1
+            if self.verbose > 1 and self.version % max(self.n_iter // self.verbose, 1) == 0:
+                print('Iteration {} / {} (staleness {}, {} rejected)'.format(self.version, self.n_iter,
+                                                                          staleness, self.n_rejected))
+            if self.version >= self.n_iter: self.finished.set()
+            return True
+
+    def apply(self, arrays):
+        # as one iteration of ``dict_learning`` with ``optimizer='sgd'``
+        from shl_scripts.shl_learn import get_P_cum_from_counts
+        gradient = arrays[0]
+        self.dictionary += self.eta * gradient
+        self.dictionary /= np.sqrt(np.sum(self.dictionary**2, axis=1))[:, np.newaxis]
+        if self.eta_homeo > 0.:
+            if self.P_cum is None:
+                energy = arrays[1]
+                self.mean_var = (1 - self.eta_homeo) * self.mean_var + self.eta_homeo * energy / energy.mean()
+                gain = self.mean_var**self.alpha_homeo
+                gain /= gain.mean()
+                self.dictionary /= gain[:, np.newaxis]
+            elif self.C == 0.:
+                counts, C_vec = arrays[1], arrays[2]
+                self.P_cum[-1, :] = (1 - self.eta_homeo) * self.P_cum[-1, :] + self.eta_homeo * C_vec
+                self.P_cum[:-1, :] = (1 - self.eta_homeo) * self.P_cum[:-1, :] + self.eta_homeo * get_P_cum_from_counts(counts)
+            else:
+                self.P_cum = (1 - self.eta_homeo) * self.P_cum + self.eta_homeo * get_P_cum_from_counts(arrays[1])
+
+    def stats(self):
+        with self.lock:
+            return dict(version=self.version, n_rejected=self.n_rejected, n_workers=len(self.workers),
+                        n_workers_seen=self.n_workers_seen,
+                        mean_staleness=float(np.mean(self.staleness)) if self.staleness else 0.,
+                        max_staleness=int(np.max(self.staleness)) if self.staleness else 0)
+
+    def start(self):
+        """
+        Starts listening in a background thread.
+
+        """
+        import socketserver
+        coordinator = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                coordinator.handle(self.request)
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self.server = socketserver.ThreadingTCPServer(tuple(self.address), Handler)
+        self.server.daemon_threads = True
+        self.address = self.server.server_address[:2]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        if self.verbose: print('Coordinator listening on', self.address)
+        return self
+
+    def handle(self, sock):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        worker = None
+        try:
+            while True:
+                try:
+                    header, payload = recv_message(sock)
+                except (ConnectionError, OSError):
+                    break
+                op = header.get('op')
+                if op == 'hello':
+                    worker = self.register()
+                    reply = pack_message(dict(self.config(), worker=worker))
+                elif op == 'pull':
+                    version, arrays = self.pull()
+                    reply = pack_arrays({'version': version, 'done': self.finished.is_set()}, arrays)
+                elif op == 'push':
+                    accepted = self.push(worker, header['version'], unpack_arrays(header, payload))
+                    reply = pack_message({'accepted': accepted, 'done': self.finished.is_set()})
+                elif op == 'stats':
+                    reply = pack_message(self.stats())
+                else:
+                    reply = pack_message({'error': 'unknown operation {}'.format(op)})
+                sock.sendall(reply)
+        finally:
+            self.unregister(worker)
+
+    def wait(self, timeout=None):
+        """
+        Waits until ``n_iter`` updates were applied, or until no update was
+        applied for ``timeout`` seconds (in which case a RuntimeError is raised).
+
+        """
+        while not self.finished.wait(0.1):
+            if not timeout is None and time.time() - self.t_last > timeout:
+                raise RuntimeError('no update for {}s after {} / {} iterations'.format(timeout, self.version, self.n_iter))
+
+    def stop(self):
+        self.finished.set()
+        if not self.server is None:
+            self.server.shutdown()
+            self.server.server_close()
+
+def run_worker(address, X, seed=None, blas_threads=None, verbose=0):
+    """
+    Runs a worker on its shard ``X`` of patches until the coordinator at
+    ``address`` has finished.
+
+    Returns
+    -------
+    n_accepted : int
+        Number of contributions which were applied.
+
+    """
+    from shl_scripts.shl_encode import sparse_encode, get_rescaling
+    from shl_scripts.shl_learn import get_P_cum_counts
+    if not blas_threads is None:
+        from shl_scripts.shl_backend import limit_blas_threads
+        limits = limit_blas_threads(blas_threads)
+    sock = socket.create_connection(tuple(address))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def request(header, message=None):
+        sock.sendall(pack_message(header) if message is None else message)
+        header, payload = recv_message(sock)
+        if 'error' in header: raise RuntimeError(header['error'])
+        return header, payload
+
+    config, _ = request({'op': 'hello'})
+    n_dictionary, C, nb_quant, do_sym = config['n_dictionary'], config['C'], config['nb_quant'], config['do_sym']
+    rng = np.random.RandomState(seed)
+    # cycles over the mini-batches of the shard, as ``dict_learning``
+    n_samples = X.shape[0]
+    batches = np.array_split(rng.permutation(n_samples), max(n_samples // config['batch_size'], 1))
+    n_accepted, ii = 0, 0
+    try:
+        while True:
+            header, payload = request({'op': 'pull'})
+            if header['done']: break
+            arrays = unpack_arrays(header, payload)
+            dictionary, P_cum = arrays[0], arrays[1] if len(arrays) > 1 else None
+            this_X = np.asarray(X[batches[ii % len(batches)], :], dtype=float)
+            ii += 1
+            sparse_code = sparse_encode(this_X, dictionary, algorithm=config['method'], P_cum=P_cum, C=C,
+                                        do_sym=do_sym, l0_sparseness=config['l0_sparseness'])
+            residual = (this_X - sparse_code @ dictionary) / n_dictionary
+            contribution = [sparse_code.T @ residual]
+            if P_cum is None:
+                contribution.append(np.sum(sparse_code**2, axis=0))
+            elif C == 0.:
+                contribution.append(get_P_cum_counts(sparse_code, C=P_cum[-1, :], nb_quant=P_cum.shape[1], do_sym=do_sym))
+                contribution.append(get_rescaling(this_X @ dictionary.T, nb_quant=nb_quant, do_sym=do_sym))
+            else:
+                contribution.append(get_P_cum_counts(sparse_code, C=C, nb_quant=P_cum.shape[1], do_sym=do_sym))
+            header, _ = request(None, pack_arrays({'op': 'push', 'version': header['version']}, contribution))
+            n_accepted += header['accepted']
+            if header['done']: break
+    except ConnectionError:
+        # the coordinator stopped
+        pass
+    finally:
+        sock.close()
+    if verbose: print('Worker {} done after {} accepted updates'.format(config['worker'], n_accepted))
+    return n_accepted
+
+def dict_learning_distributed(X, dictionary=None, P_cum=None, n_workers=2, eta=0.02, n_dictionary=2,
+                              l0_sparseness=10, n_iter=100, eta_homeo=0.01, alpha_homeo=0.02, batch_size=100,
+                              method='mp', C=0., nb_quant=100, do_sym=True, max_staleness=None,
+                              address=('127.0.0.1', 0), max_restarts=2, timeout=60., random_state=None,
+                              verbose=0):
+    """
+    Learns a dictionary with a coordinator and ``n_workers`` local worker
+    processes, each on a contiguous shard of ``X``.
+
+    Workers which die are restarted (at most ``max_restarts`` times in
+    total); learning goes on as long as one worker is alive.
+
+    Parameters
+    ----------
+    X: array of shape (n_samples, n_pixels)
+        Data matrix.
+
+    max_staleness : int
+        See ``Coordinator``, by default ``2 * n_workers``.
+
+    timeout : float
+        Time (in seconds) without any update after which learning is aborted
+        with a RuntimeError.
+
+    The other parameters are those of ``dict_learning`` (with
+    ``optimizer='sgd'`` and constant learning rates).
+
+    Returns
+    -------
+    dictionary : array of shape (n_dictionary, n_pixels)
+
+    P_cum : array or None
+
+    """
+    import multiprocessing
+    from shl_scripts.shl_backend import split_cores
+    if n_dictionary is None:
+        n_dictionary = X.shape[1]
+    if dictionary is None:
+        dictionary = np.random.RandomState(random_state).randn(n_dictionary, X.shape[1])
+    dictionary = dictionary / np.sqrt(np.sum(dictionary**2, axis=1))[:, np.newaxis]
+    if alpha_homeo == 0 and P_cum is None:
+        P_cum = init_P_cum(X, dictionary, batch_size=batch_size, nb_quant=nb_quant, C=C, do_sym=do_sym)
+    if max_staleness is None: max_staleness = 2 * n_workers
+    coordinator = Coordinator(dictionary, P_cum=P_cum, address=address, n_iter=n_iter, eta=eta,
+                              eta_homeo=eta_homeo, alpha_homeo=alpha_homeo, l0_sparseness=l0_sparseness,
+                              batch_size=batch_size, method=method, C=C, nb_quant=nb_quant, do_sym=do_sym,
+                              max_staleness=max_staleness, verbose=verbose).start()
+    n_workers, blas_threads = split_cores(n_workers)
+    bounds = np.linspace(0, X.shape[0], n_workers + 1).astype(int)
+    seed = 0 if random_state is None else random_state
+
+    def spawn(i_worker, i_restart=0):
+        process = multiprocessing.Process(target=run_worker, daemon=True,
+                        args=(coordinator.address, X[bounds[i_worker]:bounds[i_worker+1]]),
+                        kwargs=dict(seed=seed + i_worker + n_workers * i_restart, blas_threads=blas_threads))
+        process.start()
+        return process
+
+    processes = [spawn(i_worker) for i_worker in range(n_workers)]
+    n_restarts = 0
+    try:
+        while not coordinator.finished.wait(0.1):
+            for i_worker, process in enumerate(processes):
+                if process.is_alive() or process.exitcode == 0: continue
+                if n_restarts < max_restarts:
+                    n_restarts += 1
+                    if verbose: print('Worker process {} died (exit code {}), restarting'.format(i_worker, process.exitcode))
+                    processes[i_worker] = spawn(i_worker, n_restarts)
+            if not any(process.is_alive() for process in processes):
+                raise RuntimeError('all workers died after {} / {} iterations'.format(coordinator.version, n_iter))
+            if time.time() - coordinator.t_last > timeout:
+                raise RuntimeError('no update for {}s after {} / {} iterations'.format(timeout, coordinator.version, n_iter))
+    finally:
+        stats = coordinator.stats()
+        coordinator.stop()
+        for process in processes:
+            process.join(timeout=5)
+            if process.is_alive(): process.terminate()
+    if verbose: print('Distributed learning done:', stats)
+    return coordinator.dictionary, coordinator.P_cum
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Runs a worker of a distributed dictionary learning.')
+    parser.add_argument('address', help='host:port of the coordinator')
+    parser.add_argument('shard', help='.npy file of the patches of this worker')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--blas-threads', type=int, default=None)
+    args = parser.parse_args()
+    host, port = args.address.rsplit(':', 1)
+    run_worker((host, int(port)), np.load(args.shard, mmap_mode='r'), seed=args.seed,
+               blas_threads=args.blas_threads, verbose=1)
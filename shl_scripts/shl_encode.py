@@ -5,7 +5,8 @@ import numpy as np
 import time
 
 def sparse_encode(X, dictionary, algorithm='mp', fit_tol=None,
-                          P_cum=None, l0_sparseness=10, C=0., do_sym=True, verbose=0):
+                          P_cum=None, l0_sparseness=10, C=0., do_sym=True, verbose=0, gram_cache=None,
+                          atom_tree=None, chunk_size=None, n_jobs=None, backend=None):
     """Generic sparse coding
 
     Each column of the result is the solution to a sparse coding problem.
@@ -34,6 +35,24 @@ def sparse_encode(X, dictionary, algorithm='mp', fit_tol=None,
     max_iter : int, 1000 by default
         Maximum number of iterations to perform if `algorithm='lasso_cd'`.
 
+    gram_cache : int or GramCache
+        If `algorithm='mp'`, computes the rows of the Gram matrix on demand
+        and keeps at most this number of them in a LRU cache, see `mp`.
+
+    atom_tree : AtomTree
+        If `algorithm='mp'`, selects the atoms approximately by only
+        examining the best clusters of this index, see `mp_tree`.
+
+    chunk_size : int
+        Number of samples encoded at once. By default, all samples are
+        encoded at once, unless a memory budget is set (see
+        `shl_memory.set_memory_budget`), in which case the chunks are as
+        large as the budget allows.
+
+    n_jobs, backend :
+        If given, the samples are split into shards encoded in parallel, see
+        `shl_backend` (by default a pool of processes).
+
     verbose : int
         Controls the verbosity; the higher, the more messages. Defaults to 0.
 
@@ -47,6 +66,42 @@ def sparse_encode(X, dictionary, algorithm='mp', fit_tol=None,
         X = X[:, np.newaxis]
     #n_samples, n_pixels = X.shape
 
+    if not (n_jobs is None and backend is None):
+        from functools import partial
+        from shl_scripts.shl_backend import get_backend, split_cores
+        backend = get_backend(backend, n_jobs=n_jobs, default='processes', verbose=verbose)
+        if algorithm == 'mp' and atom_tree is None:
+            if gram_cache is None:
+                # the Gram matrix is computed once for all shards
+                gram_cache = dictionary @ dictionary.T
+            elif isinstance(gram_cache, GramCache):
+                # each shard fills its own cache
+                gram_cache = gram_cache.max_rows
+        n_shards = split_cores(backend.n_jobs, n_tasks=X.shape[0])[0]
+        encode = partial(sparse_encode, dictionary=dictionary, algorithm=algorithm, fit_tol=fit_tol,
+                         P_cum=P_cum, l0_sparseness=l0_sparseness, C=C, do_sym=do_sym, verbose=verbose,
+                         gram_cache=gram_cache, atom_tree=atom_tree, chunk_size=chunk_size)
+        return np.vstack(backend.map(encode, np.array_split(X, n_shards)))
+
+    if chunk_size is None:
+        from shl_scripts.shl_memory import get_memory_budget, get_chunk_size, estimate_encode
+        if not get_memory_budget() is None:
+            n_dictionary, n_pixels = dictionary.shape
+            chunk_size = get_chunk_size(lambda n: estimate_encode(n, n_dictionary, n_pixels, algorithm=algorithm,
+                                                                  gram_cache=gram_cache),
+                                        X.shape[0], reserved=8 * X.shape[0] * n_dictionary)
+    if not chunk_size is None and chunk_size < X.shape[0]:
+        if algorithm == 'mp' and gram_cache is None and atom_tree is None:
+            # the Gram matrix is shared by all chunks
+            gram_cache = dictionary @ dictionary.T
+        sparse_code = np.zeros((X.shape[0], dictionary.shape[0]))
+        for i_start in range(0, X.shape[0], chunk_size):
+            sparse_code[i_start:i_start+chunk_size, :] = sparse_encode(X[i_start:i_start+chunk_size, :],
+                        dictionary, algorithm=algorithm, fit_tol=fit_tol, P_cum=P_cum,
+                        l0_sparseness=l0_sparseness, C=C, do_sym=do_sym, verbose=verbose,
+                        gram_cache=gram_cache, atom_tree=atom_tree, chunk_size=chunk_size)
+        return sparse_code
+
     if algorithm == 'lasso_lars':
         alpha = float(regularization) / n_pixels  # account for scaling
 
@@ -108,13 +163,63 @@ def sparse_encode(X, dictionary, algorithm='mp', fit_tol=None,
 
     elif algorithm == 'mp':
         sparse_code = mp(X, dictionary, l0_sparseness=l0_sparseness, fit_tol=fit_tol,
-                            P_cum=P_cum, C=C, do_sym=do_sym, verbose=verbose)
+                            P_cum=P_cum, C=C, do_sym=do_sym, verbose=verbose, gram_cache=gram_cache,
+                            atom_tree=atom_tree)
     else:
         raise ValueError('Sparse coding method must be "mp", "lasso_lars" '
                          '"lasso_cd",  "lasso", "threshold" or "omp", got %s.'
                          % algorithm)
     return sparse_code
 
+def sparse_encode_multi(X, dictionaries, P_cums=None, l0_sparseness=10, C=0., do_sym=True,
+                        gram_caches=None, verbose=0):
+    """Matching Pursuit of the same data with many dictionaries
+
+    The correlations of the data with the atoms of all dictionaries are
+    computed with a single matrix product against the stacked atoms, then
+    each dictionary runs its own Matching Pursuit from its block of
+    correlations (see ``mp``).
+
+    Parameters
+    ----------
+    X : array of shape (n_samples, n_pixels)
+        Data matrix.
+
+    dictionaries : list of arrays of shape (n_dictionary, n_pixels)
+        The number of atoms may differ between dictionaries.
+
+    P_cums : list
+        ``P_cum`` of each dictionary (or None).
+
+    l0_sparseness : int or list of int
+
+    C, do_sym :
+        As in ``mp``, either shared by all dictionaries or given as a list
+        with one value per dictionary.
+
+    gram_caches : list of GramCache
+        Caches of the Gram rows of each dictionary, to be reused across
+        calls (e.g. across the chunks of a dataset).
+
+    Returns
+    -------
+    sparse_codes : list of arrays of shape (n_samples, n_dictionary)
+
+    """
+    n_dictionaries = len(dictionaries)
+    if P_cums is None: P_cums = [None] * n_dictionaries
+    if gram_caches is None: gram_caches = [None] * n_dictionaries
+    if np.ndim(l0_sparseness) == 0: l0_sparseness = [l0_sparseness] * n_dictionaries
+    if not isinstance(C, (list, tuple)): C = [C] * n_dictionaries
+    if np.ndim(do_sym) == 0: do_sym = [do_sym] * n_dictionaries
+    if X.ndim == 1:
+        X = X[:, np.newaxis]
+    corr = X @ np.vstack(dictionaries).T
+    bounds = np.cumsum([0] + [dictionary.shape[0] for dictionary in dictionaries])
+    return [mp(X, dictionary, l0_sparseness=l0_sparseness[i], P_cum=P_cums[i], C=C[i], do_sym=do_sym[i],
+               gram_cache=gram_caches[i], corr=corr[:, bounds[i]:bounds[i+1]], verbose=verbose)
+            for i, dictionary in enumerate(dictionaries)]
+
 def get_rescaling(code, nb_quant, do_sym=False, verbose=False):
     if do_sym:
         code = np.abs(code)
@@ -168,7 +273,58 @@ def quantile(P_cum, p_c, stick):
     """
     return P_cum.ravel()[(p_c*P_cum.shape[1] - (p_c==1)).astype(np.int) + stick]
 
-def mp(X, dictionary, l0_sparseness=10, fit_tol=None, do_sym=True, P_cum=None, C=0., verbose=0):
+class GramCache:
+    """Rows of the Gram matrix of a dictionary, computed on demand.
+
+    Matching Pursuit only needs the rows ``dictionary @ dictionary[ind]`` of
+    the atoms ``ind`` which are actually selected. Instead of materialising
+    the full (n_dictionary, n_dictionary) matrix, rows are computed when
+    first needed and the ``max_rows`` most recently used ones are kept in a
+    LRU cache, which may be shared across samples and across calls to ``mp``
+    as long as the dictionary does not change.
+
+    Parameters
+    ----------
+    dictionary : array of shape (n_dictionary, n_pixels)
+
+    max_rows : int
+        Maximum number of rows kept in memory.
+
+    Attributes
+    ----------
+    diag : array of shape (n_dictionary,)
+        The diagonal of the Gram matrix (squared norms of the atoms).
+
+    hits, misses : int
+        Number of rows served from the cache and computed.
+
+    """
+    def __init__(self, dictionary, max_rows=1024):
+        from collections import OrderedDict
+        self.dictionary = dictionary
+        self.max_rows = max_rows
+        self.rows = OrderedDict()
+        self.diag = np.sum(dictionary**2, axis=1)
+        self.hits, self.misses = 0, 0
+
+    def __getitem__(self, ind):
+        row = self.rows.get(ind)
+        if row is None:
+            self.misses += 1
+            row = self.compute_row(ind)
+            self.rows[ind] = row
+            if len(self.rows) > self.max_rows:
+                self.rows.popitem(last=False)
+        else:
+            self.hits += 1
+            self.rows.move_to_end(ind)
+        return row
+
+    def compute_row(self, ind):
+        return self.dictionary @ self.dictionary[ind]
+
+def mp(X, dictionary, l0_sparseness=10, fit_tol=None, do_sym=True, P_cum=None, C=0., verbose=0,
+       gram_cache=None, atom_tree=None, corr=None):
     """
     Matching Pursuit
     cf. https://en.wikipedia.org/wiki/Matching_pursuit
@@ -184,12 +340,32 @@ def mp(X, dictionary, l0_sparseness=10, fit_tol=None, do_sym=True, P_cum=None, C
 
     fit_tol : criterium based on the residual error - not implemented yet
 
+    gram_cache : int or GramCache
+        By default, the full Gram matrix of the dictionary is computed. If an
+        int is given, rows of the Gram matrix are instead computed on demand
+        and at most this number of them are cached (see ``GramCache``), such
+        that the memory does not grow as ``n_dictionary**2``. An existing
+        ``GramCache`` of this dictionary may also be passed to reuse its rows,
+        or the full Gram matrix if it was already computed.
+
+    atom_tree : AtomTree
+        If given, the selection of atoms is approximated with this index of
+        the dictionary (see ``mp_tree``), such that the cost of each step
+        grows sublinearly with ``n_dictionary``.
+
+    corr : array of shape (n_samples, n_dictionary)
+        The correlations ``X @ dictionary.T``, if they were already computed
+        (e.g. for many dictionaries at once, see ``sparse_encode_multi``).
+
     Returns
     -------
     sparse_code : array of shape (n_samples, n_dictionary)
         The sparse code
 
     """
+    if not atom_tree is None:
+        return mp_tree(X, dictionary, atom_tree, l0_sparseness=l0_sparseness, do_sym=do_sym,
+                       P_cum=P_cum, C=C, verbose=verbose)
     # initialization
     if verbose>0:
         t0=time.time()
@@ -204,8 +380,17 @@ def mp(X, dictionary, l0_sparseness=10, fit_tol=None, do_sym=True, P_cum=None, C
     #if fit_tol is None: fit_tol = 0.
 
     # starting Matching Pursuit
-    corr = (X @ dictionary.T)
-    Xcorr = (dictionary @ dictionary.T)
+    if corr is None:
+        corr = (X @ dictionary.T)
+    if gram_cache is None:
+        Xcorr = (dictionary @ dictionary.T)
+        Xcorr_diag = np.diag(Xcorr)
+    elif isinstance(gram_cache, np.ndarray):
+        Xcorr, Xcorr_diag = gram_cache, np.diag(gram_cache)
+    else:
+        if not isinstance(gram_cache, GramCache):
+            gram_cache = GramCache(dictionary, max_rows=gram_cache)
+        Xcorr, Xcorr_diag = gram_cache, gram_cache.diag
     #SE_0 = np.sum(X*2, axis=1)
 
     if not P_cum is None:
@@ -230,12 +415,526 @@ def mp(X, dictionary, l0_sparseness=10, fit_tol=None, do_sym=True, P_cum=None, C
             else:
                 ind  = np.argmax(quantile(P_cum, rescaling(c, C=C, do_sym=do_sym), stick))
             #print(i_l0, ind, rescaling(c, C=C, do_sym=do_sym))
-            c_ind = c[ind] / Xcorr[ind, ind]
+            c_ind = c[ind] / Xcorr_diag[ind]
             sparse_code[i_sample, ind] += c_ind
-            c -= c_ind * Xcorr[ind, :]
+            c -= c_ind * Xcorr[ind]
             #SE -= c_ind**2 # pythagora
             #i_l0 += 1
     if verbose>0:
         duration=time.time()-t0
         print('coding duration : {0}'.format(duration))
     return sparse_code
+
+class AtomTree:
+    """Coarse-to-fine index of the atoms of a dictionary for approximate MP.
+
+    The atoms are grouped once into ``n_clusters`` clusters by a spherical
+    k-means on their (absolute, if ``do_sym``) cosine similarity. At each
+    step of Matching Pursuit, the residual is first correlated with the
+    centroids of the clusters, and only the atoms of the ``n_probe`` best
+    clusters are then examined to select the next atom. With
+    ``n_clusters ~ sqrt(n_dictionary)``, one step thus costs
+    ``O(sqrt(n_dictionary))`` dot products instead of ``O(n_dictionary)``.
+
+    The selection is approximate: the atom of maximal correlation may lie in
+    a cluster which was not probed. Increasing ``n_probe`` trades speed for
+    accuracy, ``n_probe=n_clusters`` being equivalent to an exact MP.
+
+    Parameters
+    ----------
+    dictionary : array of shape (n_dictionary, n_pixels)
+
+    n_clusters : int
+        Number of clusters, by default ``int(sqrt(n_dictionary))``.
+
+    n_probe : int
+        Number of clusters examined at each step.
+
+    do_sym : bool
+        Whether atoms are selected on the absolute value of their
+        correlation, in which case an atom and its opposite are clustered
+        together.
+
+    n_iter : int
+        Number of iterations of the k-means.
+
+    Attributes
+    ----------
+    centroids : array of shape (n_clusters, n_pixels)
+        Normalized centroids of the clusters.
+
+    members : array of shape (n_clusters, max_size)
+        Indices of the atoms of each cluster, padded with -1.
+
+    n_selections, n_mismatches : int
+        Number of atoms selected by ``mp_tree`` with ``check=True`` and
+        number of those which differ from the choice of an exact MP.
+
+    """
+    def __init__(self, dictionary, n_clusters=None, n_probe=2, do_sym=True, n_iter=10, seed=42):
+        n_dictionary, n_pixels = dictionary.shape
+        if n_clusters is None: n_clusters = max(1, int(np.sqrt(n_dictionary)))
+        n_clusters = min(n_clusters, n_dictionary)
+        self.dictionary = dictionary
+        self.n_probe = int(np.clip(n_probe, 1, n_clusters))
+        self.do_sym = do_sym
+        self.diag = np.sum(dictionary**2, axis=1)
+        self.n_selections, self.n_mismatches = 0, 0
+
+        rng = np.random.default_rng(seed)
+        atoms = dictionary / np.sqrt(self.diag)[:, np.newaxis]
+        centroids = atoms[rng.choice(n_dictionary, n_clusters, replace=False)]
+        for i_iter in range(n_iter):
+            labels, sign = self._assign(atoms, centroids)
+            new = np.zeros_like(centroids)
+            np.add.at(new, labels, sign[:, np.newaxis] * atoms)
+            norm = np.sqrt(np.sum(new**2, axis=1))
+            empty = norm == 0
+            # re-seeding empty clusters with random atoms
+            new[empty] = atoms[rng.choice(n_dictionary, empty.sum(), replace=False)]
+            norm[empty] = 1.
+            centroids = new / norm[:, np.newaxis]
+        labels, sign = self._assign(atoms, centroids)
+        self.centroids = centroids
+        self.labels = labels
+
+        sizes = np.bincount(labels, minlength=n_clusters)
+        self.members = -np.ones((n_clusters, sizes.max()), dtype=np.int64)
+        order = np.argsort(labels, kind='stable')
+        rank = np.arange(n_dictionary) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+        self.members[labels[order], rank] = order
+
+    def _assign(self, atoms, centroids):
+        sim = atoms @ centroids.T
+        labels = np.argmax(np.abs(sim) if self.do_sym else sim, axis=1)
+        if self.do_sym:
+            sign = np.sign(sim[np.arange(atoms.shape[0]), labels])
+            sign[sign == 0] = 1.
+        else:
+            sign = np.ones(atoms.shape[0])
+        return labels, sign
+
+    @property
+    def mismatch_rate(self):
+        """fraction of the checked selections which differ from exact MP"""
+        return self.n_mismatches / max(self.n_selections, 1)
+
+def mp_tree(X, dictionary, tree, l0_sparseness=10, do_sym=True, P_cum=None, C=0., n_probe=None,
+            check=False, chunk_size=None, verbose=0):
+    """
+    Approximate Matching Pursuit using an ``AtomTree`` to select the atoms.
+
+    All samples are processed at once: at each step, the residuals are
+    correlated with the centroids of the clusters of the tree, and each
+    cluster then correlates its atoms with the residuals of the samples which
+    probe it, as a single matrix product. The coefficient of the selected
+    atom is its exact correlation with the residual, as in ``mp``, and ties
+    are resolved in favor of the lowest index, as ``np.argmax`` does.
+
+    Parameters
+    ----------
+    X : array of shape (n_samples, n_pixels)
+        Data matrix.
+
+    dictionary : array of shape (n_dictionary, n_pixels)
+
+    tree : AtomTree
+        Index of this dictionary.
+
+    n_probe : int
+        Number of clusters examined at each step, by default ``tree.n_probe``
+        (clipped between 1 and the number of clusters).
+
+    check : bool
+        If True, also computes the choice of an exact MP at each step and
+        accumulates the number of differing selections in ``tree.n_mismatches``
+        (this costs as much as an exact MP).
+
+    chunk_size : int
+        Number of samples processed at once.
+
+    Returns
+    -------
+    sparse_code : array of shape (n_samples, n_dictionary)
+        The sparse code
+
+    """
+    if verbose>0:
+        t0=time.time()
+    if X.ndim == 1:
+        X = X[:, np.newaxis]
+    n_samples, n_pixels = X.shape
+    n_dictionary, n_pixels = dictionary.shape
+    if n_probe is None: n_probe = tree.n_probe
+    # at least one and at most all clusters are probed
+    n_probe = int(np.clip(n_probe, 1, len(tree.centroids)))
+    if chunk_size is None: chunk_size = 4096
+    if not P_cum is None:
+        nb_quant = P_cum.shape[1]
+        stick = np.arange(n_dictionary)*nb_quant
+        if C == 0.:
+            C = P_cum[-1, :]
+            P_cum = P_cum[:-1, :]
+
+    def criterion(c, ind):
+        if P_cum is None:
+            return np.abs(c) if do_sym else c
+        return quantile(P_cum, rescaling(c.copy(), C=C, do_sym=do_sym), stick[ind])
+
+    members = [m[m >= 0] for m in tree.members]
+    sparse_code = np.zeros((n_samples, n_dictionary))
+    for i_start in range(0, n_samples, chunk_size):
+        residual = np.array(X[i_start:i_start+chunk_size, :], dtype=float)
+        code = sparse_code[i_start:i_start+chunk_size, :]
+        n_chunk = residual.shape[0]
+        for i_l0 in range(int(l0_sparseness)):
+            score = residual @ tree.centroids.T
+            if do_sym: score = np.abs(score)
+            probe = np.argpartition(-score, n_probe-1, axis=1)[:, :n_probe]
+            best_crit = np.full(n_chunk, -np.inf)
+            best_ind = np.zeros(n_chunk, dtype=np.int64)
+            best_c = np.zeros(n_chunk)
+            for i_cluster in np.unique(probe):
+                rows = np.nonzero(np.any(probe == i_cluster, axis=1))[0]
+                ind = members[i_cluster]
+                c = residual[rows] @ dictionary[ind].T
+                crit = criterion(c, ind[np.newaxis, :])
+                j = np.argmax(crit, axis=1)
+                crit = crit[np.arange(rows.size), j]
+                better = (crit > best_crit[rows]) | ((crit == best_crit[rows]) & (ind[j] < best_ind[rows]))
+                rows, j = rows[better], j[better]
+                best_crit[rows], best_ind[rows], best_c[rows] = crit[better], ind[j], c[better, j]
+            if check:
+                full = residual @ dictionary.T
+                ind_exact = np.argmax(criterion(full, np.arange(n_dictionary)[np.newaxis, :]), axis=1)
+                tree.n_selections += n_chunk
+                tree.n_mismatches += np.count_nonzero(ind_exact != best_ind)
+            c_ind = best_c / tree.diag[best_ind]
+            code[np.arange(n_chunk), best_ind] += c_ind
+            residual -= c_ind[:, np.newaxis] * dictionary[best_ind]
+    if verbose>0:
+        duration=time.time()-t0
+        print('coding duration : {0}'.format(duration))
+        if check: print('mismatch rate with exact MP : {0:.4f}'.format(tree.mismatch_rate))
+    return sparse_code
+
+def reencode(X, dictionary, previous_code, l0_sparseness=10, do_sym=True, P_cum=None, C=0., tol=0.05,
+             previous_dictionary=None, gram_cache=None, chunk_size=None, return_changed=False, verbose=0):
+    """
+    Matching Pursuit warm-started from a previous code of the same data.
+
+    When the dictionary changed only slightly (e.g. after a round of
+    fine-tuning), the atoms selected by MP mostly stay the same. Each sample
+    is then first re-encoded by a MP restricted to the atoms of its previous
+    code: all samples are processed at once and each step only involves the
+    correlations of the residual with these few atoms. A full ``mp`` is run
+    only for the samples whose selection or residual changed too much:
+
+    - the first atom chosen by a full MP is not in the previous support, up
+      to a relative tolerance ``tol`` on the selection criterion,
+    - the residual energy exceeds ``(1 + tol)`` times that of the previous
+      code (with ``previous_dictionary``, by default the new one).
+
+    Parameters
+    ----------
+    X : array of shape (n_samples, n_pixels)
+        Data matrix.
+
+    dictionary : array of shape (n_dictionary, n_pixels)
+        The new dictionary.
+
+    previous_code : array of shape (n_samples, n_dictionary)
+        The code of ``X`` with the previous dictionary.
+
+    tol : float
+        Relative tolerance of both tests. With ``tol=0``, a sample keeps its
+        restricted code only if the full MP starts with an atom of its support
+        and if its residual did not increase. The fraction of samples which
+        fall back to a full MP grows quickly with the change of the
+        dictionary relative to ``tol``: on random data, a perturbation of the
+        atoms of 1e-3 keeps all warm starts while one of 3e-2 sends a few to
+        tens of percent of the samples to the full MP, and with natural
+        images (small residuals, ``P_cum``) most samples may fall back
+        already at 1e-2. A larger ``tol`` keeps more warm starts at the cost
+        of codes further from those of a full MP; check the fraction with
+        ``return_changed`` (or ``verbose``) to tell whether the warm start
+        pays off.
+
+    gram_cache : int, GramCache or array
+        As in ``mp``, for the samples which changed. The full Gram matrix
+        (computed by default) also gives the Gram matrices of the supports.
+
+    return_changed : bool
+        If True, also returns the boolean mask of the samples which were
+        re-encoded with a full MP.
+
+    Returns
+    -------
+    sparse_code : array of shape (n_samples, n_dictionary)
+        The sparse code
+
+    changed : array of shape (n_samples,)
+        Only with ``return_changed``, True for the samples which fell back to
+        a full MP.
+
+    """
+    if verbose>0:
+        t0=time.time()
+    if X.ndim == 1:
+        X = X[:, np.newaxis]
+    n_samples, n_pixels = X.shape
+    n_dictionary, n_pixels = dictionary.shape
+    if chunk_size is None: chunk_size = 4096
+    P_cum_, C_ = P_cum, C
+    if not P_cum is None:
+        nb_quant = P_cum.shape[1]
+        stick = np.arange(n_dictionary)*nb_quant
+        if C == 0.:
+            C = P_cum[-1, :]
+            P_cum = P_cum[:-1, :]
+
+    def criterion(c, ind):
+        if P_cum is None:
+            return np.abs(c) if do_sym else c
+        return quantile(P_cum, rescaling(c.copy(), C=C, do_sym=do_sym), stick[ind])
+
+    if gram_cache is None:
+        gram_cache = dictionary @ dictionary.T
+    if isinstance(gram_cache, np.ndarray):
+        Xcorr, diag = gram_cache, np.diag(gram_cache)
+    else:
+        if not isinstance(gram_cache, GramCache):
+            gram_cache = GramCache(dictionary, max_rows=gram_cache)
+        Xcorr, diag = None, gram_cache.diag
+    sparse_code = np.zeros((n_samples, n_dictionary))
+    changed = np.zeros(n_samples, dtype=bool)
+    for i_start in range(0, n_samples, chunk_size):
+        X_ = np.asarray(X[i_start:i_start+chunk_size, :], dtype=float)
+        previous = np.asarray(previous_code[i_start:i_start+chunk_size, :])
+        code = sparse_code[i_start:i_start+chunk_size, :]
+        n_chunk = X_.shape[0]
+        rows = np.arange(n_chunk)
+        corr = X_ @ dictionary.T
+        # the previous supports, in increasing order of the atoms and padded
+        # with -1 to the size of the largest one
+        support = previous != 0
+        n_support = support.sum(axis=1)
+        width = max(int(n_support.max()) if n_chunk > 0 else 0, 1)
+        ind = np.full((n_chunk, width), -1, dtype=np.int64)
+        ind[np.arange(width)[np.newaxis, :] < n_support[:, np.newaxis]] = np.nonzero(support)[1]
+        valid = ind >= 0
+        ind_ = np.where(valid, ind, 0)
+        # selection test on the first step
+        crit_full = criterion(corr, np.arange(n_dictionary)[np.newaxis, :]).max(axis=1)
+        corr_support = corr[rows[:, np.newaxis], ind_]
+        c = corr_support.copy()
+        crit = np.where(valid, criterion(c, ind_), -np.inf)
+        crit_support = crit.max(axis=1)
+        changed_ = (n_support == 0) | (crit_full > crit_support + tol * np.abs(crit_support))
+        # MP restricted to the supports, with the Gram matrix of each support
+        if Xcorr is None:
+            atoms = dictionary[ind_]
+            gram = atoms @ atoms.transpose(0, 2, 1)
+        else:
+            gram = Xcorr[ind_[:, :, np.newaxis], ind_[:, np.newaxis, :]]
+        coeffs = np.zeros((n_chunk, width))
+        for i_l0 in range(int(l0_sparseness)):
+            j = np.argmax(crit, axis=1)
+            c_ind = np.where(valid[rows, j], c[rows, j] / diag[ind_[rows, j]], 0.)
+            coeffs[rows, j] += c_ind
+            c -= c_ind[:, np.newaxis] * gram[rows, j, :]
+            crit = np.where(valid, criterion(c, ind_), -np.inf)
+        code[np.nonzero(valid)[0], ind[valid]] = coeffs[valid]
+        # residual test, the energies being expanded on the supports as
+        # |x|**2 - 2 a.corr + a.gram.a
+        energy = np.sum(X_**2, axis=1)
+        error = energy - 2 * np.sum(coeffs * corr_support, axis=1) + np.einsum('nk,nkl,nl->n', coeffs, gram, coeffs)
+        if previous_dictionary is None:
+            coeffs = np.where(valid, previous[rows[:, np.newaxis], ind_], 0.)
+            error_previous = energy - 2 * np.sum(coeffs * corr_support, axis=1) + np.einsum('nk,nkl,nl->n', coeffs, gram, coeffs)
+        else:
+            error_previous = np.sum((X_ - previous @ previous_dictionary)**2, axis=1)
+        changed_ |= (error > (1 + tol) * error_previous) & ~np.isclose(error, error_previous, atol=1e-10)
+        if changed_.any():
+            code[changed_, :] = mp(X_[changed_], dictionary, l0_sparseness=l0_sparseness, do_sym=do_sym,
+                                   P_cum=P_cum_, C=C_, gram_cache=gram_cache, corr=corr[changed_])
+        changed[i_start:i_start+n_chunk] = changed_
+    if verbose>0:
+        duration=time.time()-t0
+        print('coding duration : {0} ({1:.1%} of samples fully re-encoded)'.format(duration, changed.mean()))
+    if return_changed:
+        return sparse_code, changed
+    return sparse_code
+
+def get_filters(dictionary):
+    """
+    Reshapes the atoms of a dictionary of square patches as 2D filters of
+    shape (n_dictionary, patch_size, patch_size).
+
+    """
+    n_dictionary, n_pixels = dictionary.shape
+    patch_size = int(np.sqrt(n_pixels))
+    if not patch_size**2 == n_pixels:
+        raise ValueError('atoms of {} pixels are not square patches'.format(n_pixels))
+    return dictionary.reshape((n_dictionary, patch_size, patch_size))
+
+class ConvGramCache(GramCache):
+    """Cross-correlations of the filters of a dictionary, computed on demand.
+
+    In convolutional MP, selecting atom ``ind`` at some position changes the
+    correlation map of every atom ``j`` in a neighbourhood of this position
+    by the cross-correlation ``row[j, dy, dx] = sum_{u,v} f_j[u, v] f_ind[u+dy, v+dx]``
+    of the two filters, for shifts ``|dy|, |dx| < patch_size``. These rows of
+    shape (n_dictionary, 2*patch_size-1, 2*patch_size-1) are kept in a LRU
+    cache as in ``GramCache``.
+
+    """
+    def __init__(self, dictionary, max_rows=1024):
+        GramCache.__init__(self, dictionary, max_rows=max_rows)
+        self.filters = get_filters(dictionary)
+
+    def compute_row(self, ind):
+        patch_size = self.filters.shape[1]
+        padded = np.pad(self.filters[ind], patch_size-1)
+        windows = np.lib.stride_tricks.sliding_window_view(padded, (patch_size, patch_size))
+        return np.einsum('juv,abuv->jab', self.filters, windows)
+
+def conv_correlate(image, dictionary, n_block=64):
+    """
+    Correlations of all atoms of a dictionary with all (valid) positions of
+    an image, computed with FFTs by blocks of ``n_block`` atoms.
+
+    Returns
+    -------
+    corr : array of shape (n_dictionary, height-patch_size+1, width-patch_size+1)
+        ``corr[j, y, x]`` is the dot product of atom ``j`` with the patch of
+        the image whose top-left corner is ``(y, x)``.
+
+    """
+    filters = get_filters(dictionary)
+    n_dictionary, patch_size, patch_size = filters.shape
+    height, width = image.shape
+    F_image = np.fft.rfft2(image)
+    corr = np.empty((n_dictionary, height-patch_size+1, width-patch_size+1))
+    for i_start in range(0, n_dictionary, n_block):
+        F_filters = np.fft.rfft2(filters[i_start:i_start+n_block], s=(height, width))
+        # circular cross-correlation, which does not wrap on valid positions
+        block = np.fft.irfft2(F_image * F_filters.conj(), s=(height, width))
+        corr[i_start:i_start+n_block] = block[:, :height-patch_size+1, :width-patch_size+1]
+    return corr
+
+def conv_decode(sparse_code, dictionary):
+    """
+    Reconstructs the image from its convolutional sparse code, that is, adds
+    each atom with its coefficient at the position of its top-left corner.
+
+    Parameters
+    ----------
+    sparse_code : array of shape (n_dictionary, n_y, n_x)
+        As returned by ``conv_mp``.
+
+    dictionary : array of shape (n_dictionary, n_pixels)
+
+    Returns
+    -------
+    image : array of shape (n_y+patch_size-1, n_x+patch_size-1)
+
+    """
+    filters = get_filters(dictionary)
+    patch_size = filters.shape[1]
+    shape = (sparse_code.shape[1]+patch_size-1, sparse_code.shape[2]+patch_size-1)
+    F_image = np.zeros((shape[0], shape[1]//2+1), dtype=complex)
+    ind_atom = np.nonzero(np.any(sparse_code != 0, axis=(1, 2)))[0]
+    for ind in ind_atom:
+        F_image += np.fft.rfft2(sparse_code[ind], s=shape) * np.fft.rfft2(filters[ind], s=shape)
+    return np.fft.irfft2(F_image, s=shape)
+
+def conv_mp(image, dictionary, l0_sparseness=100, fit_tol=None, do_sym=True, P_cum=None, C=0.,
+            gram_cache=1024, verbose=0):
+    """
+    Convolutional Matching Pursuit on a whole (whitened) image
+
+    The atoms of the dictionary are used as filters which may be placed at any
+    position of the image. The correlations of all atoms with all positions
+    are computed once with FFTs (see ``conv_correlate``), and after each
+    selection only the neighbourhood of the selected position is updated,
+    using the cross-correlations of the filters (see ``ConvGramCache``). The
+    best criterion over atoms is kept for each position, such that each step
+    only costs ``O(n_dictionary * patch_size**2)`` operations plus a search
+    over the positions, instead of a new MP for every patch of the image.
+
+    Parameters
+    ----------
+    image : array of shape (height, width)
+        The image, preprocessed as the patches which the dictionary was
+        learned on (e.g. whitened).
+
+    dictionary : array of shape (n_dictionary, n_pixels)
+        Atoms of square patches.
+
+    l0_sparseness : int
+        Total number of atoms selected in the image.
+
+    fit_tol : float
+        If given, stops earlier when the energy of the residual falls below
+        this fraction of the energy of the image.
+
+    P_cum : array of shape (n_dictionary+1, nb_quant)
+        Homeostatic selection, as in ``mp``.
+
+    gram_cache : int or ConvGramCache
+        Maximum number of cross-correlation rows kept in memory, or an
+        existing cache of this dictionary.
+
+    Returns
+    -------
+    sparse_code : array of shape (n_dictionary, height-patch_size+1, width-patch_size+1)
+        The coefficient of each atom at each position of its top-left corner.
+
+    """
+    if verbose>0:
+        t0=time.time()
+    n_dictionary, n_pixels = dictionary.shape
+    if not isinstance(gram_cache, ConvGramCache):
+        gram_cache = ConvGramCache(dictionary, max_rows=gram_cache)
+    patch_size = gram_cache.filters.shape[1]
+    if not P_cum is None:
+        nb_quant = P_cum.shape[1]
+        stick = (np.arange(n_dictionary)*nb_quant)[:, np.newaxis, np.newaxis]
+        if C == 0.:
+            C = P_cum[-1, :]
+            P_cum = P_cum[:-1, :]
+
+    def criterion(c, ind):
+        if P_cum is None:
+            return np.abs(c) if do_sym else c
+        return quantile(P_cum, rescaling(c.copy(), C=C, do_sym=do_sym), stick[ind])
+
+    corr = conv_correlate(image, dictionary)
+    n_y, n_x = corr.shape[1:]
+    sparse_code = np.zeros_like(corr)
+    crit = criterion(corr, slice(None))
+    best_ind = np.argmax(crit, axis=0)
+    best = np.take_along_axis(crit, best_ind[np.newaxis], axis=0)[0]
+    SE_0 = np.sum(image**2)
+    SE = SE_0
+    for i_l0 in range(int(l0_sparseness)):
+        pos = np.argmax(best)
+        y, x = pos // n_x, pos % n_x
+        ind = best_ind[y, x]
+        c_ind = corr[ind, y, x] / gram_cache.diag[ind]
+        sparse_code[ind, y, x] += c_ind
+        SE -= c_ind * corr[ind, y, x]
+        # local update of the correlations in the neighbourhood of (y, x)
+        y0, y1 = max(y-patch_size+1, 0), min(y+patch_size, n_y)
+        x0, x1 = max(x-patch_size+1, 0), min(x+patch_size, n_x)
+        row = gram_cache[ind][:, y0-y+patch_size-1:y1-y+patch_size-1, x0-x+patch_size-1:x1-x+patch_size-1]
+        corr[:, y0:y1, x0:x1] -= c_ind * row
+        crit = criterion(corr[:, y0:y1, x0:x1], slice(None))
+        best_ind[y0:y1, x0:x1] = np.argmax(crit, axis=0)
+        best[y0:y1, x0:x1] = np.take_along_axis(crit, best_ind[np.newaxis, y0:y1, x0:x1], axis=0)[0]
+        if not fit_tol is None and SE < fit_tol * SE_0: break
+    if verbose>0:
+        duration=time.time()-t0
+        print('coding duration : {0}, relative residual energy : {1:.4f}'.format(duration, SE/SE_0))
+    return sparse_code
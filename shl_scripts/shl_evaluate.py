@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*
+from __future__ import division, print_function, absolute_import
+"""
+Evaluation of a dictionary in one streaming pass.
+
+The data is encoded once, chunk by chunk, and all statistics (residual
+energy, per-atom variance, selection counts, kurtosis, relative entropy, ...)
+are accumulated along the way, such that the metrics of ``shl_tools`` and the
+plotting helpers do not need to encode the data again.
+
+"""
+import numpy as np
+
+class MomentAccumulator:
+    """Mergeable online estimate of the first four moments of each atom.
+
+    The count, mean and the centered sums of powers ``M2``, ``M3`` and
+    ``M4`` of the coefficients of each atom are updated batch by batch with
+    the pairwise formulas of Chan et al. and Pébay (a generalization of
+    Welford's algorithm), such that accumulators computed on different
+    shards of data merge exactly and remain numerically stable. The number
+    of times each atom was selected (non-zero coefficient) is also counted.
+
+    Parameters
+    ----------
+    n_dictionary : int
+        Number of atoms.
+
+    """
+    def __init__(self, n_dictionary):
+        self.n_dictionary = n_dictionary
+        self.n_samples = 0
+        self.mean = np.zeros(n_dictionary)
+        self.M2 = np.zeros(n_dictionary)
+        self.M3 = np.zeros(n_dictionary)
+        self.M4 = np.zeros(n_dictionary)
+        self.counts = np.zeros(n_dictionary, dtype=np.int64)
+
+    def update(self, sparse_code):
+        """
+        Accumulates a batch of sparse codes of shape (n_samples, n_dictionary).
+
+        """
+        other = MomentAccumulator(self.n_dictionary)
+        other.n_samples = sparse_code.shape[0]
+        if other.n_samples == 0: return self
+        other.mean = sparse_code.mean(axis=0)
+        centered = sparse_code - other.mean
+        power = centered**2
+        other.M2 = power.sum(axis=0)
+        power *= centered
+        other.M3 = power.sum(axis=0)
+        power *= centered
+        other.M4 = power.sum(axis=0)
+        other.counts = np.count_nonzero(sparse_code, axis=0)
+        return self.merge(other)
+
+    def merge(self, other):
+        """
+        Merges in place the statistics of another accumulator.
+
+        """
+        n_a, n_b = self.n_samples, other.n_samples
+        n = n_a + n_b
+        if n_b == 0: return self
+        delta = other.mean - self.mean
+        M2 = self.M2 + other.M2 + delta**2 * n_a * n_b / n
+        M3 = (self.M3 + other.M3 + delta**3 * n_a * n_b * (n_a - n_b) / n**2
+              + 3 * delta * (n_a * other.M2 - n_b * self.M2) / n)
+        M4 = (self.M4 + other.M4 + delta**4 * n_a * n_b * (n_a**2 - n_a * n_b + n_b**2) / n**3
+              + 6 * delta**2 * (n_a**2 * other.M2 + n_b**2 * self.M2) / n**2
+              + 4 * delta * (n_a * other.M3 - n_b * self.M3) / n)
+        self.mean = self.mean + delta * n_b / n
+        self.M2, self.M3, self.M4 = M2, M3, M4
+        self.n_samples = n
+        self.counts = self.counts + other.counts
+        return self
+
+    @property
+    def var(self):
+        return self.M2 / self.n_samples
+
+    @property
+    def energy(self):
+        """mean energy of the coefficients, i.e. ``np.mean(sparse_code**2, axis=0)``"""
+        return self.var + self.mean**2
+
+    @property
+    def kurtosis(self):
+        """(Fisher) kurtosis, as ``scipy.stats.kurtosis(sparse_code, axis=0)``"""
+        return self.n_samples * self.M4 / self.M2**2 - 3.
+
+    @property
+    def prob_active(self):
+        return self.counts / self.n_samples
+
+    @property
+    def entropy(self):
+        """entropy of the probability of selection relative to its maximum"""
+        p = self.counts / self.counts.sum()
+        p = p[p > 0]
+        return np.sum(-p * np.log(p)) / np.log(self.n_dictionary)
+
+class Evaluation:
+    """Statistics of the sparse coding of a dataset by a dictionary.
+
+    Parameters
+    ----------
+    n_dictionary : int
+        Number of atoms of the dictionary.
+
+    nb_bins : int
+        Number of bins of the histograms of the absolute value of the
+        non-zero coefficients of each atom.
+
+    coeff_max : float
+        Upper bound of these histograms. By default it is set to twice the
+        largest coefficient of the first chunk; larger coefficients are
+        counted in the last bin.
+
+    Attributes
+    ----------
+    n_samples : int
+        number of samples accumulated so far
+
+    moments : MomentAccumulator
+        moments of the coefficients of each atom
+
+    counts : array of shape (n_dictionary,)
+        number of times each atom was selected
+
+    hist : array of shape (n_dictionary, nb_bins)
+        histograms of the absolute value of the non-zero coefficients
+
+    """
+    def __init__(self, n_dictionary, nb_bins=64, coeff_max=None):
+        self.n_dictionary = n_dictionary
+        self.nb_bins = nb_bins
+        self.coeff_max = coeff_max
+        self.n_samples = 0
+        self.residual_energy = 0.
+        self.data_energy = 0.
+        self.sum_mse = 0.
+        self.moments = MomentAccumulator(n_dictionary)
+        self.hist = np.zeros((n_dictionary, nb_bins), dtype=np.int64)
+
+    def update(self, data, sparse_code, dictionary):
+        """
+        Accumulates the statistics of one chunk of data and of its sparse code.
+
+        """
+        residual = data - sparse_code @ dictionary
+        SE = np.sum(residual**2, axis=1)
+        self.n_samples += data.shape[0]
+        self.residual_energy += SE.sum()
+        self.data_energy += np.sum(data**2)
+        self.sum_mse += np.sum(SE / np.sqrt(np.sum(data**2, axis=1)))
+
+        self.moments.update(sparse_code)
+
+        ind_sample, ind_atom = np.nonzero(sparse_code)
+        coeffs = np.abs(sparse_code[ind_sample, ind_atom])
+        if self.coeff_max is None:
+            self.coeff_max = 2 * coeffs.max() if coeffs.size > 0 else 1.
+        bins = np.minimum((coeffs / self.coeff_max * self.nb_bins).astype(np.int64), self.nb_bins - 1)
+        self.hist += np.bincount(ind_atom * self.nb_bins + bins,
+                                 minlength=self.n_dictionary * self.nb_bins).reshape(self.hist.shape)
+        return self
+
+    def merge(self, other):
+        """
+        Merges in place the evaluation of another shard of the data.
+
+        """
+        if self.coeff_max is None:
+            self.coeff_max = other.coeff_max
+        elif not other.coeff_max is None and not other.coeff_max == self.coeff_max:
+            raise ValueError('cannot merge evaluations with different histogram bins')
+        self.n_samples += other.n_samples
+        self.residual_energy += other.residual_energy
+        self.data_energy += other.data_energy
+        self.sum_mse += other.sum_mse
+        self.moments.merge(other.moments)
+        self.hist += other.hist
+        return self
+
+    @property
+    def counts(self):
+        return self.moments.counts
+
+    @property
+    def bins(self):
+        """edges of the bins of ``hist``"""
+        return np.linspace(0, self.coeff_max, self.nb_bins + 1)
+
+    @property
+    def rmse(self):
+        """same as ``shl_tools.compute_RMSE``"""
+        return np.sqrt(self.sum_mse / self.n_samples)
+
+    @property
+    def relative_error(self):
+        """energy of the residual relative to the energy of the data"""
+        return self.residual_energy / self.data_energy
+
+    @property
+    def mean(self):
+        return self.moments.mean
+
+    @property
+    def variance(self):
+        """mean energy of the coefficients of each atom, i.e. ``np.mean(sparse_code**2, axis=0)``"""
+        return self.moments.energy
+
+    @property
+    def prob_active(self):
+        return self.moments.prob_active
+
+    @property
+    def kurtosis(self):
+        """(Fisher) kurtosis of the coefficients of each atom, as ``scipy.stats.kurtosis(sparse_code, axis=0)``"""
+        return self.moments.kurtosis
+
+    @property
+    def entropy(self):
+        return self.moments.entropy
+
+    @property
+    def KL(self):
+        """same as ``shl_tools.compute_KL``"""
+        P_norm = self.variance
+        N = self.n_dictionary
+        mom1 = np.sum(P_norm) / N
+        mom2 = np.sum((P_norm-mom1)**2) / (N-1)
+        return 1/N * np.sum((P_norm-mom1)**2 / mom2**2)
+
+    @property
+    def kurto(self):
+        """same as ``shl_tools.compute_kurto``"""
+        P_norm = self.variance
+        P_norm = P_norm - P_norm.mean()
+        return np.mean(P_norm**4) / np.mean(P_norm**2)**2 - 3.
+
+def evaluate(data, dico, chunk_size=None, algorithm=None, l0_sparseness=None, nb_bins=64,
+             coeff_max=None, verbose=0, n_jobs=None, backend=None):
+    """
+    Encodes the data with a dictionary in chunks and accumulates all
+    statistics in one pass.
+
+    Parameters
+    ----------
+    data : array of shape (n_samples, n_pixels)
+        Data matrix (may be a memmap).
+
+    dico : SparseHebbianLearning
+        A learned dictionary.
+
+    chunk_size : int
+        Number of samples encoded at once. By default, 1024 or, if a memory
+        budget is set (see ``shl_memory.set_memory_budget``), as many as the
+        budget allows.
+
+    n_jobs, backend :
+        If given, the chunks are split into shards evaluated in parallel (see
+        ``shl_backend``, by default a pool of processes) and their
+        evaluations are merged.
+
+    Returns
+    -------
+    evaluation : Evaluation
+
+    """
+    evaluation = Evaluation(dico.dictionary.shape[0], nb_bins=nb_bins, coeff_max=coeff_max)
+    if chunk_size is None:
+        from shl_scripts.shl_memory import get_chunk_size, estimate_evaluate
+        n_dictionary, n_pixels = dico.dictionary.shape
+        chunk_size = get_chunk_size(lambda n: estimate_evaluate(n, n_dictionary, n_pixels, nb_bins=nb_bins),
+                                    data.shape[0], default=1024)
+    i_starts = list(range(0, data.shape[0], chunk_size))
+    if not (n_jobs is None and backend is None) and len(i_starts) > 2:
+        from shl_scripts.shl_backend import get_backend, split_cores
+        backend = get_backend(backend, n_jobs=n_jobs, default='processes', verbose=verbose)
+        # the first chunk sets the bins of the histograms shared by all shards
+        evaluation = evaluate(data[:chunk_size], dico, chunk_size=chunk_size, algorithm=algorithm,
+                              l0_sparseness=l0_sparseness, nb_bins=nb_bins, coeff_max=coeff_max)
+        n_shards = split_cores(backend.n_jobs, n_tasks=len(i_starts) - 1)[0]
+        shards = [(shard[0], shard[-1] + chunk_size) for shard in np.array_split(i_starts[1:], n_shards)]
+        n = len(shards)
+        for shard in backend.imap(evaluate, [data[i_start:i_end] for i_start, i_end in shards], [dico]*n,
+                                  [chunk_size]*n, [algorithm]*n, [l0_sparseness]*n, [nb_bins]*n,
+                                  [evaluation.coeff_max]*n):
+            evaluation.merge(shard)
+            if verbose: print('Evaluated {}/{} samples'.format(evaluation.n_samples, data.shape[0]))
+        return evaluation
+    for i_start in i_starts:
+        chunk = np.asarray(data[i_start:i_start+chunk_size, :])
+        sparse_code = dico.transform(chunk, algorithm=algorithm, l0_sparseness=l0_sparseness)
+        evaluation.update(chunk, sparse_code, dico.dictionary)
+        if verbose: print('Evaluated {}/{} samples'.format(evaluation.n_samples, data.shape[0]))
+    return evaluation
+
+def evaluate_many(data, dicos, chunk_size=None, l0_sparseness=None, nb_bins=64, coeff_max=None, verbose=0):
+    """
+    Evaluates many dictionaries on the same data in one pass.
+
+    Each chunk of data is read once and encoded by all dictionaries with
+    ``shl_encode.sparse_encode_multi`` (one matrix product for the
+    correlations with all atoms, and the rows of the Gram matrix of each
+    dictionary reused across chunks), each with its own ``P_cum``, ``C`` and
+    ``do_sym``. Dictionaries not learned with ``'mp'`` are encoded with their
+    own ``transform``.
+
+    Parameters
+    ----------
+    data : array of shape (n_samples, n_pixels)
+        Data matrix (may be a memmap).
+
+    dicos : list or dict of SparseHebbianLearning
+        Learned dictionaries, e.g. as returned by ``SHL.learn_dico`` for
+        every point of a sweep.
+
+    chunk_size : int
+        Number of samples read at once, by default 1024 or as many as the
+        memory budget allows for all dictionaries together.
+
+    l0_sparseness : int
+        By default, that of each dictionary.
+
+    Returns
+    -------
+    evaluations : list or dict of Evaluation
+        With the same keys as ``dicos``.
+
+    """
+    from shl_scripts.shl_encode import sparse_encode_multi, GramCache
+    keys = list(dicos.keys()) if isinstance(dicos, dict) else range(len(dicos))
+    dicos_ = [dicos[key] for key in keys]
+    evaluations = [Evaluation(dico.dictionary.shape[0], nb_bins=nb_bins, coeff_max=coeff_max) for dico in dicos_]
+    is_mp = [dico.fit_algorithm == 'mp' for dico in dicos_]
+    multi = [dico for dico, mp_ in zip(dicos_, is_mp) if mp_]
+    gram_caches = [GramCache(dico.dictionary, max_rows=dico.dictionary.shape[0]) for dico in multi]
+    l0 = [dico.l0_sparseness if l0_sparseness is None else l0_sparseness for dico in multi]
+    if chunk_size is None:
+        from shl_scripts.shl_memory import get_chunk_size, estimate_evaluate
+        chunk_size = get_chunk_size(lambda n: sum(estimate_evaluate(n, *dico.dictionary.shape, nb_bins=nb_bins)
+                                                  for dico in dicos_), data.shape[0], default=1024)
+    for i_start in range(0, data.shape[0], chunk_size):
+        chunk = np.asarray(data[i_start:i_start+chunk_size, :])
+        sparse_codes = iter(sparse_encode_multi(chunk, [dico.dictionary for dico in multi],
+                                                P_cums=[dico.P_cum for dico in multi],
+                                                C=[dico.C for dico in multi], do_sym=[dico.do_sym for dico in multi],
+                                                l0_sparseness=l0, gram_caches=gram_caches))
+        for dico, mp_, evaluation in zip(dicos_, is_mp, evaluations):
+            if mp_:
+                sparse_code = next(sparse_codes)
+            else:
+                sparse_code = dico.transform(chunk, l0_sparseness=l0_sparseness)
+            evaluation.update(chunk, sparse_code, dico.dictionary)
+        if verbose: print('Evaluated {}/{} samples with {} dictionaries'.format(
+                          evaluations[0].n_samples, data.shape[0], len(dicos_)))
+    if isinstance(dicos, dict):
+        return dict(zip(keys, evaluations))
+    return evaluations
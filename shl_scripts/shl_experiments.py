@@ -44,15 +44,12 @@ toolbar_width = 40
 # import matplotlib
 
 import numpy as np
-# see https://github.com/bicv/SLIP/blob/master/SLIP.ipynb
-from SLIP import Image
+# SLIP (see https://github.com/bicv/SLIP/blob/master/SLIP.ipynb) is only
+# imported by get_data when images are actually loaded
 
 import warnings
 warnings.simplefilter('ignore', category=RuntimeWarning)
 
-import os
-home = os.environ['HOME']
-
 class SHL(object):
     """
 
@@ -79,10 +76,16 @@ class SHL(object):
                  max_patches=4096,
                  batch_size=128,
                  record_each=128,
+                 record_online=False,
+                 homeo_every=1,
+                 eta_schedule='constant',
+                 eta_homeo_schedule='constant',
+                 optimizer='sgd',
+                 snapshot_each=0,
                  n_image=200,
                  DEBUG_DOWNSCALE=1, # set to 10 to perform a rapid experiment
                  verbose=0,
-                 data_cache=os.path.join(home, 'tmp/data_cache'),
+                 data_cache=os.path.join(os.path.expanduser('~'), 'tmp/data_cache'),
                  ):
         self.height = height
         self.width = width
@@ -105,6 +108,12 @@ class SHL(object):
         self.do_sym = do_sym
 
         self.record_each = int(record_each/DEBUG_DOWNSCALE)
+        self.record_online = record_online
+        self.homeo_every = homeo_every
+        self.eta_schedule = eta_schedule
+        self.eta_homeo_schedule = eta_homeo_schedule
+        self.optimizer = optimizer
+        self.snapshot_each = snapshot_each
         self.verbose = verbose
         # assigning and create a folder for caching data
         self.data_cache = data_cache
@@ -165,17 +174,82 @@ class SHL(object):
 
         return sparse_code
 
+    def reencode(self, data, dico, sparse_code, previous_dico=None, l0_sparseness=None, tol=0.05,
+                 return_changed=False):
+        """
+        Codes the data with a fine-tuned dictionary, starting from their code
+        ``sparse_code`` with a previous dictionary ``previous_dico`` (e.g.
+        before a warm restart of ``learn_dico``), see ``shl_encode.reencode``.
+        Only the samples whose selection or residual changed beyond ``tol``
+        are coded again from scratch; with ``return_changed``, their mask is
+        also returned (all True if the algorithm is not MP) to tell how much
+        of the warm start was used.
+
+        """
+        if l0_sparseness is None:
+            l0_sparseness = self.l0_sparseness
+        if not self.learning_algorithm == 'mp':
+            sparse_code = self.code(data, dico, l0_sparseness=l0_sparseness)
+            if return_changed:
+                return sparse_code, np.ones(sparse_code.shape[0], dtype=bool)
+            return sparse_code
+        if self.verbose:
+            print('Re-encoding data', end=' ')
+            t0 = time.time()
+        from shl_scripts.shl_encode import reencode
+        sparse_code, changed = reencode(data, dico.dictionary, sparse_code, l0_sparseness=l0_sparseness,
+                                        C=self.C, P_cum=dico.P_cum, do_sym=self.do_sym, tol=tol,
+                                        previous_dictionary=None if previous_dico is None else previous_dico.dictionary,
+                                        return_changed=True)
+        if self.verbose:
+            dt = time.time() - t0
+            print('done in %.2fs (%.1f%% of samples coded again).' % (dt, 100 * changed.mean()))
+        if return_changed:
+            return sparse_code, changed
+        return sparse_code
+
     def decode(self, sparse_code, dico):
         return sparse_code @ dico.dictionary
 
+    def evaluate(self, data, dico, chunk_size=None, l0_sparseness=None):
+        """
+        Encodes the data once (in chunks) and returns all statistics of the
+        coding as an ``shl_evaluate.Evaluation``.
+
+        """
+        from shl_scripts.shl_evaluate import evaluate
+        if l0_sparseness is None:
+            l0_sparseness = self.l0_sparseness
+        return evaluate(data, dico, chunk_size=chunk_size, l0_sparseness=l0_sparseness, verbose=self.verbose)
+
+    def evaluate_many(self, data, dicos, chunk_size=None, l0_sparseness=None):
+        """
+        Evaluates many dictionaries (a list or a dict, e.g. indexed by
+        ``matname``) on the same data in one pass, see
+        ``shl_evaluate.evaluate_many``.
+
+        """
+        from shl_scripts.shl_evaluate import evaluate_many
+        if l0_sparseness is None:
+            l0_sparseness = self.l0_sparseness
+        return evaluate_many(data, dicos, chunk_size=chunk_size, l0_sparseness=l0_sparseness, verbose=self.verbose)
+
+    def get_trajectory(self, matname, trajectory=None):
+        """
+        The store of the snapshots of the learning (if ``snapshot_each`` is
+        set), by default next to the cached dictionary of ``matname``.
+
+        """
+        if self.snapshot_each > 0 and trajectory is None:
+            from shl_scripts.shl_trajectory import TrajectoryStore
+            trajectory = TrajectoryStore(os.path.join(self.data_cache, matname) + '_trajectory', mode='w')
+        return trajectory
+
     def learn_dico(self, dictionary=None, P_cum=None, data=None, name_database='serre07_distractors',
-                   matname=None, record_each=None, folder_exp=None, list_figures=[], fname=None):
+                   matname=None, record_each=None, folder_exp=None, list_figures=[], fname=None,
+                   trajectory=None):
 
-        if data is None: data = self.get_data(name_database, height=self.height,
-                            width=self.width, n_image=self.n_image,
-                            patch_size=self.patch_size, datapath=self.datapath,
-                            max_patches=self.max_patches, verbose=self.verbose,
-                            data_cache=self.data_cache, matname=matname)
+        if data is None: data = self.get_data(name_database, matname=matname)
 
         if matname is None:
             # Learn the dictionary from reference patches
@@ -189,7 +263,12 @@ class SHL(object):
                                          l0_sparseness=self.l0_sparseness,
                                          batch_size=self.batch_size, verbose=self.verbose,
                                          fit_tol=self.fit_tol,
-                                         record_each=self.record_each)
+                                         record_each=self.record_each, record_online=self.record_online,
+                                         homeo_every=self.homeo_every, eta_schedule=self.eta_schedule,
+                                         eta_homeo_schedule=self.eta_homeo_schedule,
+                                         optimizer=self.optimizer,
+                                         trajectory=trajectory,
+                                         snapshot_each=0 if trajectory is None else self.snapshot_each)
             if self.verbose: print('Training on %d patches' % len(data), end='... ')
             dico.fit(data)
 
@@ -210,8 +289,9 @@ class SHL(object):
                         if self.verbose != 0 :
                             print('No cache found {}: Learning the dictionary with algo = {} \n'.format(fmatname, self.learning_algorithm), end=' ')
 
+                        trajectory = self.get_trajectory(matname, trajectory)
                         dico = self.learn_dico(data=data, dictionary=dictionary, P_cum=P_cum, name_database=name_database,
-                                               record_each=self.record_each, matname=None)
+                                               record_each=self.record_each, matname=None, trajectory=trajectory)
                         with open(fmatname, 'wb') as fp:
                             pickle.dump(dico, fp)
                     except AttributeError:
@@ -234,8 +314,10 @@ class SHL(object):
                     if not (os.path.isfile(fmatname + '_lock')):
                         touch(fmatname + '_lock')
                         touch(fmatname + self.LOCK)
+                        # the trajectory of the cached dictionary is replaced as well
+                        trajectory = self.get_trajectory(matname, trajectory)
                         dico = self.learn_dico(data=data, dictionary=dictionary, P_cum=P_cum, name_database=name_database,
-                                           record_each=self.record_each, matname=None)
+                                           record_each=self.record_each, matname=None, trajectory=trajectory)
                         with open(fmatname, 'wb') as fp:
                             pickle.dump(dico, fp)
                         try:
@@ -245,41 +327,27 @@ class SHL(object):
                             if self.verbose: print('Coud not remove ', fmatname + self.LOCK)
 
         if not dico == 'lock':
-            if 'show_dico' in list_figures:
-                fig, ax = self.show_dico(dico, title=matname, fname=fname)
-            if 'show_dico_in_order' in list_figures:
-                fig,ax = self.show_dico_in_order(dico, title=matname, fname=fname)
-            if 'plot_variance' in list_figures:
-                sparse_code = self.code(data, dico, matname=matname)
-                fig, ax = self.plot_variance(sparse_code, data=data, fname=fname)
-            if 'plot_variance_histogram' in list_figures:
-                sparse_code = self.code(data, dico, matname=matname)
-                fig, ax = self.plot_variance_histogram(sparse_code, data=data, fname=fname)
-            if 'time_plot_var' in list_figures:
-                fig, ax = self.time_plot(dico, variable='var', fname=fname);
-            if 'time_plot_kurt' in list_figures:
-                fig, ax = self.time_plot(dico, variable='kurt', fname=fname);
-            if 'time_plot_prob' in list_figures:
-                fig, ax = self.time_plot(dico, variable='prob_active', fname=fname);
-            if 'time_plot_error' in list_figures:
-                fig, ax = self.time_plot(dico, variable='error', fname=fname)
-            if 'time_plot_entropy' in list_figures:
-                fig, ax = self.time_plot(dico, variable='entropy', fname=fname)
+            # the data is coded at most once for all figures
+            pipeline = self.pipeline(data=data, dico=dico, name_database=name_database,
+                                     matname=matname, fname=fname)
+            list_figures = [name for name in list_figures if name in pipeline.nodes]
+            figures = pipeline.run(list_figures)
             try:
                 #if fname is None:
+                fig, ax = figures[list_figures[-1]]
                 fig.show()
             except:
                 pass
 
         return dico
 
-    def plot_variance(self, sparse_code, data=None, algorithm=None, fname=None):
+    def plot_variance(self, sparse_code, data=None, algorithm=None, fname=None, evaluation=None):
         from shl_scripts.shl_tools import plot_variance
-        return plot_variance(self, sparse_code, data=data, fname=fname, algorithm=algorithm)
+        return plot_variance(self, sparse_code, data=data, fname=fname, algorithm=algorithm, evaluation=evaluation)
 
-    def plot_variance_histogram(self, sparse_code, data=None, algorithm=None, fname=None):
+    def plot_variance_histogram(self, sparse_code, data=None, algorithm=None, fname=None, evaluation=None):
         from shl_scripts.shl_tools import plot_variance_histogram
-        return plot_variance_histogram(self, sparse_code, data=data, fname=fname, algorithm=algorithm)
+        return plot_variance_histogram(self, sparse_code, data=data, fname=fname, algorithm=algorithm, evaluation=evaluation)
 
     def time_plot(self, dico, variable='kurt', fname=None, N_nosample=1):
         from shl_scripts.shl_tools import time_plot
@@ -289,9 +357,282 @@ class SHL(object):
         from shl_scripts.shl_tools import show_dico
         return show_dico(self, dico=dico, data=data, title=title, fname=fname, dpi=dpi)
 
-    def show_dico_in_order(self, dico, data=None, title=None, fname=None, dpi=200):
+    def show_dico_in_order(self, dico, data=None, sparse_code=None, evaluation=None, title=None, fname=None, dpi=200):
         from shl_scripts.shl_tools import show_dico_in_order
-        return show_dico_in_order(self, dico=dico, data=data, title=title, fname=fname, dpi=dpi)
+        return show_dico_in_order(self, dico=dico, data=data, sparse_code=sparse_code, evaluation=evaluation, title=title, fname=fname, dpi=dpi)
+
+    def pipeline(self, data=None, dico=None, name_database='serre07_distractors',
+                 matname=None, fname=None, n_jobs=None, backend=None):
+        """
+        Builds the dependency graph of an experiment::
+
+            data -> dico -> sparse_code -> metrics
+                                        -> figures
+
+        Each node is computed at most once (and uses the matname caches of
+        ``get_data``, ``learn_dico`` and ``code``), such that asking for an
+        extra figure does not re-encode the data. A known ``data`` or ``dico``
+        may be given to seed the graph.
+
+        """
+        pipeline = Pipeline(n_jobs=n_jobs, verbose=self.verbose, backend=backend)
+        pipeline.add('data', lambda: self.get_data(name_database, matname=matname))
+        pipeline.add('dico', lambda data: self.learn_dico(data=data, name_database=name_database, matname=matname),
+                     inputs=['data'])
+        pipeline.add('sparse_code', lambda data, dico: self.code(data, dico, matname=matname),
+                     inputs=['data', 'dico'])
+        if not data is None: pipeline.set('data', data)
+        if not dico is None: pipeline.set('dico', dico)
+
+        # metrics
+        pipeline.add('variance', lambda sparse_code: np.mean(sparse_code**2, axis=0),
+                     inputs=['sparse_code'])
+        pipeline.add('prob_active', lambda sparse_code: np.mean(np.abs(sparse_code)>0, axis=0),
+                     inputs=['sparse_code'])
+        pipeline.add('rmse', lambda data, dico, sparse_code: np.sqrt(np.mean((data - self.decode(sparse_code, dico))**2)),
+                     inputs=['data', 'dico', 'sparse_code'])
+        pipeline.add('evaluation', lambda data, dico: self.evaluate(data, dico),
+                     inputs=['data', 'dico'])
+
+        # figures use pyplot and are thus drawn one after the other
+        figures = {
+            'show_dico': (lambda dico: self.show_dico(dico, title=matname, fname=fname), ['dico']),
+            'show_dico_in_order': (lambda dico, sparse_code: self.show_dico_in_order(dico, sparse_code=sparse_code, title=matname, fname=fname), ['dico', 'sparse_code']),
+            'plot_variance': (lambda data, sparse_code: self.plot_variance(sparse_code, data=data, fname=fname), ['data', 'sparse_code']),
+            'plot_variance_histogram': (lambda data, sparse_code: self.plot_variance_histogram(sparse_code, data=data, fname=fname), ['data', 'sparse_code']),
+            'time_plot_var': (lambda dico: self.time_plot(dico, variable='var', fname=fname), ['dico']),
+            'time_plot_kurt': (lambda dico: self.time_plot(dico, variable='kurt', fname=fname), ['dico']),
+            'time_plot_prob': (lambda dico: self.time_plot(dico, variable='prob_active', fname=fname), ['dico']),
+            'time_plot_error': (lambda dico: self.time_plot(dico, variable='error', fname=fname), ['dico']),
+            'time_plot_entropy': (lambda dico: self.time_plot(dico, variable='entropy', fname=fname), ['dico']),
+            }
+        for name, (func, inputs) in figures.items():
+            pipeline.add(name, func, inputs=inputs, concurrent=False)
+        return pipeline
+
+
+class Pipeline(object):
+    """
+    A small graph of cached computations.
+
+    Each node is a function whose arguments are the results of its ``inputs``
+    nodes. Running a list of targets only computes the nodes they depend on
+    which are not yet cached. Nodes are computed level by level and
+    independent nodes of a same level run concurrently in a thread pool,
+    apart from those declared with ``concurrent=False`` (for instance figures
+    using pyplot's global state) which run in the calling thread.
+
+    """
+    def __init__(self, n_jobs=None, verbose=0, backend=None):
+        self.n_jobs = n_jobs
+        self.verbose = verbose
+        self.backend = backend
+        self.nodes = {}
+        self.results = {}
+
+    def add(self, name, func, inputs=[], concurrent=True):
+        self.nodes[name] = (func, list(inputs), concurrent)
+        self.invalidate(name)
+
+    def set(self, name, value):
+        self.invalidate(name)
+        self.results[name] = value
+
+    def invalidate(self, name):
+        """
+        Drops the cached result of a node and of all nodes depending on it.
+
+        """
+        self.results.pop(name, None)
+        for other, (func, inputs, concurrent) in self.nodes.items():
+            if name in inputs and other in self.results:
+                self.invalidate(other)
+
+    def get_levels(self, targets):
+        """
+        Groups the nodes which are needed to compute ``targets`` and which are
+        not cached into levels, such that each node only depends on nodes of
+        previous levels.
+
+        """
+        depth = {}
+        def visit(name, path=()):
+            if name in path:
+                raise ValueError('cyclic dependency in the pipeline: ' + ' -> '.join(path + (name,)))
+            if name in self.results: return -1
+            if not name in depth:
+                if not name in self.nodes:
+                    raise KeyError('unknown node in the pipeline: ' + name)
+                depth[name] = 1 + max([visit(input, path + (name,)) for input in self.nodes[name][1]] + [-1])
+            return depth[name]
+        for name in targets: visit(name)
+        levels = [[] for _ in range(max(depth.values()) + 1)] if depth else []
+        for name, level in depth.items():
+            levels[level].append(name)
+        return levels
+
+    def compute(self, name):
+        func, inputs, concurrent = self.nodes[name]
+        if self.verbose: print('Computing node', name)
+        return func(*[self.results[input] for input in inputs])
+
+    def run(self, targets):
+        """
+        Computes (if needed) and returns the results of ``targets`` as a dict.
+
+        """
+        from shl_scripts.shl_backend import Backend
+        # the pipeline builds its own backend: the default one of the package
+        # (see ``set_default_backend``) may be a pool of processes
+        backend = self.backend
+        if not isinstance(backend, Backend):
+            backend = Backend('threads' if backend is None else backend, n_jobs=self.n_jobs)
+        if backend.kind == 'processes':
+            raise ValueError('the nodes of a pipeline share their results and run in threads, got a backend of processes.')
+        for level in self.get_levels(targets):
+            parallel = [name for name in level if self.nodes[name][2]]
+            for name, result in zip(parallel, backend.imap(self.compute, parallel)):
+                self.results[name] = result
+            for name in level:
+                if not self.nodes[name][2]:
+                    self.results[name] = self.compute(name)
+        return {name: self.results[name] for name in targets}
+
+
+def _sweep_job(opts, data_fname, matname, do_code=True):
+    """
+    Runs one job of a sweep in a worker process: learns (or loads from the
+    cache) the dictionary for the given options and then codes the data.
+
+    """
+    t0 = time.time()
+    shl = SHL(**opts)
+    # the data is shared between all workers as a read-only memmap
+    data = np.load(data_fname, mmap_mode='r')
+    row = {'matname':matname, 'status':'done'}
+    dico = shl.learn_dico(data=data, matname=matname)
+    if dico == 'lock':
+        row['status'] = 'lock'
+        return row
+    row['time_learn'] = time.time() - t0
+    if hasattr(dico, 'record'):
+        row['error'] = dico.record['error'].iloc[-1]
+        row['entropy'] = dico.record['entropy'].iloc[-1]
+    if do_code:
+        t0 = time.time()
+        sparse_code = shl.code(data, dico, matname=matname)
+        row['time_code'] = time.time() - t0
+        residual = data - sparse_code @ dico.dictionary
+        row['rmse'] = np.sqrt(np.mean(residual**2)) / np.sqrt(np.mean(data**2))
+        row['l0_mean'] = np.count_nonzero(sparse_code, axis=1).mean()
+    return row
+
+def sweep(param_grid, tag='sweep', data=None, name_database='serre07_distractors',
+          do_code=True, n_jobs=None, verbose=0, backend=None, **kwargs):
+    """
+    Runs a parameter sweep over SHL experiments on a local process pool.
+
+    Each point of the cartesian product of ``param_grid`` defines the
+    parameters of one ``SHL`` instance (on top of ``kwargs``). Points sharing
+    the same cache key (``matname``) are only learned once, the patches are
+    extracted once for each set of data parameters and are shared between
+    workers as a memory-mapped ``.npy`` file in ``data_cache``.
+
+    Parameters
+    ----------
+    param_grid : dict
+        Maps each swept ``SHL`` parameter to the list of its values, for
+        instance ``{'eta':[.01, .02], 'l0_sparseness':[10, 20]}``.
+
+    tag : str
+        Prefix of the cache keys of this sweep. The keys of the dictionaries
+        also hold a hash of the fixed ``kwargs`` which differ from the
+        defaults of ``SHL``, such that sweeps sharing a tag but not these
+        parameters do not load each other's dictionaries.
+
+    data : array of shape (n_samples, n_pixels)
+        Patches to learn from. By default they are extracted with ``get_data``.
+        If given, a hash of their content is appended to ``tag``, such that the
+        cached patches and dictionaries of other data given with the same
+        ``tag`` are not reused.
+
+    do_code : bool
+        If True, each learned dictionary is also used to code the data.
+
+    n_jobs : int
+        Number of worker processes (defaults to the number of CPUs).
+
+    backend : Backend or str
+        See ``shl_backend``, by default a pool of processes whose BLAS
+        threads share the CPUs.
+
+    Returns
+    -------
+    results : pandas DataFrame
+        One row per point of the grid.
+
+    """
+    import itertools
+    import pandas as pd
+    from shl_scripts.shl_backend import get_backend
+
+    keys = sorted(param_grid.keys())
+    combos = [dict(zip(keys, values)) for values in itertools.product(*[param_grid[key] for key in keys])]
+
+    data_keys = ['height', 'width', 'patch_size', 'datapath', 'n_image', 'max_patches', 'DEBUG_DOWNSCALE']
+    if not data is None:
+        import hashlib
+        data = np.ascontiguousarray(data)
+        data_hash = hashlib.sha1(str((data.dtype.str, data.shape)).encode())
+        data_hash.update(data.data)
+        tag = tag + ' - ' + data_hash.hexdigest()[:16]
+    # the fixed parameters which are not the defaults of SHL (nor only
+    # change where the results are stored or printed)
+    import inspect
+    defaults = {key: value.default for key, value in inspect.signature(SHL).parameters.items()}
+    fixed = {key: value for key, value in kwargs.items()
+             if not key in keys + ['data_cache', 'verbose'] and not (key in defaults and defaults[key] == value)}
+    learn_tag = tag
+    if len(fixed) > 0:
+        import hashlib
+        fixed_hash = hashlib.sha1(repr(sorted(fixed.items())).encode())
+        learn_tag = tag + ' - ' + fixed_hash.hexdigest()[:16]
+    if data is None: data_keys = data_keys + ['name_database']
+    jobs, data_fnames, rows = {}, {}, []
+    for combo in combos:
+        opts = kwargs.copy()
+        opts.update(combo)
+        opts['verbose'] = verbose
+        matname = learn_tag + ' - ' + ', '.join('{}={}'.format(key, combo[key]) for key in keys)
+        # load each dataset only once
+        data_opts = dict(opts, name_database=name_database)
+        data_matname = tag + ' - ' + ', '.join('{}={}'.format(key, data_opts[key]) for key in data_keys if key in data_opts)
+        if not data_matname in data_fnames:
+            shl = SHL(**opts)
+            data_fname = os.path.join(shl.data_cache, data_matname) + '_data.npy'
+            if data is None:
+                data_ = shl.get_data(name_database, matname=data_matname)
+                if isinstance(data_, str):
+                    raise RuntimeError('the data extraction is locked ' + data_fname)
+            elif not os.path.isfile(data_fname):
+                np.save(data_fname, data)
+            data_fnames[data_matname] = data_fname
+        # deduplicate jobs sharing the same cache key
+        if not matname in jobs:
+            jobs[matname] = (opts, data_fnames[data_matname])
+        rows.append(dict(combo, matname=matname))
+
+    if verbose: print('Sweeping {} jobs over {} points'.format(len(jobs), len(combos)))
+    results = {}
+    backend = get_backend(backend, n_jobs=n_jobs, default='processes', verbose=verbose)
+    matnames = list(jobs.keys())
+    for matname, result in zip(matnames, backend.imap(_sweep_job, [jobs[matname][0] for matname in matnames],
+                                                      [jobs[matname][1] for matname in matnames],
+                                                      matnames, [do_code]*len(matnames))):
+        results[matname] = result
+        if verbose: print('done', matname)
+
+    return pd.DataFrame([dict(row, **results[row['matname']]) for row in rows])
 
 if __name__ == '__main__':
 
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*
+from __future__ import division, print_function, absolute_import
+"""
+Encoding and reconstruction of whole images.
+
+An image is tiled into (possibly overlapping) patches which are strided views
+of the image, the tiles are encoded by batches with the learned dictionary,
+and the reconstructed tiles are overlap-added back into an image, each pixel
+being normalized by the number of tiles covering it::
+
+    image = whiten(load_image(fname))
+    sparse_code, means = encode_image(image, dico, stride=8)
+    reconstruction = decode_image(sparse_code, dico, image.shape, stride=8, means=means)
+
+``stream_directory`` applies this to every image of a directory, holding one
+image at a time in memory.
+
+"""
+import os
+import time
+import numpy as np
+
+def get_shape(shape, patch_size, stride):
+    """
+    Number of tiles along each axis, such that the tiles cover the whole
+    image (the image is padded by ``get_tiles`` if needed).
+
+    """
+    return tuple(int(np.ceil(max(n - p, 0) / s)) + 1 for n, p, s in zip(shape, patch_size, stride))
+
+def check_stride(patch_size, stride):
+    # with a stride larger than the patch, some pixels would not be covered by any tile
+    if not all(1 <= s <= p for p, s in zip(patch_size, stride)):
+        raise ValueError('the stride {} must be between 1 and the patch size {}.'.format(tuple(stride), tuple(patch_size)))
+
+def get_tiles(image, patch_size, stride):
+    """
+    Tiles an image into patches of shape ``patch_size`` every ``stride`` pixels
+    (at most ``patch_size``).
+
+    The tiles are a strided view of the image: no data is copied, except when
+    the image has to be padded (by reflection) for the last tiles to fit.
+
+    Returns
+    -------
+    tiles : array of shape (n_y, n_x, patch_size[0], patch_size[1])
+
+    """
+    check_stride(patch_size, stride)
+    n_y, n_x = get_shape(image.shape, patch_size, stride)
+    pad_y = (n_y - 1) * stride[0] + patch_size[0] - image.shape[0]
+    pad_x = (n_x - 1) * stride[1] + patch_size[1] - image.shape[1]
+    if pad_y > 0 or pad_x > 0:
+        image = np.pad(image, ((0, max(pad_y, 0)), (0, max(pad_x, 0))), mode='reflect')
+    windows = np.lib.stride_tricks.sliding_window_view(image, patch_size)
+    return windows[::stride[0], ::stride[1]]
+
+def overlap_add(tiles, shape, stride):
+    """
+    Adds the tiles back at their positions and divides each pixel by the
+    number of tiles covering it.
+
+    Parameters
+    ----------
+    tiles : array of shape (n_y, n_x, patch_size[0], patch_size[1])
+
+    shape : tuple
+        Shape of the original image.
+
+    stride : tuple
+        Step between tiles, at most the patch size such that every pixel is
+        covered.
+
+    Returns
+    -------
+    image : array of shape ``shape``
+
+    """
+    n_y, n_x, height, width = tiles.shape
+    check_stride((height, width), stride)
+    full = ((n_y - 1) * stride[0] + height, (n_x - 1) * stride[1] + width)
+    image, counts = np.zeros(full), np.zeros(full)
+    # one vectorized addition per pixel of the patch: tiles never overlap
+    # within such a strided slice
+    for u in range(height):
+        for v in range(width):
+            image[u:u+n_y*stride[0]:stride[0], v:v+n_x*stride[1]:stride[1]] += tiles[:, :, u, v]
+            counts[u:u+n_y*stride[0]:stride[0], v:v+n_x*stride[1]:stride[1]] += 1
+    return (image / counts)[:shape[0], :shape[1]]
+
+def get_patch_size(dico):
+    patch_size = int(np.sqrt(dico.dictionary.shape[1]))
+    return (patch_size, patch_size)
+
+def encode_image(image, dico, stride=None, batch_size=1024, l0_sparseness=None, remove_mean=True):
+    """
+    Sparse code of all tiles of an image.
+
+    Parameters
+    ----------
+    image : array of shape (height, width)
+        A whitened image.
+
+    dico : SparseHebbianLearning
+        A learned dictionary of square patches.
+
+    stride : tuple
+        Step between tiles, by default half of the patch size.
+
+    batch_size : int
+        Approximate number of tiles encoded at once.
+
+    remove_mean : bool
+        Whether the mean of each tile is removed before encoding (and
+        returned, to be added back by ``decode_image``).
+
+    Returns
+    -------
+    sparse_code : array of shape (n_y, n_x, n_dictionary)
+
+    means : array of shape (n_y, n_x)
+
+    """
+    patch_size = get_patch_size(dico)
+    if stride is None: stride = (patch_size[0]//2, patch_size[1]//2)
+    tiles = get_tiles(image, patch_size, stride)
+    n_y, n_x = tiles.shape[:2]
+    sparse_code = np.zeros((n_y, n_x, dico.dictionary.shape[0]))
+    means = np.zeros((n_y, n_x))
+    # only the tiles of a batch of rows are copied at once
+    n_rows = max(1, batch_size // n_x)
+    for i_start in range(0, n_y, n_rows):
+        batch = tiles[i_start:i_start+n_rows].reshape(-1, patch_size[0]*patch_size[1])
+        if remove_mean:
+            mean = batch.mean(axis=1)
+            batch = batch - mean[:, np.newaxis]
+            means[i_start:i_start+n_rows] = mean.reshape(-1, n_x)
+        code = dico.transform(batch, l0_sparseness=l0_sparseness)
+        sparse_code[i_start:i_start+n_rows] = code.reshape(-1, n_x, code.shape[1])
+    return sparse_code, means
+
+def decode_image(sparse_code, dico, shape, stride=None, means=None):
+    """
+    Reconstructs an image from the sparse code of its tiles, see ``encode_image``.
+
+    """
+    patch_size = get_patch_size(dico)
+    if stride is None: stride = (patch_size[0]//2, patch_size[1]//2)
+    n_y, n_x, n_dictionary = sparse_code.shape
+    tiles = sparse_code.reshape(-1, n_dictionary) @ dico.dictionary
+    if not means is None:
+        tiles += means.reshape(-1, 1)
+    return overlap_add(tiles.reshape(n_y, n_x, *patch_size), shape, stride)
+
+def reconstruct(image, dico, stride=None, batch_size=1024, l0_sparseness=None, remove_mean=True):
+    """
+    Encodes and decodes an image, returning its reconstruction.
+
+    """
+    sparse_code, means = encode_image(image, dico, stride=stride, batch_size=batch_size,
+                                      l0_sparseness=l0_sparseness, remove_mean=remove_mean)
+    return decode_image(sparse_code, dico, image.shape, stride=stride,
+                        means=means if remove_mean else None)
+
+def psnr(image, reconstruction):
+    """
+    Peak signal-to-noise ratio (in dB) of a reconstruction, the peak being
+    the range of values of the original image.
+
+    """
+    mse = np.mean((image - reconstruction)**2)
+    if mse == 0: return np.inf
+    return 10 * np.log10((image.max() - image.min())**2 / mse)
+
+def load_image(fname):
+    """
+    Loads an image as a grayscale float array (``.npy`` files are loaded with
+    NumPy, other formats with matplotlib).
+
+    """
+    if fname.endswith('.npy'):
+        image = np.load(fname)
+    else:
+        from matplotlib.image import imread
+        image = imread(fname)
+    image = np.asarray(image, dtype=float)
+    if image.ndim == 3:
+        image = image[:, :, :3].mean(axis=2)
+    return image
+
+def get_whitening(datapath='database/', seed=None):
+    """
+    Returns a function whitening an image of any size as the patches of
+    ``shl_tools.get_data``, using SLIP (one SLIP object is built per size).
+
+    """
+    from shl_scripts.shl_tools import get_slip
+    slips = {}
+    def whiten(image):
+        if not image.shape in slips:
+            slips[image.shape] = get_slip(height=image.shape[0], width=image.shape[1],
+                                          datapath=datapath, seed=seed)
+        return slips[image.shape].whitening(image)
+    return whiten
+
+def stream_directory(path, dico, stride=None, whiten=True, batch_size=1024, l0_sparseness=None,
+                     remove_mean=True, extensions=('.png', '.jpg', '.jpeg', '.npy'), verbose=0):
+    """
+    Encodes and reconstructs all images of a directory, one at a time.
+
+    Parameters
+    ----------
+    path : str
+        The directory.
+
+    dico : SparseHebbianLearning
+
+    whiten : bool or callable
+        Whether images are whitened as the training patches (requires SLIP),
+        or a function applied to each loaded image.
+
+    Yields
+    ------
+    fname : str
+
+    reconstruction : array
+        The reconstructed (whitened) image.
+
+    stats : dict
+        Shape of the image, number of tiles, duration of encoding and
+        decoding, throughput (in tiles per second) and PSNR.
+
+    """
+    if whiten is True: whiten = get_whitening()
+    for fname in sorted(os.listdir(path)):
+        if not fname.lower().endswith(extensions): continue
+        image = load_image(os.path.join(path, fname))
+        if callable(whiten): image = whiten(image)
+        t0 = time.time()
+        reconstruction = reconstruct(image, dico, stride=stride, batch_size=batch_size,
+                                     l0_sparseness=l0_sparseness, remove_mean=remove_mean)
+        duration = time.time() - t0
+        patch_size = get_patch_size(dico)
+        n_tiles = np.prod(get_shape(image.shape, patch_size,
+                                    stride or (patch_size[0]//2, patch_size[1]//2)))
+        stats = dict(shape=image.shape, n_tiles=n_tiles, duration=duration,
+                     throughput=n_tiles/duration, psnr=psnr(image, reconstruction))
+        if verbose: print('{0}: {1} tiles in {2:.3f}s ({3:.0f} tiles/s), PSNR={4:.2f}dB'.format(
+                          fname, n_tiles, duration, stats['throughput'], stats['psnr']))
+        yield fname, reconstruction, stats
+
+def report_directory(path, dico, **kwargs):
+    """
+    Runs ``stream_directory`` and returns its statistics as a DataFrame
+    indexed by file name (reconstructions are discarded).
+
+    """
+    import pandas as pd
+    stats = {fname: stats for fname, reconstruction, stats in stream_directory(path, dico, **kwargs)}
+    return pd.DataFrame.from_dict(stats, orient='index')
@@ -1,10 +1,76 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*
 from __future__ import division, print_function, absolute_import
-from shl_scripts.shl_encode import sparse_encode
+from shl_scripts.shl_encode import sparse_encode, get_rescaling
 import time
 import numpy as np
 
+class StageTimer:
+    """Accumulates the time spent in each stage of ``dict_learning``.
+
+    Timing a stage costs two calls to ``time.perf_counter``, such that the
+    timer is always on. Stages are timed by chaining::
+
+        t = timer.start()
+        ... # sparse coding
+        t = timer.stop('coding', t)
+        ... # dictionary update
+        t = timer.stop('update', t)
+        timer.end_iteration(ii)
+
+    Parameters
+    ----------
+    callback : callable
+        If given, called at the end of each iteration as
+        ``callback(ii, timings)`` where ``timings`` maps each stage to the
+        time (in seconds) it took during this iteration.
+
+    """
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.total = {}
+        self.count = {}
+        self.max = {}
+        self.current = {}
+        self.n_iter = 0
+
+    def start(self):
+        return time.perf_counter()
+
+    def stop(self, stage, t0):
+        t1 = time.perf_counter()
+        dt = t1 - t0
+        self.total[stage] = self.total.get(stage, 0.) + dt
+        self.count[stage] = self.count.get(stage, 0) + 1
+        self.max[stage] = max(self.max.get(stage, 0.), dt)
+        self.current[stage] = self.current.get(stage, 0.) + dt
+        return t1
+
+    def end_iteration(self, ii):
+        self.n_iter += 1
+        if not self.callback is None:
+            self.callback(ii, self.current)
+        self.current = {}
+
+    def report(self):
+        """
+        Returns a pandas DataFrame with, for each stage, the total time, the
+        number of calls, the mean and max duration of one call, the mean time
+        per iteration and the fraction of the total time.
+
+        """
+        import pandas as pd
+        stages = list(self.total.keys())
+        total = sum(self.total.values())
+        return pd.DataFrame({'total':[self.total[stage] for stage in stages],
+                             'count':[self.count[stage] for stage in stages],
+                             'mean':[self.total[stage] / self.count[stage] for stage in stages],
+                             'max':[self.max[stage] for stage in stages],
+                             'per_iter':[self.total[stage] / max(self.n_iter, 1) for stage in stages],
+                             'fraction':[self.total[stage] / total for stage in stages]},
+                            index=stages)
+
+
 # SparseHebbianLearning
 class SparseHebbianLearning:
     """Sparse Hebbian learning
@@ -56,14 +122,30 @@ class SparseHebbianLearning:
         parameter: the value of the reconstruction error targeted. In this case,
         it overrides `l0_sparseness`.
 
+    record_each :
+        if set to 0, it does nothing. Else it records every record_each step the
+        statistics during the learning phase.
+
+    record_online : bool
+        if True, the recorded statistics are accumulated from the training
+        batches instead of encoding extra samples, see ``dict_learning``
+
     verbose :
         degree of verbosity of the printed output
 
+    profile_callback : callable
+        called at the end of each learning iteration with the timings of its
+        stages, see ``StageTimer``
+
     Attributes
     ----------
     dictionary : array, [n_dictionary, n_pixels]
         dictionary extracted from the data
 
+    timer : StageTimer
+        time spent in each stage of the last call to ``fit``, use
+        ``timer.report()`` to get a summary
+
 
     Notes
     -----
@@ -86,7 +168,9 @@ class SparseHebbianLearning:
                  eta_homeo=0.001, alpha_homeo=0.02,
                  batch_size=100,
                  l0_sparseness=None, fit_tol=None, nb_quant=32, C=0., do_sym=True,
-                 record_each=200, verbose=False, random_state=None):
+                 record_each=200, record_online=False, verbose=False, random_state=None, profile_callback=None,
+                 homeo_every=1, eta_schedule='constant', eta_homeo_schedule='constant', optimizer='sgd',
+                 trajectory=None, snapshot_each=0):
         self.eta = eta
         self.dictionary = dictionary
         self.n_dictionary = n_dictionary
@@ -101,9 +185,17 @@ class SparseHebbianLearning:
         self.l0_sparseness = l0_sparseness
         self.fit_tol = fit_tol
         self.record_each = record_each
+        self.record_online = record_online
         self.verbose = verbose
         self.random_state = random_state
         self.P_cum  = P_cum
+        self.profile_callback = profile_callback
+        self.homeo_every = homeo_every
+        self.eta_schedule = eta_schedule
+        self.eta_homeo_schedule = eta_homeo_schedule
+        self.optimizer = optimizer
+        self.trajectory = trajectory
+        self.snapshot_each = snapshot_each
 
     def fit(self, X, y=None):
         """Fit the model from data in X.
@@ -120,19 +212,24 @@ class SparseHebbianLearning:
             Returns the instance itself.
         """
 
+        self.timer = StageTimer(callback=self.profile_callback)
         return_fn = dict_learning(X, self.dictionary, self.P_cum,
                                   self.eta, self.n_dictionary, self.l0_sparseness,
             n_iter=self.n_iter, eta_homeo=self.eta_homeo, alpha_homeo=self.alpha_homeo,
             method=self.fit_algorithm, nb_quant=self.nb_quant, C=self.C, do_sym=self.do_sym,
-            batch_size=self.batch_size, record_each=self.record_each,
-            verbose=self.verbose, random_state=self.random_state)
+            batch_size=self.batch_size, record_each=self.record_each, record_online=self.record_online,
+            verbose=self.verbose, random_state=self.random_state, timer=self.timer,
+            homeo_every=self.homeo_every, eta_schedule=self.eta_schedule,
+            eta_homeo_schedule=self.eta_homeo_schedule, optimizer=self.optimizer,
+            trajectory=self.trajectory, snapshot_each=self.snapshot_each)
 
         if self.record_each==0:
             self.dictionary, self.P_cum = return_fn
         else:
             self.dictionary, self.P_cum, self.record = return_fn
 
-    def transform(self, X, algorithm=None, l0_sparseness=None, fit_tol=None):
+    def transform(self, X, algorithm=None, l0_sparseness=None, fit_tol=None, gram_cache=None,
+                  atom_tree=None):
         """Fit the model from data in X.
 
         Parameters
@@ -150,12 +247,75 @@ class SparseHebbianLearning:
         if l0_sparseness is None:  l0_sparseness = self.l0_sparseness
         if fit_tol is None:  fit_tol = self.fit_tol
         return sparse_encode(X, self.dictionary, algorithm=algorithm, P_cum=self.P_cum,
-                                fit_tol=fit_tol, l0_sparseness=l0_sparseness)
+                                fit_tol=fit_tol, l0_sparseness=l0_sparseness, C=self.C, do_sym=self.do_sym,
+                                gram_cache=gram_cache, atom_tree=atom_tree)
+
+    def transform_image(self, image, l0_sparseness=None, fit_tol=None, gram_cache=1024):
+        """Convolutional sparse code of a whole image.
+
+        The atoms are used as filters placed at every position of the image,
+        see ``shl_encode.conv_mp``.
+
+        Parameters
+        ----------
+        image: array-like, shape (height, width)
+            Image preprocessed as the training patches (e.g. whitened).
+
+        l0_sparseness: int
+            Total number of atoms selected in the image.
+
+        Returns
+        -------
+        sparse_code : array, shape (n_dictionary, height-patch_size+1, width-patch_size+1)
+            Coefficients of each atom at each position, such that
+            ``shl_encode.conv_decode(sparse_code, self.dictionary)``
+            reconstructs the image.
+        """
+        from shl_scripts.shl_encode import conv_mp
+        if l0_sparseness is None:  l0_sparseness = self.l0_sparseness
+        if fit_tol is None:  fit_tol = self.fit_tol
+        return conv_mp(image, self.dictionary, l0_sparseness=l0_sparseness, fit_tol=fit_tol,
+                       P_cum=self.P_cum, do_sym=self.do_sym, gram_cache=gram_cache)
+
+def get_schedule(schedule, n_iter, warmup=0.05, decay=10.):
+    """
+    Returns the factor applied to a learning rate at each iteration.
+
+    Parameters
+    ----------
+    schedule : {'constant', 'decay', 'warmup', 'cosine'} or callable
+        constant : 1
+        decay : ``1 / (1 + decay * ii / n_iter)``
+        warmup : linear increase from 0 to 1 during the first ``warmup * n_iter`` iterations
+        cosine : warmup, then cosine annealing from 1 to 0 at ``n_iter``
+        A callable is returned as is and is called with the iteration number.
+
+    Returns
+    -------
+    factor : callable
+        Function of the iteration number ``ii``.
+
+    """
+    if callable(schedule): return schedule
+    n_warmup = max(warmup * n_iter, 1)
+    if schedule == 'constant':
+        return lambda ii: 1.
+    elif schedule == 'decay':
+        return lambda ii: 1. / (1. + decay * ii / n_iter)
+    elif schedule == 'warmup':
+        return lambda ii: min(1., (ii + 1) / n_warmup)
+    elif schedule == 'cosine':
+        return lambda ii: min(1., (ii + 1) / n_warmup) * .5 * (1. + np.cos(np.pi * ii / n_iter))
+    else:
+        raise ValueError('schedule must be "constant", "decay", "warmup", "cosine" or a callable, got %s.'
+                         % schedule)
 
 def dict_learning(X, dictionary=None, P_cum=None, eta=0.02, n_dictionary=2, l0_sparseness=10, fit_tol=None, n_iter=100,
                        eta_homeo=0.01, alpha_homeo=0.02,
-                       batch_size=100, record_each=0, record_num_batches = 1000, verbose=False,
-                       method='mp', C=0., nb_quant=100, do_sym=True, random_state=None):
+                       batch_size=100, record_each=0, record_num_batches = 1000, record_online=False, verbose=False,
+                       method='mp', C=0., nb_quant=100, do_sym=True, random_state=None,
+                       timer=None, homeo_every=1, eta_schedule='constant', eta_homeo_schedule='constant',
+                       optimizer='sgd', momentum=0.9, beta2=0.999, trajectory=None, snapshot_each=0):
     """
     Solves a dictionary learning matrix factorization problem online.
 
@@ -240,11 +400,58 @@ def dict_learning(X, dictionary=None, P_cum=None, eta=0.02, n_dictionary=2, l0_s
         statistics during the learning phase (variance and kurtosis of coefficients).
 
     record_num_batches :
-        number of batches used to make statistics (if -1, uses the whole training set)
+        number of batches used to make statistics (if -1, uses the whole training set);
+        under a memory budget (see ``shl_memory``), they are encoded in chunks
+
+    record_online : bool
+        if True, the statistics are not computed by encoding
+        ``record_num_batches`` samples at each record step but are accumulated
+        (see ``shl_evaluate.MomentAccumulator``) from the sparse codes of the
+        training batches since the previous record step, at no extra cost.
 
     verbose :
         degree of verbosity of the printed output
 
+    random_state : int or np.random.RandomState
+        seed (or generator) of the initial dictionary and of the order of the
+        samples; by default, the global random state of NumPy is used.
+
+    timer : StageTimer
+        accumulates the time spent in the sparse coding ('coding'), the
+        dictionary update ('update'), the normalisation ('normalisation'),
+        the homeostasis ('get_rescaling', 'update_P_cum', 'update_gain'),
+        the recording ('record') and the snapshot ('snapshot') stages.
+
+    homeo_every : int
+        if larger than 1, the homeostasis using ``P_cum`` is amortised: the
+        histograms of the (rescaled) coefficients are accumulated over
+        ``homeo_every`` iterations, together with a sample of as many
+        patches as in one batch drawn from these iterations to estimate the
+        rescaling vector, and both are folded into ``P_cum`` once every
+        ``homeo_every`` iterations with the rate
+        ``1 - (1 - eta_homeo)**homeo_every``, such that the time constant
+        of the homeostasis is unchanged.
+
+    eta_schedule, eta_homeo_schedule : str or callable
+        schedules of ``eta`` and ``eta_homeo``: at iteration ``ii``, the
+        learning rates are multiplied by a factor given by ``get_schedule``
+        ('constant', 'decay', 'warmup', 'cosine' or a function of ``ii``)
+
+    optimizer : {'sgd', 'momentum', 'adam'}
+        sgd : the dictionary moves along the Hebbian gradient
+        ``sparse_code.T @ residual / n_dictionary``
+        momentum : along an exponential moving average of this gradient
+        (heavy ball, with coefficient ``momentum``)
+        adam : along the Adam estimate (moving averages of the gradient and
+        of its square with coefficients ``momentum`` and ``beta2``), such
+        that ``eta`` is the step on each pixel (typically 1e-3)
+
+    trajectory : TrajectoryStore or str
+        if ``snapshot_each`` is larger than 0, the dictionary and ``P_cum``
+        are appended to this store (or to a new ``shl_trajectory.TrajectoryStore``
+        at this path, overwriting any previous one) every ``snapshot_each``
+        iterations and at the last one
+
     Returns
     -------
 
@@ -256,15 +463,32 @@ def dict_learning(X, dictionary=None, P_cum=None, eta=0.02, n_dictionary=2, l0_s
     if record_each>0:
         import pandas as pd
         record = pd.DataFrame()
+        if record_online:
+            from shl_scripts.shl_evaluate import MomentAccumulator
 
     if n_dictionary is None:
         n_dictionary = X.shape[1]
 
+    if timer is None:
+        timer = StageTimer()
+
+    if snapshot_each>0:
+        if trajectory is None:
+            raise ValueError('a trajectory store is needed to snapshot the dictionary every %d iterations.' % snapshot_each)
+        if isinstance(trajectory, str):
+            from shl_scripts.shl_trajectory import TrajectoryStore
+            trajectory = TrajectoryStore(trajectory, mode='w')
+
+    if record_each>0 and record_online:
+        moments = MomentAccumulator(n_dictionary)
+        residual_energy = 0.
+
     t0 = time.time()
     n_samples, n_pixels = X.shape
+    rng = np.random if random_state is None else np.random.RandomState(random_state)
 
     if dictionary is None:
-        dictionary = np.random.randn(n_dictionary, n_pixels)
+        dictionary = rng.randn(n_dictionary, n_pixels)
     norm = np.sqrt(np.sum(dictionary**2, axis=1))
     dictionary /= norm[:, np.newaxis]
     norm = np.sqrt(np.sum(dictionary**2, axis=1))
@@ -274,11 +498,11 @@ def dict_learning(X, dictionary=None, P_cum=None, eta=0.02, n_dictionary=2, l0_s
 
     # print(alpha_homeo, eta_homeo, alpha_homeo==0, eta_homeo==0, alpha_homeo==0 or eta_homeo==0, 'P_cum', P_cum)
 
-    # splits the whole dataset into batches
+    # splits the whole dataset into batches of indices such that X is never
+    # copied (it may be a read-only memmap shared between processes)
     n_batches = n_samples // batch_size
-    X_train = X.copy()
-    np.random.shuffle(X_train)
-    batches = np.array_split(X_train, n_batches)
+    order = rng.permutation(n_samples)
+    batches = np.array_split(order, n_batches)
 
     if alpha_homeo==0:
         # do the equalitarian homeostasis
@@ -286,8 +510,7 @@ def dict_learning(X, dictionary=None, P_cum=None, eta=0.02, n_dictionary=2, l0_s
             P_cum = np.linspace(0, 1, nb_quant, endpoint=True)[np.newaxis, :] * np.ones((n_dictionary, 1))
             if C == 0.:
                 # initialize the rescaling vector
-                from shl_scripts.shl_encode import get_rescaling
-                corr = (batches[0] @ dictionary.T)
+                corr = (X[batches[0], :] @ dictionary.T)
                 C_vec = get_rescaling(corr, nb_quant=nb_quant, do_sym=do_sym, verbose=verbose)
                 # and stack it to P_cum array for convenience
                 P_cum = np.vstack((P_cum, C_vec))
@@ -297,69 +520,148 @@ def dict_learning(X, dictionary=None, P_cum=None, eta=0.02, n_dictionary=2, l0_s
         mean_var = np.ones(n_dictionary)
         P_cum = None
 
+    if homeo_every > 1 and not P_cum is None:
+        # statistics accumulated between two foldings of the homeostasis
+        counts = np.zeros((n_dictionary, P_cum.shape[1]-1))
+        indx_sketch = []
+
+    eta_factor = get_schedule(eta_schedule, n_iter)
+    eta_homeo_factor = get_schedule(eta_homeo_schedule, n_iter)
+    if optimizer in ['momentum', 'adam']:
+        velocity = np.zeros_like(dictionary)
+        if optimizer == 'adam': second = np.zeros_like(dictionary)
+    elif not optimizer == 'sgd':
+        raise ValueError('optimizer must be "sgd", "momentum" or "adam", got %s.' % optimizer)
+
     import itertools
     # Return elements from list of batches until it is exhausted. Then repeat the sequence indefinitely.
     batches = itertools.cycle(batches)
     # cycle over all batches
-    for ii, this_X in zip(range(n_iter), batches):
+    for ii, indx_batch in zip(range(n_iter), batches):
+        this_X = X[indx_batch, :]
+        eta_ii, eta_homeo_ii = eta * eta_factor(ii), eta_homeo * eta_homeo_factor(ii)
         dt = (time.time() - t0)
         if verbose > 0:
             if ii % int(n_iter//verbose + 1) == 0:
                 print ("Iteration % 3i /  % 3i (elapsed time: % 3is, % 4.1fmn)"
-                       % (ii, n_iter, dt, dt//60))
+                       % (ii, n_iter, dt, dt//60), end='')
+                if record_each>0 and len(record)>0:
+                    print(", eta=%.4g, error=%.4f" % (eta_ii, record['error'].iloc[-1]), end='')
+                print()
 
         # Sparse coding
+        t = timer.start()
         sparse_code = sparse_encode(this_X, dictionary, algorithm=method, fit_tol=fit_tol,
                                   P_cum=P_cum, C=C, do_sym=do_sym, l0_sparseness=l0_sparseness)
+        t = timer.stop('coding', t)
 
         # Update dictionary
         residual = this_X - sparse_code @ dictionary
+        if record_each>0 and record_online:
+            moments.update(sparse_code)
+            residual_energy += np.sum(residual**2)
         residual /= n_dictionary # divide by the number of features
-        dictionary += eta * sparse_code.T @ residual
+        if optimizer == 'sgd':
+            # ``(eta_ii * sparse_code.T) @ residual`` rounds as the original update
+            dictionary += eta_ii * sparse_code.T @ residual
+        else:
+            gradient = sparse_code.T @ residual
+        if optimizer == 'momentum':
+            velocity = momentum * velocity + (1 - momentum) * gradient
+            dictionary += eta_ii * velocity
+        elif optimizer == 'adam':
+            velocity = momentum * velocity + (1 - momentum) * gradient
+            second = beta2 * second + (1 - beta2) * gradient**2
+            dictionary += eta_ii * (velocity / (1 - momentum**(ii+1))) / (np.sqrt(second / (1 - beta2**(ii+1))) + 1e-8)
+        t = timer.stop('update', t)
 
         # homeostasis
         norm = np.sqrt(np.sum(dictionary**2, axis=1)).T
         dictionary /= norm[:, np.newaxis]
-
-        if eta_homeo>0.:
+        t = timer.stop('normalisation', t)
+
+        if eta_homeo>0. and homeo_every > 1 and not P_cum is None:
+            counts += get_P_cum_counts(sparse_code, C=P_cum[-1, :] if C==0. else C,
+                                       nb_quant=P_cum.shape[1], do_sym=do_sym)
+            indx_sketch.append(rng.choice(indx_batch, len(indx_batch)//homeo_every + 1, replace=False))
+            t = timer.stop('update_P_cum', t)
+            if (ii + 1) % homeo_every == 0:
+                eta_homeo_eff = 1 - (1 - eta_homeo_ii)**homeo_every
+                if C==0.:
+                    corr = (X[np.concatenate(indx_sketch), :] @ dictionary.T)
+                    C_vec = get_rescaling(corr, nb_quant=nb_quant, do_sym=do_sym, verbose=verbose)
+                    P_cum[-1, :]= (1 - eta_homeo_eff) * P_cum[-1, :] + eta_homeo_eff * C_vec
+                    t = timer.stop('get_rescaling', t)
+                    P_cum[:-1, :] = (1 - eta_homeo_eff) * P_cum[:-1, :] + eta_homeo_eff * get_P_cum_from_counts(counts)
+                else:
+                    P_cum = (1 - eta_homeo_eff) * P_cum + eta_homeo_eff * get_P_cum_from_counts(counts)
+                counts[:] = 0
+                indx_sketch = []
+                t = timer.stop('update_P_cum', t)
+        elif eta_homeo>0.:
             if P_cum is None:
                 # Update and apply gain
-                mean_var = update_gain(mean_var, sparse_code, eta_homeo, verbose=verbose)
+                mean_var = update_gain(mean_var, sparse_code, eta_homeo_ii, verbose=verbose)
                 gain = mean_var**alpha_homeo
                 gain /= gain.mean()
                 dictionary /= gain[:, np.newaxis]
+                t = timer.stop('update_gain', t)
             else:
                 if C==0.:
                     corr = (this_X @ dictionary.T)
                     C_vec = get_rescaling(corr, nb_quant=nb_quant, do_sym=do_sym, verbose=verbose)
-                    P_cum[-1, :]= (1 - eta_homeo) * P_cum[-1, :] + eta_homeo * C_vec
+                    P_cum[-1, :]= (1 - eta_homeo_ii) * P_cum[-1, :] + eta_homeo_ii * C_vec
+                    t = timer.stop('get_rescaling', t)
                     P_cum[:-1, :] = update_P_cum(P_cum=P_cum[:-1, :],
-                                                 code=sparse_code, eta_homeo=eta_homeo,
+                                                 code=sparse_code, eta_homeo=eta_homeo_ii,
                                                  C=P_cum[-1, :], nb_quant=nb_quant, do_sym=do_sym,
                                                  verbose=verbose)
                 else:
-                    P_cum = update_P_cum(P_cum, sparse_code, eta_homeo,
+                    P_cum = update_P_cum(P_cum, sparse_code, eta_homeo_ii,
                                          nb_quant=nb_quant, verbose=verbose, C=C, do_sym=do_sym)
+                t = timer.stop('update_P_cum', t)
 
         if record_each>0:
-            if ii % int(record_each) == 0:
+            if ii % int(record_each) == 0 and record_online:
+                # the error is scaled as if it were computed on record_num_batches samples
+                error = np.sqrt(residual_energy / moments.n_samples / record_num_batches)
+                record_one = pd.DataFrame([{'kurt':moments.kurtosis,
+                                            'prob_active':moments.prob_active,
+                                            'var':moments.energy,
+                                            'error':error,
+                                            'entropy':moments.entropy,
+                                            'eta':eta_ii}],
+                                            index=[ii])
+                record = pd.concat([record, record_one])
+                moments = MomentAccumulator(n_dictionary)
+                residual_energy = 0.
+                t = timer.stop('record', t)
+            elif ii % int(record_each) == 0:
                 from scipy.stats import kurtosis
-                indx = np.random.permutation(X_train.shape[0])[:record_num_batches]
-                sparse_code_rec = sparse_encode(X_train[indx, :], dictionary, algorithm=method, fit_tol=fit_tol,
+                indx = order[rng.permutation(n_samples)[:record_num_batches]]
+                sparse_code_rec = sparse_encode(X[indx, :], dictionary, algorithm=method, fit_tol=fit_tol,
                                           P_cum=P_cum, do_sym=do_sym, C=C, l0_sparseness=l0_sparseness)
                 # calculation of relative entropy
                 p = np.count_nonzero(sparse_code_rec,axis=0)/ (sparse_code_rec.shape[1])
                 p /= p.sum()
                 rel_ent = np.sum(-p * np.log(p)) / np.log(sparse_code_rec.shape[1])
-                error = np.linalg.norm(X_train[indx, :] - sparse_code_rec @ dictionary)/record_num_batches
+                error = np.linalg.norm(X[indx, :] - sparse_code_rec @ dictionary)/record_num_batches
 
                 record_one = pd.DataFrame([{'kurt':kurtosis(sparse_code_rec, axis=0),
                                             'prob_active':np.mean(np.abs(sparse_code_rec)>0, axis=0),
                                             'var':np.mean(sparse_code_rec**2, axis=0),
                                             'error':error,
-                                            'entropy':rel_ent}],
+                                            'entropy':rel_ent,
+                                            'eta':eta_ii}],
                                             index=[ii])
                 record = pd.concat([record, record_one])
+                t = timer.stop('record', t)
+
+        if snapshot_each>0 and (ii % int(snapshot_each) == 0 or ii == n_iter-1):
+            trajectory.append(ii, dictionary, P_cum)
+            t = timer.stop('snapshot', t)
+
+        timer.end_iteration(ii)
 
     if verbose > 1:
         print('Learning code...', end=' ')
@@ -369,12 +671,205 @@ def dict_learning(X, dictionary=None, P_cum=None, eta=0.02, n_dictionary=2, l0_s
     if verbose > 1:
         dt = (time.time() - t0)
         print('done (total time: % 3is, % 4.1fmn)' % (dt, dt / 60))
+        print(timer.report())
 
     if record_each==0:
         return dictionary, P_cum
     else:
         return dictionary, P_cum, record
 
+def dict_learning_multi(X, dictionaries=None, P_cums=None, eta=0.02, n_dictionary=2, l0_sparseness=10,
+                        n_iter=100, eta_homeo=0.01, alpha_homeo=0.02, batch_size=100, record_each=0,
+                        record_num_batches=1000, verbose=False, C=0., nb_quant=100, do_sym=True, random_state=None,
+                        timer=None):
+    """
+    Learns K dictionaries in lockstep on the same sequence of mini-batches.
+
+    The K configurations differ by their learning parameters (``eta``,
+    ``eta_homeo``, ``alpha_homeo``) and their initial dictionary (e.g. by
+    ``random_state``), which may all be given as sequences of length K. The
+    dictionaries are stacked in an array of shape (K, n_dictionary, n_pixels)
+    such that the correlations of each mini-batch with all atoms, the Gram
+    matrices and the dictionary updates are batched matrix products, while
+    the Matching Pursuit and the homeostasis (gain or ``P_cum``) are
+    computed independently for each configuration.
+
+    Only the defaults of ``dict_learning`` are supported: ``method='mp'``,
+    ``optimizer='sgd'``, constant ``eta`` and ``eta_homeo`` schedules and
+    ``homeo_every=1``, without trajectory. With K=1 and the same global
+    random state, the dictionary and ``P_cum`` are then those of
+    ``dict_learning`` up to the rounding of the batched matrix products.
+
+    Since all configurations see the same mini-batches, the seed only sets
+    the initial dictionaries: the order of the samples is drawn from the
+    global random state, as in ``dict_learning``.
+
+    Parameters
+    ----------
+    X: array of shape (n_samples, n_pixels)
+        Data matrix.
+
+    dictionaries : array of shape (K, n_dictionary, n_pixels),
+        initial values of the dictionaries for warm restart scenarios
+
+    P_cums : list of arrays
+        initial ``P_cum`` of each configuration
+
+    eta, eta_homeo, alpha_homeo : float or sequence of floats
+        see ``dict_learning``
+
+    random_state : int or sequence of ints
+        seeds of the initial dictionaries; by default they are drawn from
+        the global random state
+
+    record_each : int
+        if non-zero, records every record_each step the statistics of the
+        sparse codes of the mini-batches since the previous record (as with
+        ``record_online=True`` in ``dict_learning``)
+
+    Returns
+    -------
+    results : list of tuples
+        ``(dictionary, P_cum)`` or ``(dictionary, P_cum, record)`` for each
+        configuration, as returned by ``dict_learning``.
+
+    """
+    from shl_scripts.shl_encode import mp
+    params = [np.ravel(eta), np.ravel(eta_homeo), np.ravel(alpha_homeo)]
+    if not random_state is None: params.append(np.ravel(random_state))
+    if not dictionaries is None: params.append(np.arange(len(dictionaries)))
+    K = max(param.size for param in params)
+    eta, eta_homeo, alpha_homeo = [np.broadcast_to(param, (K,)) for param in params[:3]]
+
+    if record_each>0:
+        import pandas as pd
+        from shl_scripts.shl_evaluate import MomentAccumulator
+        records = [pd.DataFrame() for k in range(K)]
+        moments = [MomentAccumulator(n_dictionary) for k in range(K)]
+        residual_energy = np.zeros(K)
+
+    if timer is None:
+        timer = StageTimer()
+
+    t0 = time.time()
+    n_samples, n_pixels = X.shape
+
+    if dictionaries is None:
+        if random_state is None:
+            dictionaries = np.random.randn(K, n_dictionary, n_pixels)
+        else:
+            dictionaries = np.array([np.random.RandomState(seed).randn(n_dictionary, n_pixels)
+                                     for seed in np.broadcast_to(random_state, (K,))])
+    dictionaries = np.array(dictionaries, dtype=float)
+    n_dictionary = dictionaries.shape[1]
+    dictionaries /= np.sqrt(np.sum(dictionaries**2, axis=2))[:, :, np.newaxis]
+
+    if verbose == 1:
+        print('[dict_learning_multi]', end=' ')
+
+    n_batches = n_samples // batch_size
+    order = np.random.permutation(n_samples)
+    batches = np.array_split(order, n_batches)
+
+    if P_cums is None: P_cums = [None] * K
+    P_cums = [None if P_cum is None else P_cum.copy() for P_cum in P_cums]
+    gains, mean_vars = np.ones((K, n_dictionary)), np.ones((K, n_dictionary))
+    corr = X[batches[0], :] @ dictionaries.transpose(0, 2, 1)
+    for k in range(K):
+        if alpha_homeo[k]==0:
+            # do the equalitarian homeostasis
+            if P_cums[k] is None:
+                P_cums[k] = np.linspace(0, 1, nb_quant, endpoint=True)[np.newaxis, :] * np.ones((n_dictionary, 1))
+                if C == 0.:
+                    C_vec = get_rescaling(corr[k], nb_quant=nb_quant, do_sym=do_sym, verbose=verbose)
+                    P_cums[k] = np.vstack((P_cums[k], C_vec))
+        else:
+            # do the classical homeostasis
+            P_cums[k] = None
+
+    import itertools
+    batches = itertools.cycle(batches)
+    sparse_codes = np.zeros((K, batch_size, n_dictionary))
+    for ii, indx_batch in zip(range(n_iter), batches):
+        this_X = X[indx_batch, :]
+        dt = (time.time() - t0)
+        if verbose > 0:
+            if ii % int(n_iter//verbose + 1) == 0:
+                print ("Iteration % 3i /  % 3i (elapsed time: % 3is, % 4.1fmn)"
+                       % (ii, n_iter, dt, dt//60))
+
+        # Sparse coding, with the correlations and the Gram matrices of all
+        # configurations computed as batched matrix products
+        t = timer.start()
+        corr = this_X @ dictionaries.transpose(0, 2, 1)
+        grams = dictionaries @ dictionaries.transpose(0, 2, 1)
+        if not sparse_codes.shape[1] == this_X.shape[0]:
+            sparse_codes = np.zeros((K, this_X.shape[0], n_dictionary))
+        for k in range(K):
+            sparse_codes[k] = mp(this_X, dictionaries[k], l0_sparseness=l0_sparseness, P_cum=P_cums[k],
+                                 C=C, do_sym=do_sym, gram_cache=grams[k], corr=corr[k])
+        t = timer.stop('coding', t)
+
+        # Update dictionaries
+        residual = this_X - sparse_codes @ dictionaries
+        if record_each>0:
+            for k in range(K): moments[k].update(sparse_codes[k])
+            residual_energy += np.sum(residual**2, axis=(1, 2))
+        residual /= n_dictionary # divide by the number of features
+        # rounds as the ``'sgd'`` update of ``dict_learning``
+        dictionaries += (eta[:, np.newaxis, np.newaxis] * sparse_codes.transpose(0, 2, 1)) @ residual
+        t = timer.stop('update', t)
+
+        # homeostasis
+        dictionaries /= np.sqrt(np.sum(dictionaries**2, axis=2))[:, :, np.newaxis]
+        t = timer.stop('normalisation', t)
+
+        if np.any(eta_homeo>0.):
+            if C==0.: corr = this_X @ dictionaries.transpose(0, 2, 1)
+            for k in range(K):
+                if not eta_homeo[k]>0.: continue
+                if P_cums[k] is None:
+                    mean_vars[k] = update_gain(mean_vars[k], sparse_codes[k], eta_homeo[k], verbose=verbose)
+                    gains[k] = mean_vars[k]**alpha_homeo[k]
+                    gains[k] /= gains[k].mean()
+                    dictionaries[k] /= gains[k][:, np.newaxis]
+                elif C==0.:
+                    C_vec = get_rescaling(corr[k], nb_quant=nb_quant, do_sym=do_sym, verbose=verbose)
+                    P_cums[k][-1, :]= (1 - eta_homeo[k]) * P_cums[k][-1, :] + eta_homeo[k] * C_vec
+                    P_cums[k][:-1, :] = update_P_cum(P_cum=P_cums[k][:-1, :],
+                                                     code=sparse_codes[k], eta_homeo=eta_homeo[k],
+                                                     C=P_cums[k][-1, :], nb_quant=nb_quant, do_sym=do_sym,
+                                                     verbose=verbose)
+                else:
+                    P_cums[k] = update_P_cum(P_cums[k], sparse_codes[k], eta_homeo[k],
+                                             nb_quant=nb_quant, verbose=verbose, C=C, do_sym=do_sym)
+            t = timer.stop('homeostasis', t)
+
+        if record_each>0 and ii % int(record_each) == 0:
+            for k in range(K):
+                record_one = pd.DataFrame([{'kurt':moments[k].kurtosis,
+                                            'prob_active':moments[k].prob_active,
+                                            'var':moments[k].energy,
+                                            'error':np.sqrt(residual_energy[k] / moments[k].n_samples / record_num_batches),
+                                            'entropy':moments[k].entropy}],
+                                            index=[ii])
+                records[k] = pd.concat([records[k], record_one])
+                moments[k] = MomentAccumulator(n_dictionary)
+            residual_energy[:] = 0.
+            t = timer.stop('record', t)
+
+        timer.end_iteration(ii)
+
+    if verbose > 1:
+        dt = (time.time() - t0)
+        print('done (total time: % 3is, % 4.1fmn)' % (dt, dt / 60))
+        print(timer.report())
+
+    if record_each==0:
+        return [(dictionaries[k], P_cums[k]) for k in range(K)]
+    else:
+        return [(dictionaries[k], P_cums[k], records[k]) for k in range(K)]
+
 def update_gain(gain, code, eta_homeo, verbose=False):
     """Update the estimated variance of coefficients in place.
 
@@ -467,3 +962,30 @@ def get_P_cum(code, C, nb_quant=100, do_sym=True, verbose=False):
         p /= p.sum()
         P_cum[i, :] = np.hstack((0, np.cumsum(p)))
     return P_cum
+
+def get_P_cum_counts(code, C, nb_quant=100, do_sym=True):
+    """
+    Histograms of the rescaled coefficients of each atom, as computed by
+    ``get_P_cum`` (with ``nb_quant-1`` bins between 0 and 1), but with
+    counts instead of frequencies such that they may be accumulated over
+    batches, and computed for all atoms at once.
+
+    Returns
+    -------
+    counts : array of shape (n_dictionary, nb_quant-1)
+
+    """
+    from shl_scripts.shl_encode import rescaling
+    n_samples, nb_filter = code.shape
+    qcode = rescaling(code.copy(), C, do_sym=do_sym)
+    bins = np.minimum((qcode * (nb_quant-1)).astype(np.int64), nb_quant-2)
+    ind = np.arange(nb_filter)[np.newaxis, :] * (nb_quant-1) + bins
+    return np.bincount(ind.ravel(), minlength=nb_filter*(nb_quant-1)).reshape((nb_filter, nb_quant-1))
+
+def get_P_cum_from_counts(counts):
+    """
+    Cumulative distributions of each atom from the counts of ``get_P_cum_counts``.
+
+    """
+    P_cum = np.cumsum(counts, axis=1) / counts.sum(axis=1, keepdims=True)
+    return np.hstack((np.zeros((counts.shape[0], 1)), P_cum))
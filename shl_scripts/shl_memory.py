@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*
+from __future__ import division, print_function, absolute_import
+"""
+Memory budget.
+
+A global budget (in bytes) bounds the working set of the operations whose
+memory grows with the number of samples: the sparse coding of a dataset
+(``shl_encode.sparse_encode``, hence ``SHL.code`` and the record step of
+``dict_learning``) and its evaluation (``shl_evaluate.evaluate``). When a
+budget is set, these operations estimate their working set and process the
+data in chunks small enough to stay under it::
+
+    from shl_scripts.shl_memory import set_memory_budget
+    set_memory_budget('2GB')
+
+The budget may also be set with the environment variable
+``SHL_MEMORY_BUDGET``. ``memory_report`` compares the estimated and the
+measured peak memory of each stage.
+
+"""
+import os
+import warnings
+import numpy as np
+
+_memory_budget = None
+
+UNITS = {'B': 1, 'KB': 2**10, 'MB': 2**20, 'GB': 2**30, 'TB': 2**40}
+
+def parse_size(size):
+    """
+    Converts a size such as ``'512MB'`` or ``'2GB'`` (or a number of bytes) to bytes.
+
+    """
+    if size is None or isinstance(size, (int, float, np.integer)):
+        return size
+    size = size.strip().upper()
+    for unit in sorted(UNITS, key=len, reverse=True):
+        if size.endswith(unit):
+            return int(float(size[:-len(unit)]) * UNITS[unit])
+    return int(float(size))
+
+def set_memory_budget(budget):
+    """
+    Sets the global memory budget, in bytes or as a string such as ``'2GB'``.
+    ``None`` removes the budget.
+
+    """
+    global _memory_budget
+    _memory_budget = parse_size(budget)
+
+def get_memory_budget():
+    """
+    Returns the global memory budget in bytes, or None if there is none.
+
+    """
+    if _memory_budget is None and 'SHL_MEMORY_BUDGET' in os.environ:
+        return parse_size(os.environ['SHL_MEMORY_BUDGET'])
+    return _memory_budget
+
+def estimate_encode(n_samples, n_dictionary, n_pixels, algorithm='mp', gram_cache=None, itemsize=8):
+    """
+    Estimates the working set (in bytes) of ``sparse_encode`` on
+    ``n_samples`` samples, without its output (nor the data, which is not
+    copied).
+
+    The Gram matrix (or the cached rows of a ``GramCache``) does not depend
+    on the number of samples, whereas the correlations of each sample with
+    all atoms do.
+
+    """
+    if algorithm == 'mp' and not gram_cache is None:
+        n_rows = gram_cache if isinstance(gram_cache, (int, np.integer)) else gram_cache.max_rows
+        fixed = min(n_rows, n_dictionary) * n_dictionary
+    else:
+        fixed = n_dictionary**2
+    # temporaries of the selection of one sample (copy, absolute value, quantiles)
+    fixed += 4 * n_dictionary
+    # the correlations with all atoms and, when encoding in chunks, the code
+    # of a chunk before it is copied to the output
+    per_sample = 2 * n_dictionary
+    if algorithm in ['omp', 'lars', 'lasso_lars']:
+        # the transposed correlations and the solver's copies
+        per_sample += 2 * n_dictionary
+    return itemsize * (fixed + per_sample * n_samples)
+
+def estimate_evaluate(n_samples, n_dictionary, n_pixels, nb_bins=64, itemsize=8):
+    """
+    Estimates the working set (in bytes) of ``shl_evaluate.evaluate`` on
+    ``n_samples`` samples (one chunk).
+
+    """
+    # the sparse code is kept while the statistics are computed, which need
+    # either the reconstruction, the residual and the squared data or the two
+    # centered temporaries of the moments
+    encode = estimate_encode(n_samples, n_dictionary, n_pixels, itemsize=itemsize)
+    statistics = itemsize * n_samples * max(3 * n_pixels, 2 * n_dictionary)
+    # histograms (and their increment)
+    fixed = 2 * n_dictionary * nb_bins
+    return itemsize * (fixed + n_dictionary * n_samples) + max(encode, statistics)
+
+def estimate_record(n_samples, n_dictionary, n_pixels, chunk_size=None, itemsize=8):
+    """
+    Estimates the working set (in bytes) of the record step of
+    ``dict_learning`` which encodes ``n_samples`` samples (in chunks of
+    ``chunk_size`` samples).
+
+    """
+    # the sparse code and the selected samples are kept while the error
+    # (reconstruction and residual) and the kurtosis (centered temporaries)
+    # are computed
+    if chunk_size is None: chunk_size = n_samples
+    encode = estimate_encode(chunk_size, n_dictionary, n_pixels, itemsize=itemsize)
+    statistics = itemsize * n_samples * max(2 * n_pixels, 3 * n_dictionary)
+    return itemsize * (n_dictionary + n_pixels) * n_samples + max(encode, statistics)
+
+def get_chunk_size(estimate, n_samples, budget=None, reserved=0, default=None, min_chunk=1):
+    """
+    Largest number of samples (up to ``n_samples``) such that the working set
+    ``estimate(chunk_size)`` and the ``reserved`` bytes (e.g. the output) fit
+    in the budget.
+
+    Parameters
+    ----------
+    estimate : callable
+        Working set as a function of the number of samples, assumed affine.
+
+    budget : int
+        By default, the global budget. If there is no budget, ``default``
+        (or ``n_samples``) is returned.
+
+    Returns
+    -------
+    chunk_size : int
+
+    """
+    if budget is None: budget = get_memory_budget()
+    if budget is None: return n_samples if default is None else default
+    budget = parse_size(budget)
+    fixed = estimate(0)
+    per_sample = max(estimate(1) - fixed, 1)
+    chunk_size = int((budget - reserved - fixed) // per_sample)
+    if chunk_size < min_chunk:
+        warnings.warn('the memory budget of {} bytes is too small: {} bytes are needed for {} sample(s)'.format(
+                      budget, reserved + estimate(min_chunk), min_chunk))
+        chunk_size = min_chunk
+    return int(min(chunk_size, n_samples))
+
+def measure_peak(func, *args, **kwargs):
+    """
+    Runs ``func`` and returns its result with the peak memory (in bytes)
+    allocated during the call, as traced by ``tracemalloc``.
+
+    """
+    import tracemalloc
+    tracing = tracemalloc.is_tracing()
+    if not tracing: tracemalloc.start()
+    tracemalloc.reset_peak()
+    baseline = tracemalloc.get_traced_memory()[0]
+    try:
+        result = func(*args, **kwargs)
+        peak = tracemalloc.get_traced_memory()[1] - baseline
+    finally:
+        if not tracing: tracemalloc.stop()
+    return result, peak
+
+def memory_report(n_samples=4096, n_dictionary=324, n_pixels=256, l0_sparseness=15, budget=None,
+                  record_num_batches=1000, seed=42, verbose=0):
+    """
+    Compares the estimated and the measured peak memory of the encoding, the
+    evaluation and the record step on synthetic data, under the given budget
+    (by default, the global one).
+
+    Returns
+    -------
+    results : pandas DataFrame
+        For each stage: the chunk size chosen, the estimated and the measured
+        peak (in MB, including the output) and their ratio.
+
+    """
+    import pandas as pd
+    from shl_scripts.shl_encode import sparse_encode
+    from shl_scripts.shl_evaluate import evaluate
+    from shl_scripts.shl_benchmark import get_synthetic_data
+    budget = get_memory_budget() if budget is None else parse_size(budget)
+    X, dictionary, sparse_vector = get_synthetic_data(n_samples, n_dictionary, l0_sparseness,
+                                                      n_pixels=n_pixels, seed=seed)
+
+    class Dico:
+        # a minimal stand-in for a learned SparseHebbianLearning
+        def __init__(self, dictionary):
+            self.dictionary, self.P_cum, self.fit_algorithm = dictionary, None, 'mp'
+        def transform(self, X, algorithm=None, l0_sparseness=None):
+            return sparse_encode(X, self.dictionary, l0_sparseness=l0_sparseness)
+
+    from scipy.stats import kurtosis
+    def record():
+        # as in the record step of ``dict_learning``
+        indx = np.random.permutation(n_samples)[:record_num_batches]
+        sparse_code = sparse_encode(X[indx, :], dictionary, l0_sparseness=l0_sparseness)
+        error = np.linalg.norm(X[indx, :] - sparse_code @ dictionary)
+        return kurtosis(sparse_code, axis=0), np.mean(sparse_code**2, axis=0), error
+
+    n_record = min(record_num_batches, n_samples)
+    encode = lambda n: estimate_encode(n, n_dictionary, n_pixels)
+    # for each stage: the number of samples processed in chunks, the chunk
+    # size, the memory needed besides the chunks and the function to measure
+    stages = {'encode': (n_samples, get_chunk_size(encode, n_samples, budget=budget,
+                                                   reserved=8 * n_samples * n_dictionary),
+                         lambda chunk_size: 8 * n_samples * n_dictionary + encode(chunk_size),
+                         lambda: sparse_encode(X, dictionary, l0_sparseness=l0_sparseness)),
+              'evaluate': (n_samples, get_chunk_size(lambda n: estimate_evaluate(n, n_dictionary, n_pixels),
+                                                     n_samples, budget=budget, default=1024),
+                           lambda chunk_size: estimate_evaluate(chunk_size, n_dictionary, n_pixels),
+                           lambda: evaluate(X, Dico(dictionary), chunk_size=None, l0_sparseness=l0_sparseness)),
+              'record': (n_record, get_chunk_size(encode, n_record, budget=budget,
+                                                  reserved=8 * n_record * (n_dictionary + n_pixels)),
+                         lambda chunk_size: estimate_record(n_record, n_dictionary, n_pixels, chunk_size=chunk_size),
+                         record)}
+    previous, rows = _memory_budget, []
+    set_memory_budget(budget)
+    try:
+        for stage, (n, chunk_size, estimate, func) in stages.items():
+            estimated = estimate(chunk_size)
+            result, measured = measure_peak(func)
+            row = {'stage':stage, 'n_samples':n, 'chunk_size':chunk_size,
+                   'estimated_MB':estimated / 2**20, 'measured_MB':measured / 2**20,
+                   'ratio':measured / estimated}
+            if verbose: print('{stage:10s} chunk_size={chunk_size:6d} estimated={estimated_MB:8.2f}MB measured={measured_MB:8.2f}MB'.format(**row))
+            rows.append(row)
+    finally:
+        set_memory_budget(previous)
+    return pd.DataFrame(rows)
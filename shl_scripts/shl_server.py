@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*
+from __future__ import division, print_function, absolute_import
+"""
+Local encoding service.
+
+A learned dictionary (and its ``P_cum``) is loaded once and patches sent by
+other processes over a Unix or TCP socket are encoded by batches: requests
+arriving within ``max_delay`` seconds of the first one are coalesced into a
+single call to the encoder (up to ``max_batch`` samples), and each request
+gets back its own rows of the sparse code.
+
+Messages are framed as two big-endian uint32 (the lengths of a JSON header
+and of a raw payload) followed by the header and the payload. The header
+of an array gives its ``dtype`` and ``shape``::
+
+    server = serve_in_thread(dico, '/tmp/shl.sock')
+    with EncodeClient('/tmp/shl.sock') as client:
+        sparse_code = client.encode(patches)
+        print(client.stats())
+    server.stop()
+
+or from the command line::
+
+    python -m shl_scripts.shl_server data_cache/my_dico.pkl --unix /tmp/shl.sock
+
+"""
+import json
+import time
+import struct
+import asyncio
+import numpy as np
+
+FRAME = struct.Struct('!II')
+
+def pack_message(header, array=None):
+    """
+    Frames a JSON header and an optional array as bytes.
+
+    """
+    header = dict(header)
+    payload = b''
+    if not array is None:
+        array = np.ascontiguousarray(array)
+        header.update(dtype=array.dtype.str, shape=array.shape)
+        payload = array.tobytes()
+    header = json.dumps(header).encode()
+    return FRAME.pack(len(header), len(payload)) + header + payload
+
+def unpack_message(header, payload):
+    """
+    Decodes a header and a payload as framed by ``pack_message``.
+
+    """
+    header = json.loads(header.decode())
+    array = None
+    if 'dtype' in header:
+        array = np.frombuffer(payload, dtype=header['dtype']).reshape(header['shape'])
+    return header, array
+
+async def read_message(reader):
+    len_header, len_payload = FRAME.unpack(await reader.readexactly(FRAME.size))
+    header = await reader.readexactly(len_header)
+    payload = await reader.readexactly(len_payload)
+    return unpack_message(header, payload)
+
+def recv_exactly(sock, n):
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk: raise ConnectionError('connection closed')
+        buf += chunk
+    return bytes(buf)
+
+def recv_message(sock):
+    len_header, len_payload = FRAME.unpack(recv_exactly(sock, FRAME.size))
+    header = recv_exactly(sock, len_header)
+    return unpack_message(header, recv_exactly(sock, len_payload))
+
+def load_dico(fname):
+    """
+    Loads a ``SparseHebbianLearning`` pickled by ``SHL.learn_dico``.
+
+    """
+    import pickle
+    with open(fname, 'rb') as fp:
+        return pickle.load(fp)
+
+class EncodeServer:
+    """Encoding server with micro-batching.
+
+    Parameters
+    ----------
+    dico : SparseHebbianLearning
+        A learned dictionary.
+
+    address : str or tuple
+        Path of a Unix socket, or ``(host, port)`` of a TCP socket (port 0
+        picks a free port, see ``address`` once started).
+
+    max_batch : int
+        Maximal number of samples encoded at once.
+
+    max_delay : float
+        Maximal time (in seconds) a request waits for others to be batched with.
+
+    l0_sparseness : int
+        Number of atoms, by default that of the dictionary.
+
+    n_latencies : int
+        Number of recent requests kept to compute latency percentiles.
+
+    """
+    def __init__(self, dico, address, max_batch=1024, max_delay=0.002, l0_sparseness=None,
+                 n_latencies=10000, verbose=0):
+        from collections import deque
+        from shl_scripts.shl_encode import GramCache
+        self.dico = dico
+        self.address = address
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.l0_sparseness = l0_sparseness
+        self.verbose = verbose
+        # rows of the Gram matrix are computed once and shared by all batches
+        self.gram_cache = GramCache(dico.dictionary, max_rows=dico.dictionary.shape[0])
+        self.latencies = deque(maxlen=n_latencies)
+        self.n_requests, self.n_samples, self.n_batches = 0, 0, 0
+        self.t_start = None
+        self.server = None
+
+    def encode(self, X):
+        return self.dico.transform(X, l0_sparseness=self.l0_sparseness, gram_cache=self.gram_cache)
+
+    async def start(self):
+        self.queue = asyncio.Queue()
+        self.t_start = time.time()
+        if isinstance(self.address, str):
+            self.server = await asyncio.start_unix_server(self.handle, path=self.address)
+        else:
+            self.server = await asyncio.start_server(self.handle, *self.address)
+            self.address = self.server.sockets[0].getsockname()[:2]
+        self.batcher = asyncio.ensure_future(self.batch_loop())
+        if self.verbose: print('Encoding server listening on', self.address)
+        return self
+
+    async def stop_async(self):
+        self.batcher.cancel()
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    header, X = await read_message(reader)
+                except asyncio.IncompleteReadError:
+                    break
+                if header.get('op') == 'stats':
+                    writer.write(pack_message(self.stats()))
+                elif X is None or not X.ndim == 2 or not X.shape[1] == self.dico.dictionary.shape[1]:
+                    writer.write(pack_message({'error': 'expected an array of shape (n_samples, {})'.format(
+                                                        self.dico.dictionary.shape[1])}))
+                else:
+                    future = asyncio.get_running_loop().create_future()
+                    await self.queue.put((X, future, time.time()))
+                    try:
+                        sparse_code = await future
+                        writer.write(pack_message({}, sparse_code))
+                    except Exception as e:
+                        writer.write(pack_message({'error': repr(e)}))
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            requests = [await self.queue.get()]
+            n_samples = requests[0][0].shape[0]
+            deadline = requests[0][2] + self.max_delay
+            while n_samples < self.max_batch:
+                timeout = deadline - time.time()
+                try:
+                    # requests already queued (e.g. during the previous batch) are
+                    # taken even if the deadline has passed
+                    if timeout <= 0 or not self.queue.empty():
+                        request = self.queue.get_nowait()
+                    else:
+                        request = await asyncio.wait_for(self.queue.get(), timeout)
+                except (asyncio.QueueEmpty, asyncio.TimeoutError):
+                    break
+                requests.append(request)
+                n_samples += request[0].shape[0]
+            batch = np.vstack([X for X, future, t0 in requests])
+            try:
+                # encoding runs in a thread such that the loop keeps accepting requests
+                sparse_code = await loop.run_in_executor(None, self.encode, batch)
+            except Exception as e:
+                for X, future, t0 in requests:
+                    if not future.done(): future.set_exception(e)
+                continue
+            i_start, t1 = 0, time.time()
+            for X, future, t0 in requests:
+                if not future.done(): future.set_result(sparse_code[i_start:i_start+X.shape[0]])
+                i_start += X.shape[0]
+                self.latencies.append(t1 - t0)
+            self.n_requests += len(requests)
+            self.n_samples += batch.shape[0]
+            self.n_batches += 1
+
+    def stats(self):
+        """
+        Throughput (samples per second since the start) and percentiles of
+        the latency (in ms) of recent requests.
+
+        """
+        stats = dict(n_requests=self.n_requests, n_samples=self.n_samples, n_batches=self.n_batches,
+                     mean_batch=self.n_samples / max(self.n_batches, 1),
+                     throughput=self.n_samples / (time.time() - self.t_start))
+        if len(self.latencies) > 0:
+            latencies = np.array(self.latencies) * 1000
+            for q in (50, 90, 99):
+                stats['latency_p{}'.format(q)] = float(np.percentile(latencies, q))
+        return stats
+
+    def stop(self):
+        """
+        Stops a server started by ``serve_in_thread``.
+
+        """
+        asyncio.run_coroutine_threadsafe(self.stop_async(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+def serve(dico, address, **kwargs):
+    """
+    Runs an ``EncodeServer`` until interrupted.
+
+    """
+    async def main():
+        server = await EncodeServer(dico, address, **kwargs).start()
+        async with server.server:
+            await server.server.serve_forever()
+    asyncio.run(main())
+
+def serve_in_thread(dico, address, **kwargs):
+    """
+    Starts an ``EncodeServer`` in a background thread and returns it once it
+    listens, e.g. for tests on localhost. Use its ``stop`` method to shut it down.
+
+    """
+    import threading
+    server = EncodeServer(dico, address, **kwargs)
+    server.loop = asyncio.new_event_loop()
+    server.thread = threading.Thread(target=server.loop.run_forever, daemon=True)
+    server.thread.start()
+    asyncio.run_coroutine_threadsafe(server.start(), server.loop).result()
+    return server
+
+class EncodeClient:
+    """Blocking client of an ``EncodeServer``.
+
+    Parameters
+    ----------
+    address : str or tuple
+        Path of a Unix socket or ``(host, port)``.
+
+    """
+    def __init__(self, address):
+        import socket
+        if isinstance(address, str):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            address = tuple(address)
+        self.sock.connect(address)
+
+    def request(self, header, array=None):
+        self.sock.sendall(pack_message(header, array))
+        header, array = recv_message(self.sock)
+        if 'error' in header: raise RuntimeError(header['error'])
+        return header, array
+
+    def encode(self, X):
+        """
+        Returns the sparse code of the patches ``X`` of shape (n_samples, n_pixels).
+
+        """
+        return self.request({}, np.asarray(X, dtype=float))[1]
+
+    def stats(self):
+        return self.request({'op': 'stats'})[0]
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Serves the encoding of patches with a learned dictionary.')
+    parser.add_argument('dico', help='pickled dictionary, as cached by SHL.learn_dico')
+    parser.add_argument('--unix', default=None, help='path of a Unix socket')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--max-batch', type=int, default=1024)
+    parser.add_argument('--max-delay', type=float, default=0.002, help='in seconds')
+    parser.add_argument('--l0-sparseness', type=int, default=None)
+    args = parser.parse_args()
+    address = args.unix if args.unix else (args.host, args.port)
+    serve(load_dico(args.dico), address, max_batch=args.max_batch, max_delay=args.max_delay,
+          l0_sparseness=args.l0_sparseness, verbose=1)
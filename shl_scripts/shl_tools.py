@@ -4,12 +4,60 @@ from __future__ import division, print_function, absolute_import
 import time
 import numpy as np
 from shl_scripts.shl_encode import sparse_encode
-import matplotlib
-import matplotlib.pyplot as plt
+# matplotlib, pandas and seaborn are only imported by the plotting functions
+# such that the package imports with NumPy only
 
 toolbar_width = 40
 
 
+def get_figure(figsize, headless=False, **kwargs):
+    """
+    Returns a new figure. If ``headless``, the figure is created with the Agg
+    canvas without going through pyplot, such that it does not depend on (nor
+    modify) pyplot's global state and is safe to use in worker processes.
+
+    """
+    if headless:
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        fig = Figure(figsize=figsize, **kwargs)
+        FigureCanvasAgg(fig)
+        return fig
+    import matplotlib.pyplot as plt
+    return plt.figure(figsize=figsize, **kwargs)
+
+def get_slip(height=256, width=256, datapath='database/', seed=None, n_image=200):
+    """
+    Returns the SLIP ``Image`` object used to load and whiten images of size
+    (height, width), with the whitening parameters used to extract the
+    training patches in ``get_data``.
+
+    """
+    from SLIP import Image
+    return Image({'N_X':height, 'N_Y':width,
+            'white_n_learning' : 0,
+            'seed': seed,
+            'white_N' : .07,
+            'white_N_0' : .0, # olshausen = 0.
+            'white_f_0' : .4, # olshausen = 0.2
+            'white_alpha' : 1.4,
+            'white_steepness' : 4.,
+            'datapath': datapath,
+            'do_mask': True,
+            'N_image': n_image})
+
+def _extract_patches(slip, name_database, filename, croparea, patch_size, max_patches, patch_norm):
+    # whitening
+    image, filename_, croparea_ = slip.patch(name_database, filename=filename, croparea=croparea, center=False)#, seed=seed)
+    image = slip.whitening(image)
+    # Extract all reference patches and ravel them
+    data_ = slip.extract_patches_2d(image, patch_size, N_patches=int(max_patches))#, seed=seed)
+    data_ = data_.reshape(data_.shape[0], -1)
+    data_ -= np.mean(data_, axis=0)
+    if patch_norm:
+        data_ /= np.std(data_, axis=0)
+    return data_
+
 def touch(filename):
     open(filename, 'w').close()
 
@@ -17,28 +65,20 @@ def touch(filename):
 def get_data(height=256, width=256, n_image=200, patch_size=(12,12),
             datapath='database/', name_database='serre07_distractors',
             max_patches=1024, seed=None, patch_norm=True, verbose=0,
-            data_cache='/tmp/data_cache', matname=None):
+            data_cache='/tmp/data_cache', matname=None, n_jobs=None, backend=None):
     """
     Extract data:
 
     Extract from a given database composed of image of size (height, width) a
     series a random patches.
 
+    Images are processed serially unless ``n_jobs`` or a ``backend`` (see
+    ``shl_backend``) are given.
+
     """
     if matname is None:
         # Load natural images and extract patches
-        from SLIP import Image
-        slip = Image({'N_X':height, 'N_Y':width,
-                'white_n_learning' : 0,
-                'seed': seed,
-                'white_N' : .07,
-                'white_N_0' : .0, # olshausen = 0.
-                'white_f_0' : .4, # olshausen = 0.2
-                'white_alpha' : 1.4,
-                'white_steepness' : 4.,
-                'datapath': datapath,
-                'do_mask': True,
-                'N_image': n_image})
+        slip = get_slip(height=height, width=width, datapath=datapath, seed=seed, n_image=n_image)
 
         if verbose:
             import sys
@@ -49,25 +89,25 @@ def get_data(height=256, width=256, n_image=200, patch_size=(12,12),
             t0 = time.time()
         import os
         imagelist = slip.make_imagelist(name_database=name_database)#, seed=seed)
-        for filename, croparea in imagelist:
-            # whitening
-            image, filename_, croparea_ = slip.patch(name_database, filename=filename, croparea=croparea, center=False)#, seed=seed)
-            image = slip.whitening(image)
-            # Extract all reference patches and ravel them
-            data_ = slip.extract_patches_2d(image, patch_size, N_patches=int(max_patches))#, seed=seed)
-            data_ = data_.reshape(data_.shape[0], -1)
-            data_ -= np.mean(data_, axis=0)
-            if patch_norm:
-                data_ /= np.std(data_, axis=0)
+        filenames, cropareas = zip(*imagelist)
+        n = len(imagelist)
+        from shl_scripts.shl_backend import Backend, get_backend
+        if n_jobs is None and backend is None:
+            backend = Backend('serial')
+        else:
+            backend = get_backend(backend, n_jobs=n_jobs, default='processes')
+        # images are whitened and sampled independently, hence in parallel if asked
+        patches = backend.imap(_extract_patches, [slip]*n, [name_database]*n, filenames, cropareas,
+                               [patch_size]*n, [max_patches]*n, [patch_norm]*n)
+        data = []
+        for filename, data_ in zip(filenames, patches):
             # collect everything as a matrix
-            try:
-                data = np.vstack((data, data_))
-            except Exception:
-                data = data_.copy()
+            data.append(data_)
             if verbose:
                 # update the bar
                 sys.stdout.write(filename + ", ")
                 sys.stdout.flush()
+        data = np.vstack(data)
         if verbose:
             dt = time.time() - t0
             sys.stdout.write("\n")
@@ -87,7 +127,7 @@ def get_data(height=256, width=256, n_image=200, patch_size=(12,12),
                                     patch_size=patch_size, datapath=datapath,
                                     name_database=name_database, max_patches=max_patches,
                                     seed=seed, patch_norm=patch_norm, verbose=verbose,
-                                    matname=None)
+                                    matname=None, n_jobs=n_jobs, backend=backend)
                     np.save(fmatname + '_data.npy', data)
                 finally:
                     try:
@@ -104,22 +144,62 @@ def get_data(height=256, width=256, n_image=200, patch_size=(12,12),
     return data
 
 def generate_sparse_vector(N_image, l0_sparseness, nb_dico, N_boost=0,
-                           K_boost=2., C_0=3., rho_coeff=.85, seed=420, do_sym=False):
-    np.random.seed(seed)
-    coeff = np.zeros((N_image, nb_dico))
-    for i in range(N_image):
-        ind = np.random.permutation(np.arange(nb_dico))[:l0_sparseness] # indices of non-zero coefficients
-        coeff[i, ind] = C_0 * rho_coeff**(np.random.rand(l0_sparseness)*l0_sparseness) # activities
-        coeff[i, :N_boost] *= K_boost  # perturbation
-        if do_sym:
-            coeff[i, ind] *= np.sign(np.random.randn(l0_sparseness))
+                           K_boost=2., C_0=3., rho_coeff=.85, seed=420, do_sym=False, rng=None):
+    """
+    Generates ``N_image`` sparse vectors of length ``nb_dico`` with
+    ``l0_sparseness`` non-zero coefficients each, drawn as
+    ``C_0 * rho_coeff**(U * l0_sparseness)`` with U uniform in [0, 1). The
+    first ``N_boost`` atoms are boosted by a factor ``K_boost`` and, if
+    ``do_sym``, coefficients get a random sign.
+
+    All rows are generated at once. The supports are the ``l0_sparseness``
+    smallest of random keys (a random subset, as with a permutation) and the
+    random numbers come from a ``np.random.Generator``, such that the global
+    random state is left untouched. Pass ``rng`` to continue a stream (see
+    ``generate_sparse_blocks``), otherwise a generator is seeded with ``seed``.
 
+    """
+    if l0_sparseness > nb_dico:
+        raise ValueError('l0_sparseness ({}) cannot exceed the number of atoms ({}).'.format(
+                         l0_sparseness, nb_dico))
+    if rng is None:
+        rng = np.random.default_rng(seed)
+    coeff = np.zeros((N_image, nb_dico))
+    if N_image == 0 or l0_sparseness == 0:
+        return coeff
+    # indices of non-zero coefficients
+    keys = rng.random((N_image, nb_dico))
+    ind = np.argpartition(keys, l0_sparseness - 1, axis=1)[:, :l0_sparseness]
+    # activities
+    values = C_0 * rho_coeff**(rng.random((N_image, l0_sparseness))*l0_sparseness)
+    if do_sym:
+        values *= np.sign(rng.standard_normal((N_image, l0_sparseness)))
+    np.put_along_axis(coeff, ind, values, axis=1)
+    coeff[:, :N_boost] *= K_boost  # perturbation
     return coeff
 
+def generate_sparse_blocks(N_image, l0_sparseness, nb_dico, block_size=4096, seed=420, **kwargs):
+    """
+    Lazily yields blocks of (at most) ``block_size`` sparse vectors from one
+    random stream, for a total of ``N_image`` vectors (or forever if
+    ``N_image`` is None). Other arguments are those of
+    ``generate_sparse_vector``.
+
+    """
+    rng = np.random.default_rng(seed)
+    n_done = 0
+    while N_image is None or n_done < N_image:
+        n_block = block_size if N_image is None else min(block_size, N_image - n_done)
+        yield generate_sparse_vector(n_block, l0_sparseness, nb_dico, rng=rng, **kwargs)
+        n_done += n_block
+
 
 def compute_RMSE(data, dico):
     """
     Compute the Root Mean Square Error between the image and it's encoded representation
+
+    To compute this and other metrics while encoding the data only once, see
+    ``shl_evaluate.evaluate``.
     """
     a = dico.transform(data)
     residual = data - a @ dico.dictionary
@@ -151,54 +231,147 @@ def compute_kurto(data, dico):
     return kurto
 
 # To adapt with shl_exp
-def show_dico_in_order(shl_exp, dico, data=None, title=None, fname=None, dpi=200, **kwargs):
+def show_dico_in_order(shl_exp, dico, data=None, sparse_code=None, evaluation=None, title=None, fname=None, dpi=200, **kwargs):
     """
     Displays the dictionary of filter in order of probability of selection.
     Filter which are selected more often than others are located at the end
 
+    If the ``sparse_code`` of the data or its ``evaluation`` (see
+    ``shl_evaluate.evaluate``) is already known, it is used instead of coding
+    the data again.
+
     """
-    return show_dico(shl_exp, dico=dico, data=data, order=True, title=title, fname=fname, dpi=dpi, **kwargs)
+    return show_dico(shl_exp, dico=dico, data=data, sparse_code=sparse_code, evaluation=evaluation, order=True, title=title, fname=fname, dpi=dpi, **kwargs)
 
-def show_dico(shl_exp, dico,  data=None, order=False, title=None, fname=None, dpi=200, **kwargs):
+def get_montage(dictionary, indices=None, pad=1):
+    """
+    Tiles the atoms of a dictionary into one image.
+
+    Each atom is reshaped as a square patch and normalised by its maximum
+    absolute value (such that it spans [-1, 1]) and the tiles are arranged
+    on a grid of ``ceil(sqrt(n_dictionary))`` columns, separated by ``pad``
+    pixels. The padding (and any unused tile) is set to NaN.
+
+    Parameters
+    ----------
+    dictionary : array of shape (n_dictionary, n_pixels)
+
+    indices : sequence of int
+        Order in which the atoms are displayed (defaults to the dictionary's).
+
+    Returns
+    -------
+    montage : array of shape (n_rows*(dim_patch+pad)+pad, n_cols*(dim_patch+pad)+pad)
+
+    """
+    if indices is None:
+        indices = np.arange(dictionary.shape[0])
+    atoms = dictionary[np.asarray(indices), :]
+    n_atoms = atoms.shape[0]
+    dim_patch = int(np.sqrt(atoms.shape[1]))
+    cmax = np.max(np.abs(atoms), axis=1)
+    cmax[cmax == 0] = 1.
+    atoms = (atoms / cmax[:, np.newaxis]).reshape((n_atoms, dim_patch, dim_patch))
+
+    n_cols = int(np.ceil(np.sqrt(n_atoms)))
+    n_rows = int(np.ceil(n_atoms / n_cols))
+    step = dim_patch + pad
+    montage = np.full((n_rows, n_cols, step, step), np.nan)
+    tiles = montage.reshape((n_rows * n_cols, step, step))
+    tiles[:n_atoms, pad:, pad:] = atoms
+    montage = montage.transpose((0, 2, 1, 3)).reshape((n_rows * step, n_cols * step))
+    # close the grid on the bottom and on the right
+    return np.pad(montage, ((0, pad), (0, pad)), mode='constant', constant_values=np.nan)
+
+def write_png(fname, image, zoom=1):
+    """
+    Writes an image with values in [-1, 1] as an 8-bit grayscale PNG without
+    using matplotlib. As with the ``gray_r`` colormap of ``show_dico``, -1
+    is white and 1 is black; NaN values are white.
+
+    """
+    import zlib
+    import struct
+    gray = np.nan_to_num((1. - np.clip(image, -1., 1.)) / 2. * 255., nan=255.).astype(np.uint8)
+    if zoom > 1:
+        gray = gray.repeat(zoom, axis=0).repeat(zoom, axis=1)
+    height, width = gray.shape
+    # each scanline starts with the filter type (0: none)
+    raw = np.hstack((np.zeros((height, 1), dtype=np.uint8), gray)).tobytes()
+    def chunk(tag, data):
+        return (struct.pack('>I', len(data)) + tag + data
+                + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff))
+    with open(fname, 'wb') as fp:
+        fp.write(b'\x89PNG\r\n\x1a\n')
+        fp.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)))
+        fp.write(chunk(b'IDAT', zlib.compress(raw)))
+        fp.write(chunk(b'IEND', b''))
+
+def show_dico(shl_exp, dico,  data=None, sparse_code=None, evaluation=None, order=False, title=None, fname=None, dpi=200,
+              montage=True, pad=1, headless=False, **kwargs):
     """
     display the dictionary in a random order
+
+    By default, all atoms are tiled in one image (see ``get_montage``) drawn
+    with a single ``imshow``. Set ``montage=False`` to draw one subplot per
+    atom.
     """
+    import matplotlib.figure
+    import matplotlib.cm as cm
     subplotpars = matplotlib.figure.SubplotParams(left=0., right=1., bottom=0., top=1., wspace=0.05, hspace=0.05,)
-    fig = plt.figure(figsize=(10, 10), subplotpars=subplotpars)
+    fig = get_figure((10, 10), headless=headless, subplotpars=subplotpars)
 
     dim_graph = dico.dictionary.shape[0]
     if order:
-        sparse_code = shl_exp.code(data=data, dico=dico)
-        res_lst = np.count_nonzero(sparse_code, axis=0)
+        if not evaluation is None:
+            res_lst = evaluation.counts
+        else:
+            if sparse_code is None:
+                sparse_code = shl_exp.code(data=data, dico=dico)
+            res_lst = np.count_nonzero(sparse_code, axis=0)
         indices = res_lst.argsort()
     else:
         indices = range(dim_graph)
     dim_patch = int(np.sqrt(dico.dictionary.shape[1]))
 
-    for i in range(dim_graph):
-        ax = fig.add_subplot(np.sqrt(dim_graph), np.sqrt(dim_graph), i + 1)
-        dico_to_display = dico.dictionary[indices[i]]
-        cmax = np.max(np.abs(dico_to_display))
-        ax.imshow(dico_to_display.reshape((dim_patch,dim_patch)),
-                     cmap=plt.cm.gray_r, vmin=-cmax, vmax=+cmax,
-                     interpolation='nearest')
+    if montage:
+        cmap = cm.gray_r.copy()
+        cmap.set_bad('white')
+        ax = fig.add_subplot(111)
+        ax.imshow(get_montage(dico.dictionary, indices=indices, pad=pad),
+                  cmap=cmap, vmin=-1, vmax=1, interpolation='nearest')
         ax.set_xticks(())
         ax.set_yticks(())
+        ax.axis('off')
+    else:
+        for i in range(dim_graph):
+            ax = fig.add_subplot(int(np.sqrt(dim_graph)), int(np.sqrt(dim_graph)), i + 1)
+            dico_to_display = dico.dictionary[indices[i]]
+            cmax = np.max(np.abs(dico_to_display))
+            ax.imshow(dico_to_display.reshape((dim_patch,dim_patch)),
+                         cmap=cm.gray_r, vmin=-cmax, vmax=+cmax,
+                         interpolation='nearest')
+            ax.set_xticks(())
+            ax.set_yticks(())
     if title is not None:
         fig.suptitle(title, fontsize=12, backgroundcolor = 'white', color = 'k')
     if not fname is None: fig.savefig(fname, dpi=dpi)
     return fig, ax
 
-def plot_coeff_distribution(dico, data, title=None,algorithm=None,fname=None):
+def plot_coeff_distribution(dico, data, title=None,algorithm=None,fname=None, evaluation=None):
     """
     Plot the coeff distribution of a given dictionary
     """
+    import matplotlib.pyplot as plt
 
-    if algorithm is not None :
-        sparse_code = shl_encode.sparse_encode(data,dico.dictionary,algorithm=algorithm)
+    if evaluation is not None :
+        res_lst = evaluation.counts
     else :
-        sparse_code= dico.transform(data)
-    res_lst=np.count_nonzero(sparse_code,axis=0)
+        if algorithm is not None :
+            sparse_code = sparse_encode(data,dico.dictionary,algorithm=algorithm)
+        else :
+            sparse_code= dico.transform(data)
+        res_lst=np.count_nonzero(sparse_code,axis=0)
     import pandas as pd
     import seaborn as sns
     df = pd.DataFrame(res_lst, columns=['Coeff'])
@@ -229,29 +402,41 @@ def bins_step(mini, maxi, nb_step):
     out.append(a)
     return out
 
-def plot_dist_max_min(shl_exp, dico, data=None, algorithm=None, fname=None):
+def plot_dist_max_min(shl_exp, dico, data=None, algorithm=None, fname=None, evaluation=None):
     """
     plot the coefficient distribution of the filter which is selected the more,
     and the one which is selected the less
+
+    If the ``evaluation`` of the data is given, the histograms it accumulated
+    are used instead of coding the data again.
     """
-    if (algorithm is not None) and (data is not None)  :
-        sparse_code = shl_encode.sparse_encode(data, dico.dictionary,algorithm=algorithm)
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    if evaluation is None :
+        if (algorithm is not None) and (data is not None)  :
+            sparse_code = sparse_encode(data, dico.dictionary,algorithm=algorithm)
+        else :
+            sparse_code = shl_exp.coding
+        nb_filter_selection=np.count_nonzero(sparse_code, axis=0)
     else :
-        sparse_code = shl_exp.coding
-    nb_filter_selection=np.count_nonzero(sparse_code, axis=0)
+        nb_filter_selection = evaluation.counts
 
     index_max=np.argmax(nb_filter_selection)
     index_min=np.argmin(nb_filter_selection)
     color,label=['r', 'b'], ['most selected filter : {0}'.format(index_max),'less selected filter : {0}'.format(index_min)]
-    coeff_max = np.abs(sparse_code[:,index_max])
-    coeff_min = np.abs(sparse_code[:,index_min])
-    bins_max = bins_step(0.0001,np.max(coeff_max),20)
-    bins_min = bins_step(0.0001,np.max(coeff_min),20)
     fig = plt.figure(figsize=(6, 10))
     ax = plt.subplot(2,1,1)
     with sns.axes_style("white"):
-        n_max,bins1=np.histogram(coeff_max,bins_max)
-        n_min,bins2=np.histogram(coeff_min,bins_min)
+        if evaluation is None :
+            coeff_max = np.abs(sparse_code[:,index_max])
+            coeff_min = np.abs(sparse_code[:,index_min])
+            bins_max = bins_step(0.0001,np.max(coeff_max),20)
+            bins_min = bins_step(0.0001,np.max(coeff_min),20)
+            n_max,bins1=np.histogram(coeff_max,bins_max)
+            n_min,bins2=np.histogram(coeff_min,bins_min)
+        else :
+            n_max, bins1 = evaluation.hist[index_max, :], evaluation.bins
+            n_min, bins2 = evaluation.hist[index_min, :], evaluation.bins
         ax.semilogy(bins1[:-1],n_max,label=label[0],color=color[0])
         ax.semilogy(bins2[:-1],n_min,label=label[1],color=color[1])
     ax.set_title('distribution of coeff in the most & less selected filters')
@@ -267,10 +452,11 @@ def plot_variance_and_proxy(dico, data, title, algorithm=None, fname=None):
     Overlay of 2 histogram, the histogram of the variance of the coefficient,
     and the corresponding gaussian one
     """
+    import matplotlib.pyplot as plt
     if algorithm is not None :
-        sparse_code = shl_encode.sparse_encode(data, dico.dictionary, algorithm=algorithm)
+        sparse_code = sparse_encode(data, dico.dictionary, algorithm=algorithm)
     else :
-        sparse_code = shl_encode.code(data)
+        sparse_code = dico.transform(data)
     Z = np.mean(sparse_code**2)
     P_norm=np.mean(sparse_code**2, axis=0)/Z
     import pandas as pd
@@ -301,16 +487,19 @@ def plot_variance_and_proxy(dico, data, title, algorithm=None, fname=None):
     #print(mom1,mom2)
     return fig, ax
 
-def plot_proba_histogram(coding, verbose=False):
-    n_dictionary=coding.shape[1]
-
-    p = np.count_nonzero(coding, axis=0)/coding.shape[1]
+def plot_proba_histogram(coding, verbose=False, evaluation=None, headless=False):
+    if evaluation is None:
+        n_dictionary=coding.shape[1]
+        p = np.count_nonzero(coding, axis=0)/coding.shape[1]
+    else:
+        n_dictionary = evaluation.n_dictionary
+        p = evaluation.counts / evaluation.n_samples
     p /= p.sum()
 
     rel_ent = np.sum( -p * np.log(p)) / np.log(n_dictionary)
     if verbose: print('Entropy / Entropy_max=', rel_ent )
 
-    fig = plt.figure(figsize=(16, 4))
+    fig = get_figure((16, 4), headless=headless)
     ax = fig.add_subplot(111)
     ax.bar(np.arange(n_dictionary), p*n_dictionary)
     ax.set_title('distribution of the selection probability - entropy= ' + str(rel_ent)  )
@@ -319,12 +508,16 @@ def plot_proba_histogram(coding, verbose=False):
     ax.axis('tight')
     return fig, ax
 
-def plot_variance(shl_exp, sparse_code, data=None, algorithm=None, fname=None):
-    n_dictionary = shl_exp.n_dictionary
-    Z = np.mean(sparse_code**2)
-    fig = plt.figure(figsize=(16, 4))
+def plot_variance(shl_exp, sparse_code, data=None, algorithm=None, fname=None, evaluation=None, headless=False):
+    if evaluation is None:
+        variance = np.mean(sparse_code**2, axis=0)
+    else:
+        variance = evaluation.variance
+    n_dictionary = variance.size
+    Z = np.mean(variance)
+    fig = get_figure((16, 4), headless=headless)
     ax = fig.add_subplot(111)
-    ax.bar(np.arange(n_dictionary), np.mean(sparse_code**2, axis=0)/Z)#, yerr=np.std(code**2/Z, axis=0))
+    ax.bar(np.arange(n_dictionary), variance/Z)#, yerr=np.std(code**2/Z, axis=0))
     ax.set_title('Variance of coefficients')
     ax.set_ylabel('Variance')
     ax.set_xlabel('#')
@@ -332,17 +525,21 @@ def plot_variance(shl_exp, sparse_code, data=None, algorithm=None, fname=None):
     if not fname is None: fig.savefig(fname, dpi=200)
     return fig, ax
 
-def plot_variance_histogram(shl_exp, sparse_code, data=None, algorithm=None, fname=None):
+def plot_variance_histogram(shl_exp, sparse_code, data=None, algorithm=None, fname=None, evaluation=None, headless=False):
     from scipy.stats import gamma
 
-    Z = np.mean(sparse_code**2)
+    if evaluation is None:
+        variance = np.mean(sparse_code**2, axis=0)
+    else:
+        variance = evaluation.variance
+    Z = np.mean(variance)
     import pandas as pd
     import seaborn as sns
-    df = pd.DataFrame(np.mean(sparse_code**2, axis=0)/Z, columns=['Variance'])
-    fig = plt.figure(figsize=(16, 4))
+    df = pd.DataFrame(variance/Z, columns=['Variance'])
+    fig = get_figure((16, 4), headless=headless)
     ax = fig.add_subplot(111)
     with sns.axes_style("white"):
-        ax = sns.distplot(df['Variance'], kde=False)#, fit=gamma,  fit_kws={'clip':(0., 5.)})
+        ax = sns.histplot(df['Variance'], ax=ax)
     ax.set_title('distribution of the mean variance of coefficients')
     ax.set_ylabel('pdf')
     ax.set_xlim(0)
@@ -351,6 +548,7 @@ def plot_variance_histogram(shl_exp, sparse_code, data=None, algorithm=None, fna
 
 
 def plot_P_cum(P_cum, verbose=False, n_yticks= 21, alpha=.05, fig=None, ax=None, c='g'):
+    import matplotlib.pyplot as plt
     if fig is None: fig = plt.figure(figsize=(16, 8))
     if ax is None: ax = fig.add_subplot(111)
     coefficients = np.linspace(0, 1, P_cum.shape[1])
@@ -367,6 +565,7 @@ def plot_P_cum(P_cum, verbose=False, n_yticks= 21, alpha=.05, fig=None, ax=None,
 #import seaborn as sns
 #import pandas as pd
 def plot_scatter_MpVsTrue(sparse_vector, my_sparse_code, alpha=.01, xlabel='True', ylabel='MP'):
+    import matplotlib.pyplot as plt
 
     fig = plt.figure(figsize=(16, 16))
     ax = fig.add_subplot(111)
@@ -382,7 +581,7 @@ def plot_scatter_MpVsTrue(sparse_vector, my_sparse_code, alpha=.01, xlabel='True
     return fig, ax
 
 
-def time_plot(shl_exp, dico, variable='kurt', N_nosample=1, alpha=.3, fname=None):
+def time_plot(shl_exp, dico, variable='kurt', N_nosample=1, alpha=.3, fname=None, headless=False):
     try:
         df_variable = dico.record[variable]
         learning_time = np.array(df_variable.index) #np.arange(0, dico.n_iter, dico.record_each)
@@ -391,7 +590,7 @@ def time_plot(shl_exp, dico, variable='kurt', N_nosample=1, alpha=.3, fname=None
             A[ii, :] = df_variable[ind]
 
         #print(learning_time, A[:, :-N_nosample].shape)
-        fig = plt.figure(figsize=(12, 4))
+        fig = get_figure((12, 4), headless=headless)
         ax = fig.add_subplot(111)
         ax.plot(learning_time, A[:, :-N_nosample], '-', lw=1, alpha=alpha)
         ax.set_ylabel(variable)
@@ -405,7 +604,7 @@ def time_plot(shl_exp, dico, variable='kurt', N_nosample=1, alpha=.3, fname=None
         return fig, ax
 
     except AttributeError:
-        fig = plt.figure(figsize=(12, 1))
+        fig = get_figure((12, 1), headless=headless)
         ax = fig.add_subplot(111)
         ax.set_title('record not available')
         ax.set_ylabel(variable)
@@ -413,3 +612,76 @@ def time_plot(shl_exp, dico, variable='kurt', N_nosample=1, alpha=.3, fname=None
         ax.set_xlim(0, dico.n_iter)
         if not fname is None: fig.savefig(fname, dpi=200)
         return fig, ax
+
+def render_figure(figure, dico, fname, sparse_code=None, evaluation=None, title=None, dpi=200):
+    """
+    Renders one figure of a finished experiment to ``fname`` with the Agg
+    backend and without pyplot.
+
+    Parameters
+    ----------
+    figure : str
+        One of the names accepted in ``SHL.learn_dico(list_figures=...)``:
+        'show_dico', 'show_dico_in_order', 'plot_variance',
+        'plot_variance_histogram', 'time_plot_var', 'time_plot_kurt',
+        'time_plot_prob', 'time_plot_error' or 'time_plot_entropy'.
+
+    dico : SparseHebbianLearning
+        The learned dictionary (with its ``record`` for the time plots).
+
+    sparse_code, evaluation :
+        The coding of the data (see ``shl_evaluate.evaluate``), needed by
+        'show_dico_in_order' and the variance plots.
+
+    """
+    time_plots = {'time_plot_var':'var', 'time_plot_kurt':'kurt', 'time_plot_prob':'prob_active',
+                  'time_plot_error':'error', 'time_plot_entropy':'entropy'}
+    if figure in ['show_dico_in_order', 'plot_variance', 'plot_variance_histogram']:
+        if sparse_code is None and evaluation is None:
+            raise ValueError('the figure {} needs the sparse_code or the evaluation of the data.'.format(figure))
+    if figure == 'show_dico':
+        fig, ax = show_dico(None, dico, title=title, fname=fname, dpi=dpi, headless=True)
+    elif figure == 'show_dico_in_order':
+        fig, ax = show_dico(None, dico, sparse_code=sparse_code, evaluation=evaluation, order=True,
+                            title=title, fname=fname, dpi=dpi, headless=True)
+    elif figure == 'plot_variance':
+        fig, ax = plot_variance(None, sparse_code, evaluation=evaluation, fname=fname, headless=True)
+    elif figure == 'plot_variance_histogram':
+        fig, ax = plot_variance_histogram(None, sparse_code, evaluation=evaluation, fname=fname, headless=True)
+    elif figure in time_plots:
+        fig, ax = time_plot(None, dico, variable=time_plots[figure], fname=fname, headless=True)
+    else:
+        raise ValueError('unknown figure ' + figure)
+    return fname
+
+def _render_job(job):
+    return render_figure(**job)
+
+def render_figures(jobs, n_jobs=None, verbose=0, backend=None):
+    """
+    Renders a batch of figures in a process pool.
+
+    Parameters
+    ----------
+    jobs : list of dict
+        Keyword arguments of ``render_figure`` for each figure, for instance
+        ``{'figure':'show_dico', 'dico':dico, 'fname':'dico.png'}``.
+
+    n_jobs : int
+        Number of worker processes (defaults to the number of CPUs).
+
+    backend : Backend or str
+        See ``shl_backend``, by default a pool of processes.
+
+    Returns
+    -------
+    fnames : list of str
+        The files which were written, in the order of ``jobs``.
+
+    """
+    from shl_scripts.shl_backend import get_backend
+    fnames = []
+    for fname in get_backend(backend, n_jobs=n_jobs, default='processes').imap(_render_job, jobs):
+        fnames.append(fname)
+        if verbose: print('rendered', fnames[-1])
+    return fnames
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*
+from __future__ import division, print_function, absolute_import
+"""
+Trajectories of the dictionary during learning.
+
+``dict_learning`` snapshots the dictionary and ``P_cum`` every
+``snapshot_each`` iterations into a ``TrajectoryStore``: snapshots are
+appended to a raw binary file which is read back as a memory map, such that
+any snapshot may be accessed without loading the others::
+
+    dico = SparseHebbianLearning(..., trajectory='/tmp/run', snapshot_each=16)
+    dico.fit(data)
+    store = TrajectoryStore('/tmp/run', mode='r')
+    dictionary, P_cum = store.get(1024)
+
+To save space, snapshots may be stored as float16 and/or as deltas from the
+previous snapshot, with a full snapshot (a keyframe) every ``keyframe_each``
+ones. Deltas are taken from the decoded previous snapshot (closed loop), such
+that the rounding errors do not accumulate along the trajectory.
+
+A store is made of three files: ``path.json`` (shapes and format),
+``path.bin`` (the snapshots) and ``path.iter`` (their iterations, as int64).
+
+"""
+import os
+import json
+import numpy as np
+
+class TrajectoryStore:
+    """Append-only store of snapshots of a dictionary and of its ``P_cum``.
+
+    Parameters
+    ----------
+    path : str
+        Prefix of the files of the store.
+
+    mode : {'a', 'r', 'w'}
+        'a' appends to the store (creating it if needed), 'r' only reads it
+        and 'w' overwrites it.
+
+    dtype : str
+        Type of the stored values ('float16', 'float32' or 'float64').
+
+    delta : bool
+        Whether snapshots are stored as deltas from the previous one.
+
+    keyframe_each : int
+        With ``delta``, one snapshot in ``keyframe_each`` is stored in full.
+
+    The format of an existing store is read from its files and the above
+    parameters are then ignored.
+
+    """
+    def __init__(self, path, mode='a', dtype='float32', delta=False, keyframe_each=10):
+        if not mode in ['a', 'r', 'w']:
+            raise ValueError('mode must be "a", "r" or "w", got %s.' % mode)
+        self.path = path
+        self.mode = mode
+        self.meta = dict(dtype=np.dtype(dtype).name, delta=delta, keyframe_each=keyframe_each,
+                         dictionary_shape=None, P_cum_shape=None)
+        self.n_frames = 0
+        self._data = None
+        self._last = None
+        if mode == 'w':
+            for ext in ['.json', '.bin', '.iter']:
+                if os.path.isfile(path + ext): os.remove(path + ext)
+        elif os.path.isfile(path + '.json'):
+            with open(path + '.json') as fp:
+                self.meta.update(json.load(fp))
+            # only the snapshots whose iteration was written are complete
+            n_iter = os.path.getsize(path + '.iter') // 8 if os.path.isfile(path + '.iter') else 0
+            n_bin = os.path.getsize(path + '.bin') // self.frame_bytes if os.path.isfile(path + '.bin') else 0
+            self.n_frames = min(n_iter, n_bin)
+            if mode == 'a':
+                for ext, n_bytes in [('.bin', self.frame_bytes), ('.iter', 8)]:
+                    if os.path.isfile(path + ext):
+                        with open(path + ext, 'r+b') as fp: fp.truncate(self.n_frames * n_bytes)
+        elif mode == 'r':
+            raise FileNotFoundError('no trajectory store at ' + path)
+
+    @property
+    def frame_size(self):
+        size = int(np.prod(self.meta['dictionary_shape']))
+        if not self.meta['P_cum_shape'] is None:
+            size += int(np.prod(self.meta['P_cum_shape']))
+        return size
+
+    @property
+    def frame_bytes(self):
+        return self.frame_size * np.dtype(self.meta['dtype']).itemsize
+
+    @property
+    def nbytes(self):
+        return self.n_frames * self.frame_bytes
+
+    def __len__(self):
+        return self.n_frames
+
+    @property
+    def iterations(self):
+        if self.n_frames == 0: return np.zeros(0, dtype=np.int64)
+        return np.fromfile(self.path + '.iter', dtype=np.int64, count=self.n_frames)
+
+    def is_keyframe(self, index):
+        return not self.meta['delta'] or index % self.meta['keyframe_each'] == 0
+
+    def append(self, iteration, dictionary, P_cum=None):
+        """
+        Appends the snapshot of ``iteration``, which must be later than that
+        of the last snapshot.
+
+        """
+        if self.mode == 'r':
+            raise ValueError('the trajectory store at %s is read-only.' % self.path)
+        if self.n_frames > 0:
+            last = int(np.fromfile(self.path + '.iter', dtype=np.int64, count=1, offset=8 * (self.n_frames - 1))[0])
+            if not iteration > last:
+                raise ValueError('iteration {} does not follow the last snapshot of {} (at iteration {}).'.format(
+                                 iteration, self.path, last))
+        if self.meta['dictionary_shape'] is None:
+            self.meta['dictionary_shape'] = list(dictionary.shape)
+            self.meta['P_cum_shape'] = None if P_cum is None else list(P_cum.shape)
+            with open(self.path + '.json', 'w') as fp:
+                json.dump(self.meta, fp)
+        value = dictionary.ravel() if P_cum is None else np.concatenate((dictionary.ravel(), P_cum.ravel()))
+        if not value.size == self.frame_size:
+            raise ValueError('a snapshot of {} values does not fit the store of {} values per snapshot.'.format(
+                             value.size, self.frame_size))
+        if self.is_keyframe(self.n_frames):
+            frame = value.astype(self.meta['dtype'])
+            self._last = frame.astype(np.float64)
+        else:
+            if self._last is None:
+                self._last = self.decode(self.n_frames - 1)
+            frame = (value - self._last).astype(self.meta['dtype'])
+            self._last = self._last + frame
+        # the snapshot is written before its iteration, which validates it
+        with open(self.path + '.bin', 'ab') as fp:
+            fp.write(frame.tobytes())
+        with open(self.path + '.iter', 'ab') as fp:
+            fp.write(np.int64(iteration).tobytes())
+        self.n_frames += 1
+        self._data = None
+
+    @property
+    def data(self):
+        # the snapshots as stored, of shape (n_frames, frame_size)
+        if self._data is None:
+            self._data = np.memmap(self.path + '.bin', dtype=self.meta['dtype'], mode='r',
+                                   shape=(self.n_frames, self.frame_size))
+        return self._data
+
+    def decode(self, index):
+        """
+        The values (as float64) of the snapshot of index ``index``.
+
+        """
+        if index < 0: index += self.n_frames
+        if not 0 <= index < self.n_frames:
+            raise IndexError('snapshot {} out of a trajectory of {} snapshots'.format(index, self.n_frames))
+        if self.is_keyframe(index):
+            return self.data[index].astype(np.float64)
+        i_key = index - index % self.meta['keyframe_each']
+        value = self.data[i_key].astype(np.float64)
+        for frame in self.data[i_key+1:index+1]:
+            value += frame
+        return value
+
+    def split(self, value):
+        n_dictionary = int(np.prod(self.meta['dictionary_shape']))
+        dictionary = value[:n_dictionary].reshape(self.meta['dictionary_shape'])
+        if self.meta['P_cum_shape'] is None:
+            return dictionary, None
+        return dictionary, value[n_dictionary:].reshape(self.meta['P_cum_shape'])
+
+    def __getitem__(self, index):
+        """
+        Returns the dictionary and ``P_cum`` (or None) of the snapshot of
+        index ``index``.
+
+        """
+        return self.split(self.decode(index))
+
+    def get(self, iteration):
+        """
+        Returns the dictionary and ``P_cum`` of the last snapshot taken at or
+        before ``iteration``.
+
+        """
+        index = np.searchsorted(self.iterations, iteration, side='right') - 1
+        if index < 0:
+            raise KeyError('no snapshot at or before iteration {}'.format(iteration))
+        return self[int(index)]
+
+    def __iter__(self):
+        """
+        Yields the iteration, the dictionary and ``P_cum`` of all snapshots,
+        decoding the deltas incrementally.
+
+        """
+        value = None
+        for index, iteration in enumerate(self.iterations):
+            if self.is_keyframe(index):
+                value = self.data[index].astype(np.float64)
+            else:
+                value = value + self.data[index]
+            dictionary, P_cum = self.split(value)
+            yield int(iteration), dictionary.copy(), None if P_cum is None else P_cum.copy()
+
+    def __getstate__(self):
+        # a pickled store (e.g. with a learned dictionary) only keeps its path
+        return dict(path=self.path)
+
+    def __setstate__(self, state):
+        # and is reopened read-only on first access, such that the pickle
+        # stays readable if the files were moved or deleted
+        self.path = state['path']
+        self.mode = 'r'
+
+    def __getattr__(self, name):
+        if name in ['meta', 'n_frames', '_data', '_last'] and 'path' in self.__dict__:
+            self.__init__(self.path, mode='r')
+            return getattr(self, name)
+        raise AttributeError(name)
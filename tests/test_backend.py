@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+
+from shl_scripts.shl_backend import Backend
+from shl_scripts.shl_benchmark import get_synthetic_data
+from shl_scripts.shl_encode import sparse_encode
+
+def norm(X):
+    return np.sqrt(np.sum(X**2, axis=1))
+
+@pytest.mark.parametrize('kind', ['serial', 'threads', 'processes'])
+def test_backend_map(kind):
+    X, _, _ = get_synthetic_data(100, 36, 4, n_pixels=64)
+    jobs = np.array_split(X, 5)
+    results = Backend(kind, n_jobs=2).map(norm, jobs)
+    assert len(results) == len(jobs)
+    for result, X_ in zip(results, jobs):
+        np.testing.assert_array_equal(result, norm(X_))
+
+@pytest.mark.parametrize('kind', ['serial', 'threads', 'processes'])
+def test_sparse_encode_backend(kind):
+    X, dictionary, _ = get_synthetic_data(200, 36, 4, n_pixels=64)
+    sparse_code = sparse_encode(X, dictionary, l0_sparseness=4)
+    sparse_code_backend = sparse_encode(X, dictionary, l0_sparseness=4, backend=Backend(kind, n_jobs=2))
+    np.testing.assert_allclose(sparse_code_backend, sparse_code)
@@ -0,0 +1,49 @@
+import numpy as np
+
+from shl_scripts.shl_benchmark import (get_dictionary, get_synthetic_data, run_benchmarks, save_baseline,
+                                       homeostasis_report)
+
+def test_synthetic_data_keeps_global_state():
+    state = np.random.get_state()[1].copy()
+    X, dictionary, sparse_vector = get_synthetic_data(50, 36, 4, n_pixels=64, seed=1)
+    np.testing.assert_array_equal(np.random.get_state()[1], state)
+    np.testing.assert_allclose(np.sum(dictionary**2, axis=1), 1.)
+    np.testing.assert_array_equal(np.count_nonzero(sparse_vector, axis=1), 4)
+    np.testing.assert_allclose(X, sparse_vector @ dictionary)
+    np.testing.assert_array_equal(get_dictionary(36, 64, seed=1), dictionary)
+
+def test_run_benchmarks_baseline(tmp_path):
+    kwargs = dict(list_n_samples=[64], list_n_dictionary=[36], list_l0_sparseness=[4], n_pixels=64,
+                  repeat=1, do_data=False)
+    results = run_benchmarks(**kwargs)
+    assert len(results) > 0
+    assert np.all(results['time'] > 0) and np.all(results['peak_memory'] > 0)
+    fname = str(tmp_path / 'baseline.json')
+    save_baseline(results, fname)
+    results = run_benchmarks(baseline=fname, **kwargs)
+    assert np.all(results['speedup'] > 0)
+
+def test_homeostasis_report_keeps_global_state():
+    state = np.random.get_state()[1].copy()
+    kwargs = dict(list_homeo_every=[1, 4], n_samples=400, n_dictionary=36, n_pixels=64, l0_sparseness=4,
+                  n_iter=16, batch_size=40, nb_quant=32)
+    results = homeostasis_report(**kwargs)
+    np.testing.assert_array_equal(np.random.get_state()[1], state)
+    assert list(results['homeo_every']) == [1, 4]
+    assert results['P_cum_error'].iloc[0] == 0
+    # the learning is seeded
+    np.testing.assert_array_equal(homeostasis_report(**kwargs)['rmse'], results['rmse'])
+
+def test_encoder_frontier():
+    from shl_scripts.shl_benchmark import encoder_frontier
+    results = encoder_frontier(list_n_dictionary=[36], list_l0_sparseness=[3], algorithms=['mp', 'comp'],
+                               n_samples=200, n_pixels=64, repeat=1)
+    assert list(results['algorithm']) == ['mp', 'comp']
+    assert np.all((results['support_recovery'] > 0) & (results['support_recovery'] <= 1))
+    assert np.all(results['rec_error'] < 1)
+    # at least one point of each size is not dominated
+    assert results['pareto'].any()
+    for _, row in results[results['pareto']].iterrows():
+        dominated = ((results['throughput'] > row['throughput'])
+                     & (results['support_recovery'] > row['support_recovery']))
+        assert not dominated.any()
@@ -0,0 +1,27 @@
+import threading
+import numpy as np
+
+from shl_scripts.shl_benchmark import get_synthetic_data
+from shl_scripts.shl_distributed import Coordinator, run_worker
+
+def test_coordinator_round_trip():
+    X, dictionary, _ = get_synthetic_data(400, 36, 4, n_pixels=64)
+    init = np.random.default_rng(0).standard_normal(dictionary.shape)
+    coordinator = Coordinator(init, n_iter=20, l0_sparseness=4, batch_size=20, max_staleness=4).start()
+    try:
+        workers = [threading.Thread(target=run_worker, args=(coordinator.address, X_), kwargs=dict(seed=i))
+                   for i, X_ in enumerate(np.array_split(X, 2))]
+        for worker in workers: worker.start()
+        coordinator.wait(timeout=30)
+        for worker in workers: worker.join(timeout=30)
+        stats = coordinator.stats()
+    finally:
+        coordinator.stop()
+    assert stats['version'] == 20
+    assert stats['n_workers_seen'] == 2
+    assert stats['max_staleness'] <= 4
+    assert coordinator.dictionary.shape == dictionary.shape
+    assert np.all(np.isfinite(coordinator.dictionary))
+    # the updates were applied to the (normalized) initial dictionary
+    init /= np.sqrt(np.sum(init**2, axis=1))[:, np.newaxis]
+    assert not np.allclose(coordinator.dictionary, init)
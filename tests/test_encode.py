@@ -0,0 +1,162 @@
+import numpy as np
+
+from shl_scripts.shl_benchmark import get_synthetic_data, get_dictionary, get_P_cum_init
+from shl_scripts.shl_encode import sparse_encode, sparse_encode_multi
+
+def test_sparse_encode_multi():
+    X, dictionary, _ = get_synthetic_data(200, 36, 4, n_pixels=64)
+    dictionaries = [dictionary, get_dictionary(49, 64, seed=1), dictionary]
+    P_cums = [None, get_P_cum_init(X, dictionaries[1], nb_quant=32, do_sym=True),
+              get_P_cum_init(X, dictionary, nb_quant=32, do_sym=False)]
+    # each dictionary is encoded with its own configuration
+    l0_sparseness, do_sym = [4, 6, 5], [True, True, False]
+    sparse_codes = sparse_encode_multi(X, dictionaries, P_cums=P_cums, l0_sparseness=l0_sparseness,
+                                       do_sym=do_sym)
+    for i, sparse_code in enumerate(sparse_codes):
+        np.testing.assert_allclose(sparse_code, sparse_encode(X, dictionaries[i], P_cum=P_cums[i],
+                                   l0_sparseness=l0_sparseness[i], do_sym=do_sym[i]))
+
+def test_gram_cache():
+    from shl_scripts.shl_encode import GramCache
+    dictionary = get_dictionary(20, 64)
+    gram = dictionary @ dictionary.T
+    cache = GramCache(dictionary, max_rows=3)
+    np.testing.assert_allclose(cache.diag, np.diag(gram))
+    for ind in [0, 1, 2, 0, 3, 1]:
+        np.testing.assert_allclose(cache[ind], gram[ind])
+    # 0 was used again before 3 was added, such that 1 was evicted
+    assert (cache.hits, cache.misses) == (1, 5)
+    assert list(cache.rows) == [0, 3, 1]
+
+def test_mp_gram_cache():
+    from shl_scripts.shl_encode import GramCache
+    X, dictionary, _ = get_synthetic_data(200, 64, 5, n_pixels=64)
+    P_cum = get_P_cum_init(X, dictionary, nb_quant=32)
+    for P_cum_ in [None, P_cum]:
+        sparse_code = sparse_encode(X, dictionary, l0_sparseness=5, P_cum=P_cum_)
+        # rows computed on demand, with a cache smaller than the dictionary
+        np.testing.assert_allclose(sparse_encode(X, dictionary, l0_sparseness=5, P_cum=P_cum_, gram_cache=8),
+                                   sparse_code)
+        cache = GramCache(dictionary, max_rows=64)
+        for X_ in np.array_split(X, 4):
+            sparse_encode(X_, dictionary, l0_sparseness=5, P_cum=P_cum_, gram_cache=cache)
+        assert cache.hits > 0 and cache.misses <= 64
+
+def test_mp_tree():
+    from shl_scripts.shl_encode import AtomTree, mp, mp_tree
+    X, dictionary, _ = get_synthetic_data(200, 64, 5, n_pixels=64)
+    P_cum = get_P_cum_init(X, dictionary, nb_quant=32)
+    tree = AtomTree(dictionary, n_clusters=8, n_probe=2)
+    # the clusters partition the atoms
+    members = tree.members[tree.members >= 0]
+    np.testing.assert_array_equal(np.sort(members), np.arange(64))
+    for P_cum_ in [None, P_cum]:
+        # probing all clusters is an exact MP
+        sparse_code = mp(X, dictionary, l0_sparseness=5, P_cum=P_cum_)
+        np.testing.assert_allclose(mp_tree(X, dictionary, tree, l0_sparseness=5, P_cum=P_cum_, n_probe=8),
+                                   sparse_code)
+        np.testing.assert_allclose(mp_tree(X, dictionary, tree, l0_sparseness=5, P_cum=P_cum_, n_probe=100),
+                                   sparse_code)
+    tree.n_selections = tree.n_mismatches = 0
+    mp_tree(X, dictionary, tree, l0_sparseness=5, n_probe=8, check=True)
+    assert tree.n_selections == 200 * 5 and tree.n_mismatches == 0
+    # with fewer clusters, the code is approximate but as sparse
+    sparse_code = sparse_encode(X, dictionary, l0_sparseness=5, atom_tree=tree)
+    assert np.all(np.count_nonzero(sparse_code, axis=1) <= 5)
+    residual = X - sparse_code @ dictionary
+    assert np.sum(residual**2) < np.sum(X**2)
+    np.testing.assert_allclose(mp_tree(X, dictionary, tree, l0_sparseness=5, n_probe=0),
+                               mp_tree(X, dictionary, tree, l0_sparseness=5, n_probe=1))
+
+def get_unrolled(dictionary, shape):
+    # each atom placed at each position of an image, as a dense dictionary
+    n_dictionary, n_pixels = dictionary.shape
+    patch_size = int(np.sqrt(n_pixels))
+    n_y, n_x = shape[0] - patch_size + 1, shape[1] - patch_size + 1
+    unrolled = np.zeros((n_dictionary, n_y, n_x) + shape)
+    for i in range(n_y):
+        for j in range(n_x):
+            unrolled[:, i, j, i:i+patch_size, j:j+patch_size] = dictionary.reshape(n_dictionary, patch_size, patch_size)
+    return unrolled.reshape(n_dictionary * n_y * n_x, -1)
+
+def test_conv_mp():
+    from shl_scripts.shl_encode import mp, conv_mp, conv_correlate, conv_decode
+    dictionary = get_dictionary(6, 16, seed=3)
+    image = np.random.default_rng(0).standard_normal((12, 10))
+    unrolled = get_unrolled(dictionary, image.shape)
+    np.testing.assert_allclose(conv_correlate(image, dictionary).ravel(), unrolled @ image.ravel(), atol=1e-10)
+    for do_sym in [True, False]:
+        sparse_code = conv_mp(image, dictionary, l0_sparseness=20, do_sym=do_sym, gram_cache=4)
+        assert sparse_code.shape == (6, 9, 7)
+        reference = mp(image.reshape(1, -1), unrolled, l0_sparseness=20, do_sym=do_sym)
+        np.testing.assert_allclose(sparse_code.ravel(), reference.ravel(), atol=1e-10)
+        np.testing.assert_allclose(conv_decode(sparse_code, dictionary).ravel(), (reference @ unrolled).ravel(), atol=1e-10)
+    # with the homeostasis, the selection uses the P_cum of each atom at every
+    # position (with fine and distinct quantiles, such that there are no ties)
+    from shl_scripts.shl_encode import get_rescaling
+    rng = np.random.default_rng(1)
+    P_cum = np.cumsum(rng.random((6, 4096)), axis=1)
+    P_cum = (P_cum - P_cum[:, :1]) / (P_cum[:, -1:] - P_cum[:, :1])
+    C_vec = get_rescaling(conv_correlate(image, dictionary).ravel(), nb_quant=4096, do_sym=True)
+    sparse_code = conv_mp(image, dictionary, l0_sparseness=20, P_cum=np.vstack((P_cum, C_vec)))
+    reference = mp(image.reshape(1, -1), unrolled, l0_sparseness=20,
+                   P_cum=np.vstack((np.repeat(P_cum, 63, axis=0), C_vec)))
+    np.testing.assert_allclose(sparse_code.ravel(), reference.ravel(), atol=1e-10)
+    # fit_tol stops as soon as the residual is small enough
+    sparse_code = conv_mp(image, dictionary, l0_sparseness=100, fit_tol=.5)
+    residual = image - conv_decode(sparse_code, dictionary)
+    assert np.count_nonzero(sparse_code) < 100
+    assert np.sum(residual**2) <= .5 * np.sum(image**2)
+
+def test_reencode():
+    from shl_scripts.shl_encode import mp, reencode
+    X, dictionary, _ = get_synthetic_data(300, 36, 4, n_pixels=64)
+    sparse_code = mp(X, dictionary, l0_sparseness=4)
+    # with the same dictionary, the previous code is kept
+    code, changed = reencode(X, dictionary, sparse_code, l0_sparseness=4, return_changed=True)
+    assert not changed.any()
+    np.testing.assert_allclose(code, sparse_code, atol=1e-10)
+    rng = np.random.default_rng(0)
+    for eps in [1e-3, 3e-2]:
+        new = dictionary + eps * rng.standard_normal(dictionary.shape)
+        new /= np.sqrt(np.sum(new**2, axis=1))[:, np.newaxis]
+        reference = mp(X, new, l0_sparseness=4)
+        code, changed = reencode(X, new, sparse_code, l0_sparseness=4, previous_dictionary=dictionary,
+                                 return_changed=True)
+        # the samples which fell back are those of a full MP, the others keep their support
+        np.testing.assert_allclose(code[changed], reference[changed])
+        np.testing.assert_array_equal(code[~changed] != 0, (sparse_code[~changed] != 0) & (code[~changed] != 0))
+        residual = np.sum((X - code @ new)**2, axis=1)
+        residual_previous = np.sum((X - sparse_code @ dictionary)**2, axis=1)
+        assert np.all(residual[~changed] <= 1.05 * residual_previous[~changed] + 1e-10)
+        # the same with chunks and rows of the Gram matrix computed on demand
+        code_, changed_ = reencode(X, new, sparse_code, l0_sparseness=4, previous_dictionary=dictionary,
+                                   chunk_size=64, gram_cache=8, return_changed=True)
+        np.testing.assert_array_equal(changed_, changed)
+        np.testing.assert_allclose(code_, code, atol=1e-10)
+    # a small change keeps the warm start of most samples, not a large one
+    fractions = []
+    for eps in [1e-3, 1e-1]:
+        new = dictionary + eps * rng.standard_normal(dictionary.shape)
+        new /= np.sqrt(np.sum(new**2, axis=1))[:, np.newaxis]
+        fractions.append(reencode(X, new, sparse_code, l0_sparseness=4, previous_dictionary=dictionary,
+                                  return_changed=True)[1].mean())
+    assert fractions[0] < .2 < fractions[1]
+    # a larger tolerance keeps more warm starts
+    new = dictionary + 1e-2 * rng.standard_normal(dictionary.shape)
+    new /= np.sqrt(np.sum(new**2, axis=1))[:, np.newaxis]
+    fractions = [reencode(X, new, sparse_code, l0_sparseness=4, tol=tol, previous_dictionary=dictionary,
+                          return_changed=True)[1].mean() for tol in [0., .05, .5]]
+    assert fractions[0] >= fractions[1] >= fractions[2]
+
+def test_shl_reencode(tmp_path):
+    from shl_scripts.shl_experiments import SHL
+    from shl_scripts.shl_learn import SparseHebbianLearning
+    X, dictionary, _ = get_synthetic_data(200, 36, 4, n_pixels=64)
+    shl = SHL(n_dictionary=36, l0_sparseness=4, do_sym=True, data_cache=str(tmp_path))
+    dico = SparseHebbianLearning(fit_algorithm='mp', dictionary=dictionary, l0_sparseness=4, do_sym=True)
+    sparse_code = shl.code(X, dico)
+    code, changed = shl.reencode(X, dico, sparse_code, previous_dico=dico, return_changed=True)
+    assert not changed.any()
+    np.testing.assert_allclose(code, sparse_code, atol=1e-10)
+    np.testing.assert_allclose(shl.reencode(X, dico, sparse_code), code)
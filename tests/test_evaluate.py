@@ -0,0 +1,100 @@
+import numpy as np
+import pytest
+
+from shl_scripts.shl_benchmark import get_synthetic_data, get_P_cum_init
+from shl_scripts.shl_evaluate import Evaluation, evaluate, evaluate_many
+from shl_scripts.shl_experiments import SHL
+from shl_scripts.shl_learn import SparseHebbianLearning
+
+def get_dico(shl, dictionary, P_cum=None):
+    return SparseHebbianLearning(fit_algorithm='mp', dictionary=dictionary, P_cum=P_cum, C=shl.C,
+                                 do_sym=shl.do_sym, l0_sparseness=shl.l0_sparseness)
+
+def test_shl_evaluate_matches_code(tmp_path):
+    X, dictionary, _ = get_synthetic_data(300, 36, 4, n_pixels=64)
+    for do_sym in [False, True]:
+        shl = SHL(n_dictionary=36, l0_sparseness=4, do_sym=do_sym, data_cache=str(tmp_path))
+        for P_cum in [None, get_P_cum_init(X, dictionary, nb_quant=32, do_sym=do_sym)]:
+            dico = get_dico(shl, dictionary, P_cum)
+            reference = Evaluation(36)
+            reference.update(X, shl.code(X, dico), dictionary)
+            evaluation = shl.evaluate(X, dico, chunk_size=128)
+            assert evaluation.n_samples == X.shape[0]
+            np.testing.assert_allclose(evaluation.rmse, reference.rmse)
+            np.testing.assert_allclose(evaluation.prob_active, reference.prob_active)
+            np.testing.assert_allclose(evaluation.mean, reference.mean)
+            np.testing.assert_allclose(evaluation.variance, reference.variance)
+
+def test_evaluate_many_mixed_configs(tmp_path):
+    X, dictionary, _ = get_synthetic_data(300, 36, 4, n_pixels=64)
+    dicos = {}
+    for do_sym in [False, True]:
+        shl = SHL(n_dictionary=36, l0_sparseness=4, do_sym=do_sym, data_cache=str(tmp_path))
+        dicos[do_sym] = get_dico(shl, dictionary, get_P_cum_init(X, dictionary, nb_quant=32, do_sym=do_sym))
+    evaluations = evaluate_many(X, dicos, chunk_size=128)
+    for key, dico in dicos.items():
+        reference = evaluate(X, dico, chunk_size=128)
+        np.testing.assert_allclose(evaluations[key].rmse, reference.rmse)
+        np.testing.assert_allclose(evaluations[key].prob_active, reference.prob_active)
+
+def test_evaluate_matches_tools():
+    from shl_scripts.shl_tools import compute_RMSE, compute_KL, compute_kurto
+    X, dictionary, _ = get_synthetic_data(300, 36, 4, n_pixels=64)
+    dico = SparseHebbianLearning(fit_algorithm='mp', dictionary=dictionary, l0_sparseness=3)
+    evaluation = evaluate(X, dico, chunk_size=64)
+    np.testing.assert_allclose(evaluation.rmse, compute_RMSE(X, dico))
+    np.testing.assert_allclose(evaluation.KL, compute_KL(X, dico))
+    np.testing.assert_allclose(evaluation.kurto, compute_kurto(X, dico))
+    sparse_code = dico.transform(X)
+    np.testing.assert_allclose(evaluation.variance, np.mean(sparse_code**2, axis=0))
+    np.testing.assert_array_equal(evaluation.counts, np.count_nonzero(sparse_code, axis=0))
+    residual = X - sparse_code @ dictionary
+    np.testing.assert_allclose(evaluation.relative_error, np.sum(residual**2) / np.sum(X**2))
+    # the histograms count each non-zero coefficient once
+    assert evaluation.hist.sum() == np.count_nonzero(sparse_code)
+    np.testing.assert_array_equal(evaluation.hist.sum(axis=1), evaluation.counts)
+
+def test_evaluate_chunks_and_merge():
+    X, dictionary, _ = get_synthetic_data(300, 36, 4, n_pixels=64)
+    dico = SparseHebbianLearning(fit_algorithm='mp', dictionary=dictionary, l0_sparseness=3)
+    reference = evaluate(X, dico, chunk_size=300, coeff_max=5.)
+    evaluation = evaluate(X[:100], dico, chunk_size=32, coeff_max=5.)
+    evaluation.merge(evaluate(X[100:], dico, chunk_size=50, coeff_max=5.))
+    assert evaluation.n_samples == reference.n_samples
+    for name in ['rmse', 'relative_error', 'variance', 'kurtosis', 'entropy', 'KL']:
+        np.testing.assert_allclose(getattr(evaluation, name), getattr(reference, name))
+    np.testing.assert_array_equal(evaluation.hist, reference.hist)
+    with pytest.raises(ValueError):
+        evaluation.merge(evaluate(X[:10], dico, coeff_max=4.))
+    # as when the chunks are evaluated in parallel
+    evaluation = evaluate(X, dico, chunk_size=32, coeff_max=5., backend='threads', n_jobs=2)
+    np.testing.assert_allclose(evaluation.rmse, reference.rmse)
+    np.testing.assert_array_equal(evaluation.hist, reference.hist)
+
+def test_moment_accumulator_merge():
+    from scipy.stats import kurtosis
+    from shl_scripts.shl_evaluate import MomentAccumulator
+    _, _, sparse_code = get_synthetic_data(500, 36, 4, n_pixels=64)
+    # shifted, such that the merge formulas are tested with non-zero means
+    sparse_code = sparse_code + np.linspace(-1, 1, 36)
+    sparse_code[::7, 3] = 0.
+    reference = MomentAccumulator(36).update(sparse_code)
+    np.testing.assert_allclose(reference.mean, sparse_code.mean(axis=0))
+    np.testing.assert_allclose(reference.var, sparse_code.var(axis=0))
+    np.testing.assert_allclose(reference.energy, np.mean(sparse_code**2, axis=0))
+    np.testing.assert_allclose(reference.kurtosis, kurtosis(sparse_code, axis=0))
+    np.testing.assert_array_equal(reference.counts, np.count_nonzero(sparse_code, axis=0))
+    # batches of uneven sizes, some accumulated separately and merged
+    accumulator, other = MomentAccumulator(36), MomentAccumulator(36)
+    for i_start, i_end in [(0, 1), (1, 120), (120, 120), (120, 333)]:
+        accumulator.update(sparse_code[i_start:i_end])
+    for i_start, i_end in [(333, 400), (400, 500)]:
+        other.update(sparse_code[i_start:i_end])
+    accumulator.merge(other).merge(MomentAccumulator(36))
+    assert accumulator.n_samples == 500
+    for name in ['mean', 'M2', 'M3', 'M4', 'kurtosis', 'entropy']:
+        np.testing.assert_allclose(getattr(accumulator, name), getattr(reference, name), rtol=1e-10, atol=1e-10)
+    np.testing.assert_array_equal(accumulator.counts, reference.counts)
+    # merging into an empty accumulator copies the other one
+    empty = MomentAccumulator(36).merge(reference)
+    np.testing.assert_allclose(empty.M4, reference.M4)
@@ -0,0 +1,66 @@
+import threading
+import numpy as np
+import pytest
+
+from shl_scripts.shl_benchmark import get_synthetic_data
+from shl_scripts.shl_experiments import sweep, Pipeline
+
+def run_sweep(data, tmp_path, **kwargs):
+    return sweep({'l0_sparseness':[3, 4]}, tag='test', data=data, backend='serial', do_code=True,
+                 data_cache=str(tmp_path), patch_size=(8, 8), n_dictionary=16, n_iter=10, batch_size=20,
+                 record_each=0, **kwargs)
+
+def test_sweep_cache_keys(tmp_path):
+    X, _, _ = get_synthetic_data(200, 16, 3, n_pixels=64)
+    results = run_sweep(X, tmp_path)
+    assert list(results['status']) == ['done', 'done']
+    # a fixed parameter set to its default shares the cached dictionaries
+    results_default = run_sweep(X, tmp_path, eta=.025)
+    assert list(results_default['matname']) == list(results['matname'])
+    # other fixed parameters do not
+    results_eta = run_sweep(X, tmp_path, eta=.05)
+    assert not set(results_eta['matname']) & set(results['matname'])
+    assert not np.allclose(results_eta['rmse'], results['rmse'])
+    # nor other data
+    results_data = run_sweep(X[::-1].copy(), tmp_path)
+    assert not set(results_data['matname']) & set(results['matname'])
+
+def get_pipeline(calls, **kwargs):
+    pipeline = Pipeline(**kwargs)
+    def node(name, func):
+        def compute(*args):
+            calls.append((name, threading.current_thread() is threading.main_thread()))
+            return func(*args)
+        return compute
+    pipeline.add('a', node('a', lambda: 2))
+    pipeline.add('b', node('b', lambda a: a + 1), inputs=['a'])
+    pipeline.add('c', node('c', lambda a: a * 10), inputs=['a'])
+    pipeline.add('d', node('d', lambda b, c: b + c), inputs=['b', 'c'], concurrent=False)
+    return pipeline
+
+def test_pipeline():
+    calls = []
+    pipeline = get_pipeline(calls, n_jobs=2)
+    assert pipeline.get_levels(['d']) == [['a'], ['b', 'c'], ['d']]
+    assert pipeline.run(['d']) == {'d': 23}
+    assert sorted(name for name, main in calls) == ['a', 'b', 'c', 'd']
+    # nodes declared with concurrent=False run in the calling thread
+    assert dict(calls)['d']
+    # cached results are not computed again
+    calls.clear()
+    assert pipeline.run(['b', 'd']) == {'b': 3, 'd': 23}
+    assert calls == []
+    # setting a node invalidates the nodes depending on it
+    pipeline.set('a', 3)
+    assert pipeline.run(['d']) == {'d': 34}
+    assert sorted(name for name, main in calls) == ['b', 'c', 'd']
+
+def test_pipeline_errors():
+    pipeline = get_pipeline([])
+    with pytest.raises(KeyError):
+        pipeline.run(['e'])
+    pipeline.add('a', lambda d: d, inputs=['d'])
+    with pytest.raises(ValueError):
+        pipeline.run(['d'])
+    with pytest.raises(ValueError):
+        get_pipeline([], backend='processes').run(['d'])
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+from shl_scripts.shl_image import get_tiles, overlap_add, reconstruct, psnr
+from shl_scripts.shl_learn import SparseHebbianLearning
+
+def get_identity(patch_size=4, l0_sparseness=None):
+    n_pixels = patch_size**2
+    return SparseHebbianLearning(fit_algorithm='mp', dictionary=np.eye(n_pixels),
+                                 l0_sparseness=n_pixels if l0_sparseness is None else l0_sparseness)
+
+@pytest.mark.parametrize('stride', [(2, 2), (4, 4), (3, 4), (1, 3)])
+def test_overlap_add(stride):
+    image = np.random.default_rng(0).standard_normal((18, 21))
+    tiles = get_tiles(image, (4, 4), stride)
+    np.testing.assert_allclose(overlap_add(tiles, image.shape, stride), image)
+
+@pytest.mark.parametrize('stride', [(2, 2), (4, 4), (3, 4)])
+def test_reconstruct_identity(stride):
+    image = np.random.default_rng(0).standard_normal((18, 21))
+    # all pixels of a tile are coded with the identity dictionary
+    reconstruction = reconstruct(image, get_identity(), stride=stride)
+    np.testing.assert_allclose(reconstruction, image, atol=1e-12)
+    assert psnr(image, reconstruction) > 100
+    # with half of them, the error is finite and no pixel is lost
+    reconstruction = reconstruct(image, get_identity(l0_sparseness=8), stride=stride)
+    assert np.all(np.isfinite(reconstruction))
+    assert 0 < psnr(image, reconstruction) < 100
+
+def test_stride_larger_than_patch():
+    image = np.zeros((16, 16))
+    with pytest.raises(ValueError):
+        get_tiles(image, (4, 4), (5, 4))
+    with pytest.raises(ValueError):
+        overlap_add(np.zeros((3, 3, 4, 4)), (16, 16), (4, 6))
+    with pytest.raises(ValueError):
+        reconstruct(image, get_identity(), stride=(8, 8))
+
+def test_stream_directory(tmp_path):
+    from shl_scripts.shl_image import stream_directory, report_directory
+    rng = np.random.default_rng(0)
+    for i, shape in enumerate([(16, 16), (20, 13)]):
+        np.save(str(tmp_path / 'image_{}.npy'.format(i)), rng.standard_normal(shape))
+    (tmp_path / 'notes.txt').write_text('not an image')
+    results = list(stream_directory(str(tmp_path), get_identity(), whiten=False, stride=(2, 2)))
+    assert [fname for fname, reconstruction, stats in results] == ['image_0.npy', 'image_1.npy']
+    for fname, reconstruction, stats in results:
+        np.testing.assert_allclose(reconstruction, np.load(str(tmp_path / fname)), atol=1e-12)
+        assert stats['n_tiles'] == np.prod([int(np.ceil((n - 4) / 2)) + 1 for n in stats['shape']])
+    report = report_directory(str(tmp_path), get_identity(l0_sparseness=4), whiten=False)
+    assert list(report.index) == ['image_0.npy', 'image_1.npy']
+    assert np.all(report['psnr'] < 100)
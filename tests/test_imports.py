@@ -0,0 +1,24 @@
+import os
+import sys
+import subprocess
+import pytest
+
+HEAVY = ['matplotlib', 'seaborn', 'pandas', 'SLIP', 'scipy', 'sklearn']
+
+def get_modules(code):
+    # a fresh interpreter, such that modules imported by other tests do not count
+    output = subprocess.check_output([sys.executable, '-c', code + '; import sys; print(" ".join(sys.modules))'],
+                                     cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    return set(output.decode().split())
+
+@pytest.mark.parametrize('module', ['shl_scripts', 'shl_scripts.shl_encode', 'shl_scripts.shl_learn',
+                                    'shl_scripts.shl_experiments', 'shl_scripts.shl_tools'])
+def test_lazy_imports(module):
+    modules = get_modules('import ' + module)
+    assert not [name for name in HEAVY if name in modules]
+
+def test_lazy_submodules():
+    modules = get_modules('import shl_scripts')
+    assert not 'shl_scripts.shl_learn' in modules
+    modules = get_modules('import shl_scripts; shl_scripts.shl_encode.mp')
+    assert 'shl_scripts.shl_encode' in modules
@@ -0,0 +1,123 @@
+import numpy as np
+import pytest
+
+from shl_scripts.shl_benchmark import get_synthetic_data
+from shl_scripts.shl_learn import dict_learning, dict_learning_multi, StageTimer, SparseHebbianLearning
+
+@pytest.mark.parametrize('alpha_homeo', [0.02, 0.])
+def test_dict_learning_multi_single(alpha_homeo):
+    X, _, _ = get_synthetic_data(400, 36, 4, n_pixels=64)
+    init = np.random.RandomState(1).randn(36, 64)
+    kwargs = dict(n_dictionary=36, l0_sparseness=4, n_iter=50, batch_size=40, alpha_homeo=alpha_homeo, nb_quant=32)
+    np.random.seed(3)
+    dictionary, P_cum = dict_learning(X, dictionary=init.copy(), **kwargs)
+    np.random.seed(3)
+    [(dictionary_, P_cum_)] = dict_learning_multi(X, dictionaries=init[np.newaxis].copy(), **kwargs)
+    np.testing.assert_allclose(dictionary_, dictionary, atol=1e-10)
+    if alpha_homeo == 0:
+        np.testing.assert_allclose(P_cum_, P_cum, atol=1e-10)
+    else:
+        assert P_cum_ is None and P_cum is None
+
+def test_dict_learning_multi_configurations():
+    X, _, _ = get_synthetic_data(400, 36, 4, n_pixels=64)
+    kwargs = dict(n_dictionary=36, l0_sparseness=4, n_iter=30, batch_size=40)
+    etas, seeds = [0.01, 0.05], [1, 2]
+    np.random.seed(3)
+    results = dict_learning_multi(X, eta=etas, random_state=seeds, **kwargs)
+    assert len(results) == 2
+    # each configuration is learned as on its own, from its own seed
+    for (dictionary, P_cum), eta, seed in zip(results, etas, seeds):
+        np.random.seed(3)
+        [(dictionary_, P_cum_)] = dict_learning_multi(X, eta=eta, random_state=seed, **kwargs)
+        np.testing.assert_allclose(dictionary, dictionary_, atol=1e-10)
+
+def test_stage_timer():
+    import time
+    iterations = []
+    timer = StageTimer(callback=lambda ii, timings: iterations.append((ii, dict(timings))))
+    for ii in range(3):
+        t = timer.start()
+        time.sleep(0.001)
+        t = timer.stop('coding', t)
+        if ii > 0: t = timer.stop('update', t)
+        timer.end_iteration(ii)
+    assert [ii for ii, timings in iterations] == [0, 1, 2]
+    assert sorted(iterations[0][1]) == ['coding'] and sorted(iterations[1][1]) == ['coding', 'update']
+    assert timer.n_iter == 3
+    assert timer.count == {'coding': 3, 'update': 2}
+    assert timer.total['coding'] >= 0.003
+    report = timer.report()
+    np.testing.assert_allclose(report['fraction'].sum(), 1.)
+    np.testing.assert_allclose(report.loc['coding', 'total'], timer.total['coding'])
+
+def test_dict_learning_profile():
+    X, _, _ = get_synthetic_data(400, 36, 4, n_pixels=64)
+    iterations = []
+    dico = SparseHebbianLearning(fit_algorithm='mp', n_dictionary=36, l0_sparseness=4, n_iter=20, batch_size=40,
+                                 alpha_homeo=0., nb_quant=32, record_each=0,
+                                 profile_callback=lambda ii, timings: iterations.append(ii))
+    dico.fit(X)
+    assert iterations == list(range(20))
+    assert dico.timer.n_iter == 20
+    for stage in ['coding', 'update', 'normalisation']:
+        assert dico.timer.count[stage] == 20
+
+def learn(X, **kwargs):
+    kwargs = dict(dict(dictionary=np.random.RandomState(1).randn(36, 64), n_dictionary=36, l0_sparseness=4,
+                       n_iter=40, batch_size=40, alpha_homeo=0., eta_homeo=0.05, nb_quant=32, random_state=3),
+                  **kwargs)
+    return dict_learning(X, **kwargs)
+
+def test_amortised_homeostasis():
+    X, _, _ = get_synthetic_data(400, 36, 4, n_pixels=64)
+    timers = {homeo_every: StageTimer() for homeo_every in [1, 4]}
+    results = {homeo_every: learn(X, homeo_every=homeo_every, timer=timers[homeo_every])
+               for homeo_every in [1, 4]}
+    # the histograms are folded once every homeo_every iterations
+    assert timers[1].count['get_rescaling'] == 40
+    assert timers[4].count['get_rescaling'] == 10
+    P_cum, P_cum_ = results[1][1], results[4][1]
+    assert P_cum_.shape == P_cum.shape
+    assert np.all(np.diff(P_cum_[:-1], axis=1) >= 0)
+    assert P_cum_[:-1].min() >= 0 and P_cum_[:-1].max() <= 1
+    # with the same time constant as the homeostasis at every iteration
+    initial = np.linspace(0, 1, 32)
+    assert np.abs(P_cum_[:-1] - P_cum[:-1]).mean() < .5 * np.abs(P_cum[:-1] - initial).mean()
+
+def test_get_schedule():
+    from shl_scripts.shl_learn import get_schedule
+    assert get_schedule('constant', 100)(50) == 1.
+    np.testing.assert_allclose(get_schedule('decay', 100, decay=10.)(100), 1 / 11)
+    warmup = get_schedule('warmup', 100, warmup=.1)
+    np.testing.assert_allclose([warmup(0), warmup(4), warmup(9), warmup(50)], [.1, .5, 1., 1.])
+    cosine = get_schedule('cosine', 100, warmup=.1)
+    np.testing.assert_allclose([cosine(0), cosine(50), cosine(100)], [.1, .5, 0.], atol=1e-12)
+    factor = lambda ii: 2.
+    assert get_schedule(factor, 100) is factor
+    with pytest.raises(ValueError):
+        get_schedule('linear', 100)
+
+def test_schedules_and_optimizers():
+    X, _, _ = get_synthetic_data(400, 36, 4, n_pixels=64)
+    dictionary, P_cum = learn(X)
+    np.testing.assert_array_equal(learn(X, eta_schedule=lambda ii: 1.)[0], dictionary)
+    # without learning rate, the dictionary and the homeostasis do not move
+    init = np.random.RandomState(1).randn(36, 64)
+    init /= np.sqrt(np.sum(init**2, axis=1))[:, np.newaxis]
+    dictionary_, P_cum_ = learn(X, eta_schedule=lambda ii: 0., eta_homeo_schedule=lambda ii: 0.)
+    np.testing.assert_allclose(dictionary_, init)
+    np.testing.assert_allclose(P_cum_[:-1], np.linspace(0, 1, 32) * np.ones((36, 1)))
+    # momentum without memory is the plain gradient descent
+    np.testing.assert_allclose(learn(X, optimizer='momentum', momentum=0.)[0], dictionary, atol=1e-10)
+    # all optimizers learn
+    def error(dictionary, P_cum):
+        from shl_scripts.shl_encode import sparse_encode
+        sparse_code = sparse_encode(X, dictionary, l0_sparseness=4, P_cum=P_cum)
+        return np.sum((X - sparse_code @ dictionary)**2)
+    error_init = error(init, P_cum_)
+    for kwargs in [dict(), dict(optimizer='momentum'), dict(optimizer='adam', eta=1e-2),
+                   dict(eta_schedule='cosine'), dict(eta_schedule='decay', eta_homeo_schedule='warmup')]:
+        assert error(*learn(X, n_iter=100, **kwargs)) < error_init
+    with pytest.raises(ValueError):
+        learn(X, optimizer='rmsprop')
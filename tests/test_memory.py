@@ -0,0 +1,18 @@
+import numpy as np
+
+from shl_scripts.shl_benchmark import get_synthetic_data
+from shl_scripts.shl_encode import sparse_encode
+from shl_scripts.shl_memory import set_memory_budget, get_chunk_size, estimate_encode
+
+def test_sparse_encode_budget():
+    X, dictionary, _ = get_synthetic_data(500, 36, 4, n_pixels=64)
+    sparse_code = sparse_encode(X, dictionary, l0_sparseness=4)
+    set_memory_budget('200KB')
+    try:
+        # the budget only leaves room for a few chunks
+        chunk_size = get_chunk_size(lambda n: estimate_encode(n, 36, 64), X.shape[0], reserved=8 * X.shape[0] * 36)
+        assert 1 < chunk_size < X.shape[0]
+        sparse_code_chunked = sparse_encode(X, dictionary, l0_sparseness=4)
+    finally:
+        set_memory_budget(None)
+    np.testing.assert_allclose(sparse_code_chunked, sparse_code)
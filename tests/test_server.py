@@ -0,0 +1,29 @@
+import threading
+import numpy as np
+
+from shl_scripts.shl_benchmark import get_synthetic_data
+from shl_scripts.shl_learn import SparseHebbianLearning
+from shl_scripts.shl_server import serve_in_thread, EncodeClient
+
+def test_encode_server_round_trip():
+    X, dictionary, _ = get_synthetic_data(64, 36, 4, n_pixels=64)
+    dico = SparseHebbianLearning(fit_algorithm='mp', dictionary=dictionary, l0_sparseness=4)
+    server = serve_in_thread(dico, ('127.0.0.1', 0), max_delay=0.01)
+    try:
+        results = {}
+        def request(i_client, X_):
+            with EncodeClient(server.address) as client:
+                results[i_client] = client.encode(X_)
+        # concurrent requests are batched together and each gets its own rows
+        threads = [threading.Thread(target=request, args=(i, X_))
+                   for i, X_ in enumerate(np.array_split(X, 4))]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+        sparse_code = np.vstack([results[i] for i in range(4)])
+        np.testing.assert_allclose(sparse_code, dico.transform(X))
+        with EncodeClient(server.address) as client:
+            stats = client.stats()
+        assert stats['n_requests'] == 4
+        assert stats['n_samples'] == X.shape[0]
+    finally:
+        server.stop()
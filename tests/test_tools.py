@@ -0,0 +1,101 @@
+import numpy as np
+import pytest
+
+from shl_scripts.shl_learn import SparseHebbianLearning
+from shl_scripts.shl_tools import render_figure
+
+@pytest.mark.parametrize('figure', ['show_dico_in_order', 'plot_variance', 'plot_variance_histogram'])
+def test_render_figure_needs_coding(figure, tmp_path):
+    dico = SparseHebbianLearning(fit_algorithm='mp', dictionary=np.eye(16))
+    with pytest.raises(ValueError):
+        render_figure(figure, dico, str(tmp_path / 'figure.png'))
+
+def test_render_figure_unknown(tmp_path):
+    dico = SparseHebbianLearning(fit_algorithm='mp', dictionary=np.eye(16))
+    with pytest.raises(ValueError):
+        render_figure('show_everything', dico, str(tmp_path / 'figure.png'))
+
+def test_generate_sparse_vector():
+    from shl_scripts.shl_tools import generate_sparse_vector
+    state = np.random.get_state()[1].copy()
+    coeff = generate_sparse_vector(2000, 5, 20, C_0=3., rho_coeff=.85, seed=1)
+    np.testing.assert_array_equal(np.random.get_state()[1], state)
+    np.testing.assert_array_equal(coeff, generate_sparse_vector(2000, 5, 20, C_0=3., rho_coeff=.85, seed=1))
+    assert coeff.shape == (2000, 20)
+    np.testing.assert_array_equal(np.count_nonzero(coeff, axis=1), 5)
+    values = coeff[coeff != 0]
+    assert np.all(values <= 3.) and np.all(values > 3. * .85**5)
+    # the supports are uniformly drawn
+    counts = np.count_nonzero(coeff, axis=0)
+    assert np.all(np.abs(counts - 2000 * 5 / 20) < 100)
+    coeff = generate_sparse_vector(2000, 5, 20, N_boost=2, K_boost=10., do_sym=True, seed=1)
+    assert np.any(coeff < 0) and np.any(coeff > 0)
+    assert np.abs(coeff[:, :2]).max() > 3. and np.abs(coeff[:, 2:]).max() <= 3.
+    assert not generate_sparse_vector(3, 0, 20).any()
+    np.testing.assert_array_equal(np.count_nonzero(generate_sparse_vector(3, 20, 20), axis=1), 20)
+    with pytest.raises(ValueError):
+        generate_sparse_vector(3, 21, 20)
+
+def test_generate_sparse_blocks():
+    from shl_scripts.shl_tools import generate_sparse_blocks
+    blocks = list(generate_sparse_blocks(1000, 5, 20, block_size=300, seed=2))
+    assert [block.shape[0] for block in blocks] == [300, 300, 300, 100]
+    # the blocks come from one stream, reproducible from the seed
+    coeff = np.vstack(blocks)
+    np.testing.assert_array_equal(np.count_nonzero(coeff, axis=1), 5)
+    np.testing.assert_array_equal(coeff, np.vstack(list(generate_sparse_blocks(1000, 5, 20, block_size=300, seed=2))))
+    assert not np.array_equal(coeff[:300], coeff[300:600])
+    import itertools
+    stream = generate_sparse_blocks(None, 5, 20, block_size=10)
+    assert len(list(itertools.islice(stream, 7))) == 7
+
+def test_get_montage():
+    from shl_scripts.shl_tools import get_montage
+    dictionary = np.random.default_rng(0).standard_normal((7, 16))
+    dictionary[5] = 0.
+    montage = get_montage(dictionary, indices=[6, 5, 4, 3, 2, 1, 0], pad=1)
+    # 3 columns and 3 rows of 4x4 tiles
+    assert montage.shape == (3 * 5 + 1, 3 * 5 + 1)
+    for i_tile, i_atom in enumerate([6, 5, 4, 3, 2, 1, 0]):
+        row, col = divmod(i_tile, 3)
+        tile = montage[1+5*row:5+5*row, 1+5*col:5+5*col]
+        atom = dictionary[i_atom].reshape(4, 4)
+        if i_atom == 5:
+            np.testing.assert_array_equal(tile, 0.)
+        else:
+            np.testing.assert_allclose(tile, atom / np.abs(atom).max())
+    assert np.all(np.isnan(montage[0, :])) and np.all(np.isnan(montage[:, 5]))
+    # unused tiles
+    assert np.all(np.isnan(montage[11:15, 6:10]))
+
+def test_write_png(tmp_path):
+    import zlib
+    import struct
+    from shl_scripts.shl_tools import write_png
+    image = np.array([[-1., 0., 1.], [np.nan, 2., -.5]])
+    fname = str(tmp_path / 'image.png')
+    write_png(fname, image, zoom=2)
+    with open(fname, 'rb') as fp:
+        png = fp.read()
+    assert png[:8] == b'\x89PNG\r\n\x1a\n'
+    width, height = struct.unpack('>II', png[16:24])
+    assert (height, width) == (4, 6)
+    i_data = png.index(b'IDAT')
+    length = struct.unpack('>I', png[i_data-4:i_data])[0]
+    raw = np.frombuffer(zlib.decompress(png[i_data+4:i_data+4+length]), dtype=np.uint8).reshape(4, 7)
+    assert np.all(raw[:, 0] == 0)
+    np.testing.assert_array_equal(raw[::2, 1::2], [[255, 127, 0], [255, 0, 191]])
+
+def test_render_figures(tmp_path):
+    pytest.importorskip('matplotlib')
+    from shl_scripts.shl_tools import render_figures
+    dico = SparseHebbianLearning(fit_algorithm='mp', dictionary=np.random.default_rng(0).standard_normal((16, 16)),
+                                 l0_sparseness=2)
+    sparse_code = dico.transform(np.random.default_rng(1).standard_normal((50, 16)))
+    jobs = [dict(figure=figure, dico=dico, sparse_code=sparse_code, fname=str(tmp_path / (figure + '.png')))
+            for figure in ['show_dico', 'show_dico_in_order', 'plot_variance']]
+    fnames = render_figures(jobs, backend='serial')
+    assert fnames == [job['fname'] for job in jobs]
+    for fname in fnames:
+        with open(fname, 'rb') as fp:
+            assert fp.read(8) == b'\x89PNG\r\n\x1a\n'
@@ -0,0 +1,83 @@
+import pickle
+import numpy as np
+import pytest
+
+from shl_scripts.shl_trajectory import TrajectoryStore
+
+def get_trajectory(n_frames=25, seed=0):
+    rng = np.random.default_rng(seed)
+    dictionary = rng.standard_normal((8, 16))
+    P_cum = np.linspace(0, 1, 5)[np.newaxis, :] * np.ones((8, 1))
+    frames = []
+    for i_frame in range(n_frames):
+        dictionary = dictionary + .01 * rng.standard_normal(dictionary.shape)
+        P_cum = P_cum + .001 * rng.random(P_cum.shape)
+        frames.append((10 * i_frame, dictionary, P_cum))
+    return frames
+
+def test_float16_delta(tmp_path):
+    path = str(tmp_path / 'run')
+    frames = get_trajectory()
+    store = TrajectoryStore(path, mode='w', dtype='float16', delta=True, keyframe_each=10)
+    for iteration, dictionary, P_cum in frames:
+        store.append(iteration, dictionary, P_cum)
+    assert len(store) == len(frames)
+    assert store.nbytes == len(frames) * (8 * 16 + 8 * 5) * 2
+    # the deltas are closed loop: the error does not grow along the trajectory
+    for iteration, dictionary, P_cum in frames:
+        dictionary_, P_cum_ = store.get(iteration + 5)
+        np.testing.assert_allclose(dictionary_, dictionary, atol=5e-3)
+        np.testing.assert_allclose(P_cum_, P_cum, atol=5e-3)
+    with pytest.raises(KeyError):
+        store.get(-1)
+    for (iteration, dictionary, P_cum), (iteration_, dictionary_, P_cum_) in zip(frames, store):
+        assert iteration_ == iteration
+        np.testing.assert_allclose(dictionary_, store.get(iteration)[0])
+    # a reopened store appends where it stopped
+    store = TrajectoryStore(path, mode='a')
+    assert store.meta['dtype'] == 'float16' and store.meta['delta']
+    store.append(1000, dictionary + .01, P_cum)
+    np.testing.assert_allclose(store.get(1000)[0], dictionary + .01, atol=5e-3)
+
+def test_pickle(tmp_path):
+    path = str(tmp_path / 'run')
+    store = TrajectoryStore(path, mode='w', dtype='float16', delta=True)
+    for iteration, dictionary, P_cum in get_trajectory(n_frames=5):
+        store.append(iteration, dictionary, P_cum)
+    store_ = pickle.loads(pickle.dumps(store))
+    # the files are only opened (read-only) on first access
+    assert not 'meta' in store_.__dict__
+    assert len(store_) == 5
+    assert store_.mode == 'r'
+    np.testing.assert_array_equal(store_.get(40)[0], store.get(40)[0])
+    with pytest.raises(ValueError):
+        store_.append(50, dictionary, P_cum)
+    # the pickle stays readable without the files
+    for ext in ['.json', '.bin', '.iter']:
+        (tmp_path / ('run' + ext)).unlink()
+    store_ = pickle.loads(pickle.dumps(store))
+    assert store_.path == path
+
+def test_iterations_increase(tmp_path):
+    path = str(tmp_path / 'run')
+    store = TrajectoryStore(path, mode='w')
+    for iteration, dictionary, P_cum in get_trajectory(n_frames=3):
+        store.append(iteration, dictionary, P_cum)
+    store = TrajectoryStore(path, mode='a')
+    with pytest.raises(ValueError):
+        store.append(20, dictionary, P_cum)
+    assert len(store) == 3
+
+def test_dict_learning_overwrites(tmp_path):
+    from shl_scripts.shl_benchmark import get_synthetic_data
+    from shl_scripts.shl_learn import dict_learning
+    path = str(tmp_path / 'run')
+    X, dictionary, _ = get_synthetic_data(200, 16, 3, n_pixels=36)
+    for seed in [1, 2]:
+        final, _ = dict_learning(X, dictionary=np.random.RandomState(seed).randn(16, 36), n_dictionary=16,
+                                 l0_sparseness=3, n_iter=20, batch_size=20, random_state=seed,
+                                 trajectory=path, snapshot_each=5)
+    # a second run at the same path replaces the trajectory of the first one
+    store = TrajectoryStore(path, mode='r')
+    np.testing.assert_array_equal(store.iterations, np.unique(store.iterations))
+    np.testing.assert_allclose(store.get(19)[0], final, atol=1e-6)